@@ -0,0 +1,114 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Logging through a queue, so that the threads handling requests do not wait
+for log file writes.  Python 2 has no logging.handlers.QueueHandler, so this
+provides equivalents of it and of QueueListener.
+"""
+import random
+import logging
+import threading
+from Queue import Full
+
+_STOP = object()
+_exception_formatter = logging.Formatter()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue for a QueueListener to write.  If the queue is
+    full the record is dropped rather than blocking the caller, and counted
+    in dropped.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Merge the arguments into the message and format any exception now,
+        since the arguments may change, and tracebacks cannot be formatted,
+        once the caller moves on.  The rest of the formatting is left to the
+        listener's handlers.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Background thread which passes records from a queue to handlers.
+    """
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Write out everything queued so far, then stop the thread.
+        """
+        if self._thread:
+            self.queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class Payload(object):
+    """
+    Request or response data to be logged, truncated to limit characters
+    (0 for no limit).  Only a sample_rate fraction of payloads are logged in
+    full; for the rest only the length is logged.  The data is only
+    shortened if the record is actually formatted.
+    """
+    def __init__(self, data, limit, sample_rate):
+        self.data = data
+        self.limit = limit
+        self.sample_rate = sample_rate
+
+    def __str__(self):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return "<%d bytes, not sampled>" % len(self.data)
+        if self.limit and len(self.data) > self.limit:
+            return "%s...<%d bytes truncated>" % (
+                self.data[:self.limit], len(self.data) - self.limit)
+        return self.data
@@ -0,0 +1,119 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Allocate burst benchmark against an in-memory datastore.
+
+Sends bursts of concurrent allocate requests through
+calico_mesos.handle_request, as at a launch burst, once with each allocation
+made separately and once coalesced.  Reports p50/p99 latency, datastore
+round trips per allocation and block compare-and-swap conflicts.  Needs
+pycalico and mock installed, but no etcd.
+
+Usage: python benchmarks/allocate_benchmark.py [--bursts N] [--burst-size N]
+           [--latency MS] [--coalesce-ms MS]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+HOSTNAME = "bench-host"
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(calico_mesos, options, coalesce_ms):
+    from mock import patch
+    from coalescer import AllocationCoalescer
+    from fake_datastore import FakeIPAMClient, Latency
+
+    latency = Latency(options.latency / 1000.0)
+    lazy_datastore = calico_mesos._LazyDatastore()
+    lazy_datastore._client = FakeIPAMClient({4: ["10.0.0.0/16"]}, latency)
+    coalescer = None
+    if coalesce_ms:
+        coalescer = AllocationCoalescer(lazy_datastore, HOSTNAME,
+                                        coalesce_ms / 1000.0)
+
+    durations = []
+    failures = []
+
+    def allocate(uid):
+        start = time.time()
+        code, response = calico_mesos.handle_request(json.dumps(
+            {"command": "allocate",
+             "args": {"hostname": HOSTNAME, "uid": uid, "num_ipv4": 1,
+                      "num_ipv6": 0}}))
+        durations.append((time.time() - start) * 1000)
+        if code or len(json.loads(response)["ipv4"]) != 1:
+            failures.append(response)
+
+    with patch.object(calico_mesos, "datastore", lazy_datastore), \
+            patch.object(calico_mesos, "HOSTNAME", HOSTNAME), \
+            patch.object(calico_mesos, "_allocation_coalescer", coalescer):
+        # Warm up, so that the host has a block.
+        allocate("bench-warmup")
+        del durations[:]
+        before = sum(latency.round_trips.values())
+        for burst in range(options.bursts):
+            threads = [threading.Thread(target=allocate,
+                                        args=("bench-%d-%d" % (burst, i),))
+                       for i in range(options.burst_size)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    allocations = options.bursts * options.burst_size
+    round_trips = sum(latency.round_trips.values()) - before
+    durations.sort()
+    print "%-12s %8d %10.2f %10.2f %12.2f %14d" % (
+        "%.1f ms" % coalesce_ms if coalesce_ms else "off", len(failures),
+        percentile(durations, 0.5), percentile(durations, 0.99),
+        float(round_trips) / allocations, latency.cas_conflicts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--bursts", type=int, default=20)
+    parser.add_argument("--burst-size", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=1.0,
+                        help="ms per datastore round trip")
+    parser.add_argument("--coalesce-ms", type=float, default=5.0,
+                        help="coalescing window compared with none")
+    options = parser.parse_args()
+
+    import logging
+    logging.getLogger("CALICOMESOS").addHandler(logging.NullHandler())
+    logging.getLogger("CALICOMESOS").propagate = False
+    import calico_mesos
+
+    print "%d bursts of %d concurrent allocations, datastore latency %.1f ms" \
+        % (options.bursts, options.burst_size, options.latency)
+    print "%-12s %8s %10s %10s %12s %14s" % ("coalescing", "failed",
+                                             "p50 ms", "p99 ms",
+                                             "round trips", "CAS conflicts")
+    for coalesce_ms in (0, options.coalesce_ms):
+        run(calico_mesos, options, coalesce_ms)
+
+
+if __name__ == '__main__':
+    main()
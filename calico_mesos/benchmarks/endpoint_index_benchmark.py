@@ -0,0 +1,100 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares the endpoint lookups made by isolate and cleanup through the local
+endpoint index with the datastore reads they replace.
+
+The datastore reads are only timed with --etcd, against the etcd configured
+for pycalico (ETCD_AUTHORITY).  The index's durable writes, which isolate and
+cleanup pay instead, are reported too.
+
+Usage: python benchmarks/endpoint_index_benchmark.py [--runs N] [--etcd]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from endpoint_index import EndpointIndex
+
+
+class _Endpoint(object):
+    def __init__(self, container_id):
+        self.hostname = "host"
+        self.orchestrator_id = "mesos"
+        self.workload_id = container_id
+        self.endpoint_id = "ep-" + container_id
+        self.state = "active"
+        self.mac = "ee:ee:ee:ee:ee:ee"
+        self.ipv4_nets = ["192.168.0.1/32"]
+        self.ipv6_nets = []
+        self.profile_ids = ["default_host", "public"]
+
+
+def time_per_call(func, runs):
+    start = time.time()
+    for run in xrange(runs):
+        func(run)
+    return (time.time() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=1000)
+    parser.add_argument("--etcd", action="store_true",
+                        help="also time the equivalent datastore reads")
+    options = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        index = EndpointIndex(os.path.join(tmpdir, "endpoints"))
+        index.rebuild(lambda: [_Endpoint("existing")])
+        timings = [
+            ("index miss (isolate)",
+             lambda run: (index.get("c%d" % run), index.is_complete())),
+            ("index hit (cleanup)", lambda run: index.get("existing")),
+            ("index add (fsync)",
+             lambda run: index.add("c%d" % run, _Endpoint("c%d" % run))),
+            ("index remove (fsync)", lambda run: index.remove("c%d" % run))]
+
+        if options.etcd:
+            from pycalico.ipam import IPAMClient
+            client = IPAMClient()
+            timings.extend([
+                ("etcd get_endpoints",
+                 lambda run: client.get_endpoints(
+                     hostname="host", orchestrator_id="mesos",
+                     workload_id="c%d" % run)),
+                ("etcd get_endpoint", lambda run: _get_endpoint(client))])
+
+        for name, func in timings:
+            print "%-24s %10.1f us/call" % (
+                name, time_per_call(func, options.runs) * 1e6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _get_endpoint(client):
+    try:
+        client.get_endpoint(hostname="host", orchestrator_id="mesos",
+                            workload_id="existing")
+    except KeyError:
+        pass
+
+
+if __name__ == '__main__':
+    main()
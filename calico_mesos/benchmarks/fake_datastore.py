@@ -0,0 +1,354 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-memory stand-in for the IPAMClient operations used by calico_mesos, for
+benchmarking without etcd.
+
+Every operation counts as one round trip to the datastore and sleeps for the
+configured latency, outside the datastore lock, so that concurrent callers
+overlap as they would against etcd.
+"""
+import time
+import uuid
+import random
+import threading
+from collections import deque
+
+from netaddr import IPNetwork
+from etcd import EtcdAlreadyExist, EtcdKeyNotFound
+from pycalico.block import get_block_cidr_for_address, AlreadyAssignedError
+from pycalico.ipam import CASError
+from pycalico.datastore_datatypes import Endpoint
+
+
+class FakePool(object):
+    def __init__(self, cidr):
+        self.cidr = IPNetwork(cidr)
+
+    def __repr__(self):
+        return "FakePool(%s)" % self.cidr
+
+
+class FakeBlock(object):
+    """
+    Copy of an allocation block, as read by _read_block.
+    """
+    def __init__(self, cidr, allocations, version):
+        self.cidr = cidr
+        self.allocations = dict(allocations)
+        self.version = version
+
+    def assign(self, address, handle_id, attributes):
+        if address in self.allocations:
+            raise AlreadyAssignedError("%s is already assigned" % address)
+        self.allocations[address] = handle_id
+
+    def release(self, addresses):
+        unallocated = set()
+        handles = {}
+        for address in addresses:
+            if address not in self.allocations:
+                unallocated.add(address)
+                continue
+            handle_id = self.allocations.pop(address)
+            handles[handle_id] = handles.get(handle_id, 0) + 1
+        return unallocated, handles
+
+    def auto_assign(self, num, handle_id, attributes, affinity_check=True):
+        assigned = []
+        for address in self.cidr:
+            if len(assigned) == num:
+                break
+            if address not in self.allocations:
+                self.allocations[address] = handle_id
+                assigned.append(address)
+        return assigned
+
+
+class Latency(object):
+    """
+    Counts round trips and sleeps for each of them.
+    """
+    def __init__(self, latency, jitter=0):
+        self.latency = latency
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self.round_trips = {}
+        self.cas_conflicts = 0
+
+    def __call__(self, operation):
+        with self._lock:
+            self.round_trips[operation] = \
+                self.round_trips.get(operation, 0) + 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FakeEtcdClient(object):
+    """
+    Key/value store standing in for the etcd client, for the writes
+    calico_mesos makes directly.
+    """
+    def __init__(self, latency):
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def write(self, key, value, prevExist=None, **kwargs):
+        self._latency("etcd.write")
+        with self._lock:
+            if prevExist is False and key in self._values:
+                raise EtcdAlreadyExist()
+            self._values[key] = value
+
+    def read(self, key, **kwargs):
+        self._latency("etcd.read")
+        with self._lock:
+            try:
+                return self._values[key]
+            except KeyError:
+                raise EtcdKeyNotFound()
+
+
+class FakeIPAMClient(object):
+    """
+    In-memory IPAMClient.  Assignments are held per block, with a version
+    for compare-and-swap, so that the block-level paths of ipam_blocks and
+    the reservoir behave as they would against etcd.
+
+    :param pools: Dictionary of IP version to list of CIDR strings.
+    :param latency: Latency instance applied to every operation.
+    """
+    def __init__(self, pools, latency):
+        self._latency = latency
+        self.etcd_client = FakeEtcdClient(latency)
+        self._lock = threading.Lock()
+        self._pools = dict((version, [FakePool(cidr) for cidr in cidrs])
+                           for version, cidrs in pools.iteritems())
+        self._blocks = {}
+        self._handles = {}
+        self._endpoints = {}
+        # Addresses not yet handed out by auto_assign_ips, per version.
+        self._candidates = dict(
+            (version, self._iter_candidates(version)) for version in pools)
+        self._freed = dict((version, deque()) for version in pools)
+
+    # Endpoints.
+
+    def get_endpoints(self, hostname=None, orchestrator_id=None,
+                      workload_id=None, endpoint_id=None):
+        self._latency("get_endpoints")
+        with self._lock:
+            return [endpoint for endpoint in self._endpoints.values()
+                    if (hostname is None or endpoint.hostname == hostname) and
+                    (workload_id is None or
+                     endpoint.workload_id == workload_id)]
+
+    def get_endpoint(self, hostname=None, orchestrator_id=None,
+                     workload_id=None, endpoint_id=None):
+        endpoints = self.get_endpoints(hostname, orchestrator_id, workload_id)
+        if len(endpoints) != 1:
+            raise KeyError(workload_id)
+        return endpoints[0]
+
+    def create_endpoint(self, hostname, orchestrator_id, workload_id, ip_list,
+                        mac=None):
+        self._latency("create_endpoint")
+        endpoint = Endpoint(hostname, orchestrator_id, workload_id,
+                            uuid.uuid1().hex, "active", mac)
+        for ip in ip_list:
+            nets = endpoint.ipv4_nets if ip.version == 4 else \
+                endpoint.ipv6_nets
+            nets.add(IPNetwork(ip))
+        return endpoint
+
+    def set_endpoint(self, endpoint):
+        self._latency("set_endpoint")
+        with self._lock:
+            self._endpoints[endpoint.endpoint_id] = endpoint
+
+    def remove_endpoint(self, endpoint):
+        self._latency("remove_endpoint")
+        with self._lock:
+            if self._endpoints.pop(endpoint.endpoint_id, None) is None:
+                raise KeyError(endpoint.endpoint_id)
+
+    def remove_workload(self, hostname, orchestrator_id, workload_id):
+        self._latency("remove_workload")
+
+    # Pools and addresses.
+
+    def get_ip_pools(self, version):
+        self._latency("get_ip_pools")
+        return list(self._pools.get(version, []))
+
+    def assign_ip(self, address, handle_id, attributes, hostname=None):
+        self._latency("assign_ip")
+        if not any(address in pool.cidr
+                   for pool in self._pools.get(address.version, [])):
+            raise ValueError("%s is not in a pool" % address)
+        with self._lock:
+            block = self._block(get_block_cidr_for_address(address))
+            if address in block.allocations:
+                raise AlreadyAssignedError("%s is already assigned" % address)
+            self._assign(block, address, handle_id)
+
+    def auto_assign_ips(self, num_v4, num_v6, handle_id, attributes,
+                        pool=(None, None), hostname=None):
+        """
+        As IPAMClient.auto_assign_ips: assign from the host's blocks, each
+        with a compare-and-swap, then claim new blocks for the rest.
+        """
+        return (self._auto_assign_ips(4, num_v4, handle_id),
+                self._auto_assign_ips(6, num_v6, handle_id))
+
+    def unassign_address(self, pool, address):
+        self._latency("unassign_address")
+        with self._lock:
+            return self._release(address)
+
+    def release_ips(self, addresses):
+        self._latency("release_ips")
+        with self._lock:
+            return set(address for address in addresses
+                       if not self._release(address))
+
+    def release_ip_by_handle(self, handle_id):
+        self._latency("release_ip_by_handle")
+        with self._lock:
+            if handle_id not in self._handles:
+                raise KeyError(handle_id)
+            for address in list(self._handles[handle_id]):
+                self._release(address)
+
+    def get_ip_assignments_by_handle(self, handle_id):
+        self._latency("get_ip_assignments_by_handle")
+        with self._lock:
+            if handle_id not in self._handles:
+                raise KeyError(handle_id)
+            return sorted(self._handles[handle_id])
+
+    # Block and handle primitives used by ipam_blocks.
+
+    def _get_affine_blocks(self, host, version, pool):
+        self._latency("_get_affine_blocks")
+        with self._lock:
+            return sorted(cidr for cidr in self._blocks
+                          if cidr.version == version)
+
+    def _read_block(self, block_cidr):
+        self._latency("_read_block")
+        with self._lock:
+            if block_cidr not in self._blocks:
+                raise KeyError(block_cidr)
+            block = self._blocks[block_cidr]
+            return FakeBlock(block_cidr, block.allocations, block.version)
+
+    def _compare_and_swap_block(self, block):
+        self._latency("_compare_and_swap_block")
+        with self._lock:
+            current = self._blocks[block.cidr]
+            if current.version != block.version:
+                self._latency.cas_conflicts += 1
+                raise CASError(str(block.cidr))
+            for address, handle_id in current.allocations.items():
+                if block.allocations.get(address) != handle_id:
+                    self._release(address)
+            for address, handle_id in block.allocations.iteritems():
+                if address not in current.allocations:
+                    self._assign(current, address, handle_id)
+
+    def _increment_handle(self, handle_id, block_cidr, amount):
+        self._latency("_increment_handle")
+
+    def _decrement_handle(self, handle_id, block_cidr, amount):
+        self._latency("_decrement_handle")
+
+    def _auto_assign_ips(self, version, num, handle_id):
+        if not num:
+            return []
+        assigned = []
+        for block_cidr in self._get_affine_blocks(None, version, None):
+            assigned.extend(self._auto_assign_block(block_cidr,
+                                                    num - len(assigned),
+                                                    handle_id))
+            if len(assigned) == num:
+                return assigned
+        # Claiming a block takes several round trips in libcalico; count
+        # them as one.
+        self._latency("claim_block")
+        with self._lock:
+            assigned.extend(self._auto_assign(version, num - len(assigned),
+                                              handle_id))
+        return assigned
+
+    def _auto_assign_block(self, block_cidr, num, handle_id):
+        while True:
+            block = self._read_block(block_cidr)
+            addresses = block.auto_assign(num, handle_id, {})
+            if not addresses:
+                return []
+            self._increment_handle(handle_id, block_cidr, len(addresses))
+            try:
+                self._compare_and_swap_block(block)
+            except CASError:
+                self._decrement_handle(handle_id, block_cidr, len(addresses))
+                continue
+            return addresses
+
+    # Internals, called with the lock held.
+
+    def _block(self, block_cidr):
+        if block_cidr not in self._blocks:
+            self._blocks[block_cidr] = FakeBlock(block_cidr, {}, 0)
+        return self._blocks[block_cidr]
+
+    def _assign(self, block, address, handle_id):
+        block.allocations[address] = handle_id
+        block.version += 1
+        self._handles.setdefault(handle_id, set()).add(address)
+
+    def _release(self, address):
+        block = self._blocks.get(get_block_cidr_for_address(address))
+        if block is None or address not in block.allocations:
+            return False
+        handle_id = block.allocations.pop(address)
+        block.version += 1
+        self._handles[handle_id].discard(address)
+        if not self._handles[handle_id]:
+            del self._handles[handle_id]
+        self._freed[address.version].append(address)
+        return True
+
+    def _auto_assign(self, version, count, handle_id):
+        assigned = []
+        while len(assigned) < count:
+            freed = self._freed.get(version)
+            if freed:
+                address = freed.popleft()
+            else:
+                address = next(self._candidates[version], None)
+                if address is None:
+                    break
+            block = self._block(get_block_cidr_for_address(address))
+            if address not in block.allocations:
+                self._assign(block, address, handle_id)
+                assigned.append(address)
+        return assigned
+
+    def _iter_candidates(self, version):
+        for pool in self._pools[version]:
+            for address in pool.cidr.iter_hosts():
+                yield address
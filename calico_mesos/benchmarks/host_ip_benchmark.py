@@ -0,0 +1,70 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares the cost of reading the host's IPv4 addresses by scraping
+`ip -4 addr`, by a netlink dump, and through the netlink-invalidated cache.
+
+Usage: python benchmarks/host_ip_benchmark.py [--runs N]
+"""
+import os
+import re
+import sys
+import time
+import argparse
+from subprocess import check_output
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ifaddrs
+
+IP_SUBNET_RE = re.compile(r'inet ((?:\d+\.){3}\d+\/\d+)')
+INTERFACE_SPLIT_RE = re.compile(r'(\d+:.*(?:\n\s+.*)+)')
+IFACE_RE = re.compile(r'^\d+: (\S+):')
+
+
+def ip_addr_scrape():
+    """
+    The original implementation: fork `ip -4 addr` and parse its output.
+    """
+    addresses = []
+    output = check_output(["ip", "-4", "addr"])
+    for iface_block in INTERFACE_SPLIT_RE.findall(output):
+        match = IFACE_RE.match(iface_block)
+        if match:
+            addresses.extend((match.group(1), address)
+                             for address in IP_SUBNET_RE.findall(iface_block))
+    return addresses
+
+
+def time_per_call(func, runs):
+    start = time.time()
+    for _ in xrange(runs):
+        func()
+    return (time.time() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=1000)
+    options = parser.parse_args()
+
+    cache = ifaddrs.AddressCache()
+    for name, func in [("ip -4 addr", ip_addr_scrape),
+                       ("netlink dump", ifaddrs.get_ipv4_addresses),
+                       ("netlink cached", cache.get)]:
+        print "%-16s %10.1f us/call" % (name,
+                                        time_per_call(func, options.runs) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
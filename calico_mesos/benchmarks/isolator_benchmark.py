@@ -0,0 +1,204 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Isolator throughput benchmark against an in-memory datastore.
+
+Drives container life cycles through calico_mesos.handle_request, as the
+daemon does, with the IPAMClient replaced by benchmarks/fake_datastore.py and
+provision_veth replaced by a sleep.  Each cycle allocates an IPv4 address,
+isolates a container with it and cleans the container up, then reserves an
+IPv6 address and releases it, first by address and then by uid.
+
+Reports throughput, and per command the p50/p99 latency and datastore round
+trips.  Needs pycalico and mock installed, but no etcd or network.
+
+Usage: python benchmarks/isolator_benchmark.py [--cycles N] [--concurrency N]
+           [--latency MS] [--jitter MS] [--veth-latency MS]
+           [--coalesce-ms MS]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+HOSTNAME = "bench-host"
+IPV4_POOL = "10.0.0.0/16"
+IPV6_POOL = "fd00::/112"
+
+
+class _RecordCollector(logging.Handler):
+    """
+    Keeps the JSON records logged on CALICOMESOS.metrics.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_cycle(calico_mesos, index):
+    """
+    Run one container life cycle.
+    :return: Number of failed requests.
+    """
+    container_id = "bench-container-%d" % index
+    uid = "bench-uid-%d" % index
+    failures = 0
+
+    def request(command, args):
+        code, response = calico_mesos.handle_request(
+            json.dumps({"command": command, "args": args}))
+        return code, json.loads(response)
+
+    code, response = request("allocate", {"hostname": HOSTNAME, "uid": uid,
+                                          "num_ipv4": 1, "num_ipv6": 0})
+    if code or not response["ipv4"]:
+        return 1
+    reserved = ["fd00::%x" % (index % 0xfffe + 1)]
+    for command, args in [
+            ("isolate", {"hostname": HOSTNAME, "container_id": container_id,
+                         "pid": os.getpid(), "ipv4_addrs": response["ipv4"],
+                         "netgroups": ["bench"]}),
+            # Cleanup unassigns the container's addresses.
+            ("cleanup", {"hostname": HOSTNAME,
+                         "container_id": container_id}),
+            ("reserve", {"hostname": HOSTNAME, "uid": uid,
+                         "ipv6_addrs": reserved}),
+            ("release", {"ips": reserved}),
+            ("reserve", {"hostname": HOSTNAME, "uid": uid,
+                         "ipv6_addrs": reserved}),
+            ("release", {"uid": uid})]:
+        code, _ = request(command, args)
+        failures += code
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cycles", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="cycles in flight at once")
+    parser.add_argument("--latency", type=float, default=1.0,
+                        help="ms per datastore round trip")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="extra random ms per round trip, up to this")
+    parser.add_argument("--veth-latency", type=float, default=5.0,
+                        help="ms taken by provision_veth")
+    parser.add_argument("--coalesce-ms", type=float, default=0.0,
+                        help="allocate coalescing window, 0 for none")
+    options = parser.parse_args()
+
+    state_dir = tempfile.mkdtemp()
+    os.environ["CALICO_MESOS_STATE_DIR"] = state_dir
+    try:
+        _run(options)
+    finally:
+        shutil.rmtree(state_dir)
+
+
+def _run(options):
+    from mock import patch
+    from netaddr import IPNetwork
+    from pycalico.datastore_datatypes import Endpoint
+    import calico_mesos
+    from parallel import run_parallel
+    from coalescer import AllocationCoalescer
+    from fake_datastore import FakeIPAMClient, Latency
+
+    # As the daemon does, under the temporary state directory.
+    calico_mesos._open_request_state()
+    logging.getLogger("CALICOMESOS").addHandler(logging.NullHandler())
+    logging.getLogger("CALICOMESOS").propagate = False
+    collector = _RecordCollector()
+    metrics_log = logging.getLogger("CALICOMESOS.metrics")
+    metrics_log.setLevel(logging.INFO)
+    metrics_log.addHandler(collector)
+
+    latency = Latency(options.latency / 1000.0, options.jitter / 1000.0)
+    lazy_datastore = calico_mesos._LazyDatastore()
+    lazy_datastore._client = FakeIPAMClient({4: [IPV4_POOL], 6: [IPV6_POOL]},
+                                            latency)
+    coalescer = None
+    if options.coalesce_ms:
+        coalescer = AllocationCoalescer(lazy_datastore, HOSTNAME,
+                                        options.coalesce_ms / 1000.0)
+
+    def provision_veth(endpoint, namespace, veth_name_ns):
+        time.sleep(options.veth_latency / 1000.0)
+        return "ee:ee:ee:ee:ee:ee"
+
+    with patch.object(calico_mesos, "datastore", lazy_datastore), \
+            patch.object(calico_mesos, "HOSTNAME", HOSTNAME), \
+            patch.object(calico_mesos, "_allocation_coalescer", coalescer), \
+            patch.object(calico_mesos, "_get_host_ip_net",
+                         return_value=IPNetwork("10.99.0.1/24")), \
+            patch.object(Endpoint, "provision_veth", provision_veth,
+                         create=True):
+        start = time.time()
+        results = run_parallel(lambda index: run_cycle(calico_mesos, index),
+                               range(options.cycles), options.concurrency)
+        elapsed = time.time() - start
+
+    failures = sum(result or 0 for result, _ in results)
+    errors = [exc_info for _, exc_info in results if exc_info]
+    requests = len(collector.records)
+    print "%d cycles, %d requests in %.2fs: %.1f cycles/s, %.1f requests/s" % (
+        options.cycles, requests, elapsed, options.cycles / elapsed,
+        requests / elapsed)
+    print "%d failed requests, %d failed cycles" % (failures, len(errors))
+    print "datastore latency %.1f ms (+%.1f ms jitter), veth %.1f ms, " \
+          "concurrency %d" % (options.latency, options.jitter,
+                              options.veth_latency, options.concurrency)
+    if coalescer:
+        print "allocate coalescing %.1f ms: %s" % (options.coalesce_ms,
+                                                   coalescer.stats())
+    print
+    print "%-10s %8s %8s %10s %10s %14s" % ("command", "count", "errors",
+                                            "p50 ms", "p99 ms",
+                                            "round trips")
+    by_command = {}
+    for record in collector.records:
+        by_command.setdefault(record["command"], []).append(record)
+    for command in sorted(by_command):
+        records = by_command[command]
+        durations = sorted(record["duration"] * 1000 for record in records)
+        round_trips = sum(call["count"] for record in records
+                          for call in record["datastore"].values())
+        print "%-10s %8d %8d %10.2f %10.2f %14.2f" % (
+            command, len(records),
+            len([record for record in records if record["error"]]),
+            percentile(durations, 0.5),
+            percentile(durations, 0.99), float(round_trips) / len(records))
+    print
+    print "Round trips by operation (including direct etcd writes):"
+    for operation, count in sorted(latency.round_trips.items()):
+        print "  %-26s %8d" % (operation, count)
+
+
+if __name__ == '__main__':
+    main()
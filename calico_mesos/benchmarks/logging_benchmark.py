@@ -0,0 +1,114 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Logging latency benchmark.
+
+Logs the request and response lines of each request, with a payload of the
+given size and a sleep standing in for the rest of the request, through the
+same TimedRotatingFileHandler calico_mesos uses: once written synchronously,
+and once through the async_logging queue.
+Reports the p50/p99/max time the logging thread spends per request, and for
+the async mode how long the queue takes to drain at stop.
+
+Usage: python benchmarks/logging_benchmark.py [--requests N]
+           [--payload BYTES] [--work MS] [--limit BYTES]
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import logging.handlers
+import argparse
+import tempfile
+from Queue import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_logging import QueueHandler, QueueListener, Payload
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(logger, options):
+    """
+    :return: Sorted list of per-request logging latencies, in ms.
+    """
+    payload = '{"command": "isolate", "args": {"pad": "%s"}}' % (
+        "x" * options.payload)
+    latencies = []
+    for _ in range(options.requests):
+        start = time.time()
+        logger.info("Received request: %s",
+                    Payload(payload, options.limit, 1))
+        logger.info("Request completed with response: %s",
+                    Payload('{"error": null}', options.limit, 1))
+        latencies.append((time.time() - start) * 1000)
+        # The rest of the request, mostly waiting on etcd.
+        time.sleep(options.work / 1000.0)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--payload", type=int, default=2048,
+                        help="bytes of request data logged")
+    parser.add_argument("--work", type=float, default=1.0,
+                        help="ms spent on the rest of each request")
+    parser.add_argument("--limit", type=int, default=4096,
+                        help="payload truncation limit, 0 for none")
+    options = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    formatter = logging.Formatter(
+                '%(asctime)s [%(levelname)s] %(name)s %(lineno)d: %(message)s')
+    print "%-6s %10s %10s %10s %12s" % ("mode", "p50 ms", "p99 ms",
+                                        "max ms", "drain ms")
+    try:
+        for mode in ("sync", "async"):
+            handler = logging.handlers.TimedRotatingFileHandler(
+                os.path.join(tmpdir, "%s.log" % mode), when='D',
+                backupCount=10)
+            handler.setFormatter(formatter)
+            logger = logging.getLogger("CALICOMESOS.bench.%s" % mode)
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG)
+            listener = None
+            if mode == "sync":
+                logger.addHandler(handler)
+            else:
+                queue_handler = QueueHandler(Queue(options.requests * 2))
+                logger.addHandler(queue_handler)
+                listener = QueueListener(queue_handler.queue, handler)
+                listener.start()
+
+            latencies = run(logger, options)
+            drain = 0
+            if listener:
+                start = time.time()
+                listener.stop()
+                drain = (time.time() - start) * 1000
+            handler.close()
+            print "%-6s %10.4f %10.4f %10.4f %12.1f" % (
+                mode, percentile(latencies, 0.5), percentile(latencies, 0.99),
+                latencies[-1], drain)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Cold-start benchmark for calico_mesos.py.
+
+Runs each sample request in a fresh interpreter, the same way net-modules
+runs the isolator, and reports the wall-clock time per command along with
+whether the run loaded pycalico.  Requests which need the datastore will fail
+quickly if no etcd is reachable; that still measures start-up cost.
+
+Usage: python benchmarks/startup_benchmark.py [--runs N] [--binary PATH]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(SRC_DIR, "calico_mesos.py")
+
+# Runs the script named in argv[1] as __main__ and reports which modules it
+# loaded.
+WRAPPER = """
+import sys, atexit, runpy
+def report():
+    sys.stderr.write("\\nMODULES %d %s\\n" % (
+        len(sys.modules),
+        any(m.startswith("pycalico") for m in sys.modules)))
+atexit.register(report)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+SAMPLE_REQUESTS = [
+    ("invalid-json", '{"command": '),
+    ("isolate-invalid", {"command": "isolate",
+                         "args": {"hostname": "bench"}}),
+    ("isolate", {"command": "isolate",
+                 "args": {"hostname": "bench",
+                          "container_id": "bench-container",
+                          "pid": 1,
+                          "ipv4_addrs": ["192.168.0.1"],
+                          "netgroups": ["bench"]}}),
+    ("cleanup", {"command": "cleanup",
+                 "args": {"hostname": "bench",
+                          "container_id": "bench-container"}}),
+    ("allocate", {"command": "allocate",
+                  "args": {"hostname": "bench", "uid": "bench-uid",
+                           "num_ipv4": 1, "num_ipv6": 0}}),
+    ("reserve", {"command": "reserve",
+                 "args": {"hostname": "bench", "uid": "bench-uid",
+                          "ipv4_addrs": ["192.168.0.1"]}}),
+    ("release-uid", {"command": "release",
+                     "args": {"uid": "bench-uid"}}),
+    ("release-ips", {"command": "release",
+                     "args": {"ips": ["192.168.0.1"]}}),
+]
+
+
+def run_once(command, raw_request, env):
+    start = time.time()
+    process = subprocess.Popen(command,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               env=env)
+    _, stderr = process.communicate(raw_request)
+    elapsed = time.time() - start
+    modules, pycalico = None, None
+    for line in stderr.splitlines():
+        if line.startswith("MODULES "):
+            _, modules, pycalico = line.split()
+            modules, pycalico = int(modules), pycalico == "True"
+    return elapsed, modules, pycalico
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--binary",
+                        help="Benchmark a built calico_mesos binary instead "
+                             "of the source under the current interpreter.")
+    options = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = SRC_DIR
+    env.setdefault("CALICO_MESOS_LOGFILE",
+                   os.path.join(tempfile.mkdtemp(), "isolator.log"))
+    if options.binary:
+        command = [options.binary]
+    else:
+        command = [sys.executable, "-c", WRAPPER, SCRIPT]
+
+    print "%-16s %10s %10s %10s %8s %9s" % ("command", "min ms", "median ms",
+                                           "max ms", "modules", "pycalico")
+    for name, request in SAMPLE_REQUESTS:
+        raw_request = (request if isinstance(request, basestring)
+                       else json.dumps(request))
+        results = [run_once(command, raw_request, env)
+                   for _ in range(options.runs)]
+        times = sorted(r[0] * 1000 for r in results)
+        _, modules, pycalico = results[-1]
+        print "%-16s %10.1f %10.1f %10.1f %8s %9s" % (
+            name, times[0], times[len(times) / 2], times[-1],
+            "-" if modules is None else modules,
+            "-" if pycalico is None else pycalico)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Veth provisioning latency for a burst of container launches, with and
+without the veth pool.
+
+Starts --burst processes in their own network namespaces, then provisions a
+veth into each of them concurrently, as isolate does.  With the pool, the
+pairs are created beforehand, as the daemon's background refill would.
+Must be run as root, with pycalico installed.  No datastore is needed.
+
+Usage: python benchmarks/veth_pool_benchmark.py [--burst N] [--workers N]
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from netaddr import IPNetwork
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pycalico import netns
+from pycalico.datastore_datatypes import Endpoint
+from parallel import run_parallel, check_results
+from veth_pool import VethPool, provision_pooled_veth
+
+
+def start_namespaces(count):
+    return [subprocess.Popen(["unshare", "-n", "sleep", "600"])
+            for _ in xrange(count)]
+
+
+def make_endpoints(count):
+    endpoints = []
+    for index in xrange(count):
+        endpoint = Endpoint("host", "mesos", "bench-%d" % index,
+                            "%011x%021x" % (0xbe0c0000 + index, 0), "active", None)
+        endpoint.ipv4_nets.add(IPNetwork("10.99.%d.%d/32" %
+                                         (index // 250, index % 250 + 1)))
+        endpoints.append(endpoint)
+    return endpoints
+
+
+def run_burst(endpoints, processes, workers, pool):
+    """
+    :return: Tuple of (total seconds, sorted per-launch seconds).
+    """
+    def launch(index):
+        start = time.time()
+        namespace = netns.PidNamespace(processes[index].pid)
+        pair = pool and pool.take()
+        if pair:
+            provision_pooled_veth(endpoints[index], namespace, "eth0", pair)
+        else:
+            endpoints[index].provision_veth(namespace, "eth0")
+        return time.time() - start
+
+    start = time.time()
+    latencies = check_results(run_parallel(launch, range(len(endpoints)),
+                                           workers))
+    return time.time() - start, sorted(latencies)
+
+
+def report(name, total, latencies):
+    print "%-10s total %7.1f ms  p50 %7.1f ms  p99 %7.1f ms  max %7.1f ms" % (
+        name, total * 1e3, latencies[len(latencies) // 2] * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3, latencies[-1] * 1e3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--burst", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=8)
+    options = parser.parse_args()
+
+    for name, pool_size in [("no pool", 0), ("pool", options.burst)]:
+        processes = start_namespaces(options.burst)
+        endpoints = make_endpoints(options.burst)
+        pool = None
+        try:
+            if pool_size:
+                pool = VethPool(pool_size)
+                pool.refill()
+            report(name, *run_burst(endpoints, processes, options.workers,
+                                    pool))
+        finally:
+            if pool:
+                pool.stop()
+            for endpoint in endpoints:
+                subprocess.call(["ip", "link", "del", endpoint.name],
+                                stderr=open(os.devnull, "w"))
+            for process in processes:
+                process.kill()
+                process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,25 +11,130 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+# pycalico and netaddr are imported by the functions that use them, rather
+# than here, so that a request only pays for the imports it needs.
 import sys
 import os
+import atexit
 import errno
-from pycalico import netns
-from pycalico.ipam import IPAMClient
-from pycalico.datastore import Rules, Rule
-from pycalico.block import AlreadyAssignedError
-from netaddr import IPAddress, AddrFormatError
 import json
 import logging
 import logging.handlers
 import traceback
-import re
-from subprocess import check_output, CalledProcessError
-from netaddr import IPNetwork
 import socket
-
-LOGFILE = "/var/log/calico/isolator.log"
+import threading
+from contextlib import contextmanager
+from subprocess import CalledProcessError
+from Queue import Queue
+from parallel import run_parallel, check_results, OnceCache, TaskGraph
+from ifaddrs import AddressCache
+from profile_cache import ProfileCache
+from endpoint_index import EndpointIndex, endpoint_record, \
+    endpoint_from_record
+from pool_index import PoolIndex
+from metrics import RequestMetrics, Histograms, PeriodicSaver, TimedProxy
+from async_logging import QueueHandler, QueueListener, Payload
+from keyed_locks import KeyedLocks, LockTimeout
+from response_cache import ResponseCache, request_hash
+from handle_records import HandleRecords
+import statefile
+
+LOGFILE = os.environ.get("CALICO_MESOS_LOGFILE",
+                         "/var/log/calico/isolator.log")
+SOCKET_PATH = os.environ.get("CALICO_MESOS_SOCKET",
+                             "/var/run/calico/isolator.sock")
+LOG_LEVEL = os.environ.get("CALICO_MESOS_LOG_LEVEL", "DEBUG").upper()
+# Write the log file from a background thread, rather than in each request.
+LOG_ASYNC = os.environ.get("CALICO_MESOS_LOG_ASYNC", "").lower() in \
+    ("1", "true", "yes")
+LOG_QUEUE_SIZE = int(os.environ.get("CALICO_MESOS_LOG_QUEUE_SIZE", "10000"))
+# Request and response payloads are cut to this many characters in the log
+# (0 for no limit), and only this fraction of them are logged at all.
+LOG_PAYLOAD_LIMIT = int(os.environ.get("CALICO_MESOS_LOG_PAYLOAD_LIMIT",
+                                       "4096"))
+LOG_PAYLOAD_SAMPLE = float(os.environ.get("CALICO_MESOS_LOG_PAYLOAD_SAMPLE",
+                                          "1"))
 ORCHESTRATOR_ID = "mesos"
+BATCH_WORKERS = int(os.environ.get("CALICO_MESOS_BATCH_WORKERS", "8"))
+# Containers cleanup_all tears down at once.
+DRAIN_WORKERS = int(os.environ.get("CALICO_MESOS_DRAIN_WORKERS", "8"))
+RESERVE_WORKERS = int(os.environ.get("CALICO_MESOS_RESERVE_WORKERS", "8"))
+# Most addresses one reserve or release may cover, counting every address of
+# its CIDRs and ranges.
+MAX_RANGE_ADDRESSES = int(os.environ.get("CALICO_MESOS_MAX_RANGE_ADDRESSES",
+                                         "65536"))
+# Seconds a request waits for another on the same container, uid or profile.
+LOCK_TIMEOUT = float(os.environ.get("CALICO_MESOS_LOCK_TIMEOUT", "30"))
+EXCLUDED_INTERFACES = os.environ.get("CALICO_MESOS_EXCLUDED_INTERFACES",
+                                     "docker0,lo").split(",")
+PROFILE_CACHE_TTL = float(os.environ.get("CALICO_MESOS_PROFILE_CACHE_TTL",
+                                         "300"))
+PROFILE_CACHE_SIZE = int(os.environ.get("CALICO_MESOS_PROFILE_CACHE_SIZE",
+                                        "1024"))
+PROFILE_CACHE_FILE = os.path.join(statefile.STATE_DIR, "profiles.json")
+ENDPOINT_INDEX_DIR = os.path.join(statefile.STATE_DIR, "endpoints")
+# File for node_exporter's textfile collector.  Unset disables the histograms.
+PROMETHEUS_FILE = os.environ.get("CALICO_MESOS_PROMETHEUS_FILE")
+METRICS_STATE_FILE = os.path.join(statefile.STATE_DIR, "metrics.json")
+METRICS_SAVE_INTERVAL = float(
+    os.environ.get("CALICO_MESOS_METRICS_SAVE_INTERVAL", "15"))
+ETCD_POOL_SIZE = int(os.environ.get("CALICO_MESOS_ETCD_POOL_SIZE", "16"))
+ETCD_IDLE_TIMEOUT = float(os.environ.get("CALICO_MESOS_ETCD_IDLE_TIMEOUT",
+                                         "60"))
+ETCD_HEALTH_INTERVAL = float(
+    os.environ.get("CALICO_MESOS_ETCD_HEALTH_INTERVAL", "30"))
+# Low and high watermarks of the daemon's reservoir of pre-assigned
+# addresses, per IP version.  A high watermark of 0 disables the reservoir.
+RESERVOIR_WATERMARKS = dict(
+    (version, (int(os.environ.get("CALICO_MESOS_RESERVOIR_IPV%d_LOW" % version,
+                                  "0")),
+               int(os.environ.get("CALICO_MESOS_RESERVOIR_IPV%d_HIGH" % version,
+                                  "0"))))
+    for version in (4, 6))
+# Number of veth pairs the daemon creates ahead of time.  0 disables the pool.
+VETH_POOL_SIZE = int(os.environ.get("CALICO_MESOS_VETH_POOL_SIZE", "0"))
+# Milliseconds the daemon waits to merge concurrent allocations into one
+# assignment per block.  0 to assign each allocation separately.
+ALLOCATE_COALESCE_WINDOW = float(
+    os.environ.get("CALICO_MESOS_ALLOCATE_COALESCE_MS", "0")) / 1000
+# The Mesos agent, from which reconcile lists the running containers.
+AGENT_URL = os.environ.get("CALICO_MESOS_AGENT_URL")
+RECONCILE_INTERVAL = float(os.environ.get("CALICO_MESOS_RECONCILE_INTERVAL",
+                                          "60"))
+RECONCILE_GRACE = float(os.environ.get("CALICO_MESOS_RECONCILE_GRACE", "300"))
+RECONCILE_BATCH_SIZE = int(os.environ.get("CALICO_MESOS_RECONCILE_BATCH_SIZE",
+                                          "50"))
+RECONCILE_STATE_FILE = os.path.join(statefile.STATE_DIR, "reconcile.json")
+# Seconds after an allocate or reserve before reconcile may release the uid's
+# unused addresses.  Must be longer than any gap between allocate and isolate.
+RECONCILE_HANDLE_AGE = float(
+    os.environ.get("CALICO_MESOS_RECONCILE_HANDLE_AGE", "86400"))
+# Have the daemon's cleanup only remove the veth, and queue the datastore
+# work for a background worker.
+DEFERRED_CLEANUP = os.environ.get("CALICO_MESOS_DEFERRED_CLEANUP",
+                                  "").lower() in ("1", "true", "yes")
+CLEANUP_JOURNAL = os.path.join(statefile.STATE_DIR, "cleanup.journal")
+CLEANUP_BATCH_SIZE = int(os.environ.get("CALICO_MESOS_CLEANUP_BATCH_SIZE",
+                                        "20"))
+# Have the daemon mirror this host's endpoints, the profiles and the IP pools
+# in memory, kept up to date by etcd watches.
+DATASTORE_MIRROR = os.environ.get("CALICO_MESOS_DATASTORE_MIRROR",
+                                  "").lower() in ("1", "true", "yes")
+# Return the original response to a retried request, rather than running it
+# again.  Off by default (a TTL of 0), since it adds file I/O to every
+# request.
+RESPONSE_CACHE_TTL = float(os.environ.get("CALICO_MESOS_RESPONSE_CACHE_TTL",
+                                          "0"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("CALICO_MESOS_RESPONSE_CACHE_SIZE",
+                                         "4096"))
+RESPONSE_CACHE_DIR = os.path.join(statefile.STATE_DIR, "responses")
+HANDLE_RECORDS_DIR = os.path.join(statefile.STATE_DIR, "handles")
+# Commands whose responses are cached, by the container or uid they are for.
+CACHED_COMMANDS = frozenset(["isolate", "cleanup", "allocate", "reserve",
+                             "release"])
+# Commands whose cached responses list addresses, which a release by address
+# makes stale.
+ADDRESS_COMMANDS = frozenset(["allocate", "reserve"])
 
 ERROR_MISSING_COMMAND      = "Missing command"
 ERROR_MISSING_CONTAINER_ID = "Missing container_id"
@@ -37,20 +142,127 @@ ERROR_MISSING_HOSTNAME     = "Missing hostname"
 ERROR_MISSING_PID          = "Missing pid"
 ERROR_UNKNOWN_COMMAND      = "Unknown command: %s"
 ERROR_MISSING_ARGS = "Missing args"
+ERROR_ALREADY_CONFIGURED = ("This container has already been configured "
+                            "with Calico Networking.")
+
 
-datastore = IPAMClient()
+class _LazyDatastore(object):
+    """
+    Stands in for the IPAMClient, which is only constructed (and pycalico
+    only imported) on first access to the datastore.
+
+    The client's etcd connections are pooled and kept alive, so that they are
+    reused by every request the process handles.
+    """
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+        self.pool = None
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from pycalico.ipam import IPAMClient
+                    # Imports urllib3, so only when the datastore is used.
+                    import etcd_pool
+                    client = IPAMClient()
+                    self.pool = etcd_pool.install(client.etcd_client,
+                                                  ETCD_POOL_SIZE,
+                                                  ETCD_IDLE_TIMEOUT)
+                    self._client = client
+        return self._client
+
+    def __getattr__(self, name):
+        attr = getattr(self.get_client(), name)
+        # Time calls on behalf of the request in progress, which is looked up
+        # now rather than when the call is made, since the call may be made
+        # on another thread.
+        metrics = getattr(_request_context, "metrics", None)
+        if metrics and name == "etcd_client":
+            # Reads and writes made on the etcd client directly, rather than
+            # through an IPAMClient method.
+            return TimedProxy(attr, metrics, "etcd_client.")
+        if metrics and callable(attr):
+            return metrics.timed(name, attr)
+        return attr
+
+    def __dir__(self):
+        # Lets mock's autospec see the IPAMClient methods.
+        return dir(self.get_client())
+
+
+datastore = _LazyDatastore()
 _log = logging.getLogger("CALICOMESOS")
+# One JSON record of timings per request.
+_metrics_log = logging.getLogger("CALICOMESOS.metrics")
 
 HOSTNAME = socket.gethostname()
 
+# The host's interface addresses, refreshed when the kernel reports a change.
+_host_addresses = AddressCache()
+
+# Profiles known to exist.  In memory only when running as a daemon; the
+# one-shot CLI shares it through PROFILE_CACHE_FILE.
+_profile_cache = ProfileCache(PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE)
+
+# The endpoints this host has created, so that isolate and cleanup need not
+# look them up in the datastore.
+_endpoint_index = EndpointIndex(ENDPOINT_INDEX_DIR)
+
+# Per-thread state of the request being handled.
+_request_context = threading.local()
+
+# Serializes concurrent requests for the same container, uid or profile.
+_locks = KeyedLocks(LOCK_TIMEOUT)
+
+# Responses of successful requests, for retries.  Set when running as the CLI
+# or the daemon.
+_response_cache = None
+
+# The handles this host has assigned addresses to, which reconcile may
+# release.  Set when running as the CLI or the daemon.
+_handle_records = None
+
+# Histograms of request timings, for PROMETHEUS_FILE.
+_histograms = Histograms()
+
+# Pre-assigned addresses for allocate.  Only used by the daemon, when
+# configured.
+_ip_reservoir = None
+
+# Pre-created veth pairs for isolate.  Only used by the daemon, when
+# configured.
+_veth_pool = None
+
+# Worker completing deferred cleanups.  Only used by the daemon, when
+# configured.
+_cleanup_worker = None
+
+# Merges concurrent allocations.  Only used by the daemon, when configured.
+_allocation_coalescer = None
+
+# Watch-fed copy of the datastore state requests read.  Only used by the
+# daemon, when configured.
+_datastore_mirror = None
+
+
 def calico_mesos():
     """
     Module function which parses JSON from stdin and calls the appropriate
     plugin function.
     :return:
     """
-    stdin_raw_data = sys.stdin.read()
-    _log.info("Received request: %s" % stdin_raw_data)
+    return process_request(sys.stdin.read())
+
+
+def process_request(stdin_raw_data):
+    """
+    Parse a raw JSON request and call the appropriate plugin function.
+    :param stdin_raw_data: The request, as read from stdin by the caller.
+    :return: The response of the plugin function.
+    """
+    _log.info("Received request: %s", _payload(stdin_raw_data))
 
     # Convert input data to JSON object
     try:
@@ -58,6 +270,19 @@ def calico_mesos():
     except ValueError as e:
         raise IsolatorException(str(e))
 
+    with _lookup_scope(OnceCache()):
+        if isinstance(stdin_json, list):
+            return _batch(stdin_json)
+        return _dispatch(stdin_json)
+
+
+def _dispatch(stdin_json):
+    """
+    Call the plugin function for a single parsed request.
+    """
+    if not isinstance(stdin_json, dict):
+        raise IsolatorException(ERROR_MISSING_COMMAND)
+
     # Extract command
     try:
         command = stdin_json['command']
@@ -72,6 +297,104 @@ def calico_mesos():
 
     # Call command with args
     _log.debug("Executing %s" % command)
+    with _request_metrics(command, args):
+        keys = _request_keys(args)
+        with _locked(keys):
+            return _cached_response(command, args, keys)
+
+
+def _request_keys(args):
+    """
+    :return: List of the lock keys of the container_id and uid a request is
+    for, if any.
+    """
+    keys = []
+    if isinstance(args, dict):
+        for kind, field in (("container", "container_id"), ("uid", "uid")):
+            value = args.get(field)
+            if isinstance(value, (basestring, int, long)):
+                keys.append((kind, unicode(value)))
+    return keys
+
+
+@contextmanager
+def _locked(keys):
+    """
+    Hold the locks of the given (kind, name) keys.  Any time spent waiting
+    for another request to release them counts as the lock_wait phase of the
+    request, and is the value of the with statement.
+
+    Requests hold the keys of their container and uid, and take profile keys
+    while holding them, so nothing may take a container or uid key while
+    holding a profile key.
+    """
+    if not keys:
+        yield 0.0
+        return
+    metrics = getattr(_request_context, "metrics", None)
+    try:
+        waited = _locks.acquire(keys)
+    except LockTimeout as e:
+        if metrics:
+            metrics.add_phase("lock_wait", _locks.timeout)
+        raise IsolatorException(str(e))
+    if waited and metrics:
+        metrics.add_phase("lock_wait", waited)
+    try:
+        yield waited
+    finally:
+        _locks.release(keys)
+
+
+def _cached_response(command, args, keys):
+    """
+    Run a command, unless it repeats the latest successful request for the
+    same container or uid, in which case return that request's response.
+    Called holding the locks of the keys, so a retry made while the original
+    is still running waits for its response.
+    """
+    if not (_response_cache and keys and command in CACHED_COMMANDS):
+        return _run_command(command, args)
+    key = _response_key(keys)
+    digest = request_hash(command, args)
+    with _span("response_cache"):
+        found, response = _response_cache.get(key, command, digest)
+    if found:
+        _log.info("Returning the response of the same %s request made "
+                  "earlier for %s", command, key)
+        return response
+    generation = None
+    if command in ADDRESS_COMMANDS:
+        generation = _response_cache.generation()
+    response = _run_command(command, args)
+    try:
+        _response_cache.put(key, command, digest, response, generation)
+    except (IOError, OSError) as e:
+        _log.warning("Could not cache response for %s: %s", key, e)
+    return response
+
+
+def _response_key(keys):
+    """
+    :return: The response cache key of the given (kind, name) lock keys.
+    """
+    return ",".join("%s=%s" % key for key in keys)
+
+
+def _forget_response(container_id):
+    """
+    Drop the cached response for a container removed other than by a cleanup
+    request, so that retrying its isolate request does not report success.
+    """
+    if not _response_cache:
+        return
+    try:
+        _response_cache.forget(_response_key([("container", container_id)]))
+    except (IOError, OSError) as e:
+        _log.warning("Could not forget response for %s: %s", container_id, e)
+
+
+def _run_command(command, args):
     if command == 'isolate':
         return isolate(args)
     elif command == 'cleanup':
@@ -82,117 +405,412 @@ def calico_mesos():
         return reserve(args)
     elif command == 'release':
         return release(args)
+    elif command == 'stats':
+        return stats(args)
+    elif command == 'reconcile':
+        return reconcile(args)
+    elif command == 'cleanup_queue':
+        return cleanup_queue(args)
+    elif command == 'cleanup_all':
+        return cleanup_all(args)
     else:
         raise IsolatorException(ERROR_UNKNOWN_COMMAND % command)
 
 
+@contextmanager
+def _request_metrics(command, args):
+    """
+    Time the enclosed request, and its phases and datastore calls, then log
+    the timings as one JSON record and add them to the histograms.
+    """
+    fields = {}
+    if isinstance(args, dict):
+        for field in ("container_id", "uid"):
+            if args.get(field) is not None:
+                fields[field] = args[field]
+    metrics = RequestMetrics(command, **fields)
+    previous = getattr(_request_context, "metrics", None)
+    _request_context.metrics = metrics
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        _request_context.metrics = previous
+        record = metrics.finish(error)
+        _metrics_log.info(json.dumps(record))
+        if PROMETHEUS_FILE:
+            _histograms.observe_request(record, metrics.calls())
+
+
+def _span(phase):
+    """
+    :return: Context manager timing the enclosed block as a phase of the
+    request in progress, if any.
+    """
+    metrics = getattr(_request_context, "metrics", None)
+    if metrics:
+        return metrics.span(phase)
+    return _no_span()
+
+
+@contextmanager
+def _no_span():
+    yield
+
+
+def _batch(requests):
+    """
+    Execute a list of requests in one invocation.
+
+    Requests for the same container_id or uid run in the order given, and
+    everything else runs concurrently.  Lookups made through _shared_lookup
+    are shared by all requests in the batch.
+
+    :param requests: List of {"command": ..., "args": ...} objects.
+    :return: JSON list with one response object per request, in order.  A
+    failed request has its message in "error" and does not affect the rest.
+    """
+    _log.debug("Executing batch of %d requests", len(requests))
+    lookups = OnceCache()
+
+    # Group requests which must not be reordered.
+    groups = []
+    groups_by_key = {}
+    for index, request in enumerate(requests):
+        args = request.get("args") if isinstance(request, dict) else None
+        key = None
+        if isinstance(args, dict):
+            key = args.get("container_id") or args.get("uid")
+        if not isinstance(key, basestring):
+            # Not a valid ID, so the request fails validation on its own.
+            key = None
+        if key is None:
+            groups.append([index])
+        elif key in groups_by_key:
+            groups_by_key[key].append(index)
+        else:
+            groups_by_key[key] = [index]
+            groups.append(groups_by_key[key])
+
+    results = [None] * len(requests)
+
+    def run_group(indexes):
+        with _lookup_scope(lookups):
+            for index in indexes:
+                results[index] = _batch_item_result(requests[index])
+
+    check_results(run_parallel(run_group, groups, BATCH_WORKERS))
+    return json.dumps(results)
+
+
+def _batch_item_result(request):
+    """
+    Run one request of a batch, converting its outcome to a response object.
+    """
+    try:
+        response = _dispatch(request)
+    except IsolatorException as e:
+        _log.error(e)
+        return {"error": str(e)}
+    except Exception as e:
+        _log.exception(e)
+        return {"error": "Unhandled error %s\n%s" %
+                         (str(e), traceback.format_exc())}
+    if response is None:
+        return {"error": None}
+    return json.loads(response)
+
+
+@contextmanager
+def _lookup_scope(lookups):
+    """
+    Share the OnceCache lookups between all _shared_lookup calls made by
+    this thread for the duration of the block.
+    """
+    previous = getattr(_request_context, "lookups", None)
+    _request_context.lookups = lookups
+    try:
+        yield
+    finally:
+        _request_context.lookups = previous
+
+
+def _in_request(func):
+    """
+    :return: func, wrapped to run in the calling thread's request context
+    (its metrics and shared lookups) from whichever thread calls it.
+    """
+    context = (getattr(_request_context, "metrics", None),
+               getattr(_request_context, "lookups", None))
+
+    def call(*args):
+        previous = (getattr(_request_context, "metrics", None),
+                    getattr(_request_context, "lookups", None))
+        _request_context.metrics, _request_context.lookups = context
+        try:
+            return func(*args)
+        finally:
+            _request_context.metrics, _request_context.lookups = previous
+    return call
+
+
+def _shared_lookup(key, func, *args):
+    """
+    Return func(*args).  The result is computed once per request, and shared
+    by every request of a batch.
+    """
+    lookups = getattr(_request_context, "lookups", None)
+    if lookups is None:
+        return func(*args)
+    return lookups.get(key, func, *args)
+
+
 def _setup_logging(logfile):
     # Ensure directory exists.
     try:
-        os.makedirs(os.path.dirname(LOGFILE))
+        os.makedirs(os.path.dirname(logfile))
     except OSError as oserr:
         if oserr.errno != errno.EEXIST:
             raise
 
-    _log.setLevel(logging.DEBUG)
+    level = getattr(logging, LOG_LEVEL, logging.DEBUG)
+    _log.setLevel(level)
     formatter = logging.Formatter(
                 '%(asctime)s [%(levelname)s] %(name)s %(lineno)d: %(message)s')
     handler = logging.handlers.TimedRotatingFileHandler(logfile,
                                                         when='D',
                                                         backupCount=10)
-    handler.setLevel(logging.DEBUG)
+    handler.setLevel(level)
     handler.setFormatter(formatter)
-    _log.addHandler(handler)
+    if not LOG_ASYNC:
+        _log.addHandler(handler)
+        return
+
+    # Requests only queue their records; a listener thread formats them and
+    # does the file I/O and rotation.  The queue is drained at exit, which
+    # runs before logging's own shutdown closes the file handler.
+    queue_handler = QueueHandler(Queue(LOG_QUEUE_SIZE))
+    queue_handler.setLevel(level)
+    _log.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, handler)
+    listener.start()
+
+    def stop_listener():
+        listener.stop()
+        if queue_handler.dropped:
+            handler.handle(logging.makeLogRecord({
+                "name": _log.name, "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "Dropped %d log records while the log queue was full" %
+                       queue_handler.dropped}))
+    atexit.register(stop_listener)
+
+
+def _payload(data):
+    """
+    :return: data, wrapped to be truncated or sampled if it is logged.
+    """
+    return Payload(data, LOG_PAYLOAD_LIMIT, LOG_PAYLOAD_SAMPLE)
 
 
-def _validate_ip_addrs(ip_addrs, ip_version=None):
-    if type(ip_addrs) != list:
-        raise IsolatorException("IP addresses must be provided as JSON list, not: %s" % type(ip_addrs))
-    validated_ip_addrs = []
-    for ip_addr in ip_addrs:
-        try:
-            ip = IPAddress(ip_addr)
-        except AddrFormatError:
-            raise IsolatorException("IP address could not be parsed: %s" % ip_addr)
+def _parse_ip_fields(fields, allow_ranges):
+    """
+    Parse each field's list of addresses, reporting every invalid entry of
+    every field in a single IsolatorException.
+    :param fields: List of (list of entries, IP version required or None).
+    :return: List of parsed (IP version, first, last) lists, one per field.
+    """
+    import ip_ranges
+    parsed_fields = []
+    errors = []
+    for ip_addrs, ip_version in fields:
+        if type(ip_addrs) != list:
+            raise IsolatorException("IP addresses must be provided as JSON list, not: %s" % type(ip_addrs))
+        parsed, field_errors = ip_ranges.parse(ip_addrs, ip_version,
+                                               allow_ranges)
+        parsed_fields.append(parsed)
+        errors.extend(error for error in field_errors if error not in errors)
+    if errors:
+        raise IsolatorException("; ".join(errors))
+    return parsed_fields
+
+
+def _validate_ip_addrs(*fields):
+    """
+    :param fields: (list of addresses, IP version required or None) for
+    each field to validate.
+    :return: List of IPAddresses for each field, in the order given.
+    """
+    from netaddr import IPAddress
+    return [[IPAddress(first, version) for version, first, _ in parsed]
+            for parsed in _parse_ip_fields(fields, allow_ranges=False)]
 
-        if ip_version and ip.version != ip_version:
-            raise IsolatorException("IPv%d address must not be placed in IPv%d address field." % \
-                                        (ip.version, ip_version))
-        else:
-            validated_ip_addrs.append(ip)
-    return validated_ip_addrs
 
-def _create_profile_for_host_communication(profile_name):
+def _validate_ip_ranges(*fields):
     """
-    Create a profile which allows traffic to and from the host.
+    As _validate_ip_addrs, but entries may also be CIDRs ("10.0.0.0/24") or
+    ranges ("10.0.0.10-10.0.0.20").
+    :return: AddressRanges for each field, without duplicates.
     """
-    _log.info("Autocreating profile %s", profile_name)
-    datastore.create_profile(profile_name)
-    prof = datastore.get_profile(profile_name)
+    from ip_ranges import AddressRanges
+    validated = [AddressRanges(parsed)
+                 for parsed in _parse_ip_fields(fields, allow_ranges=True)]
+    count = sum(addresses.size() for addresses in validated)
+    if count > MAX_RANGE_ADDRESSES:
+        raise IsolatorException("Too many IP addresses: %d, the limit is %d."
+                                % (count, MAX_RANGE_ADDRESSES))
+    return validated
 
-    host_net = str(_get_host_ip_net())
+
+def _host_communication_rules(profile_name):
+    """
+    Rules for a profile which allows traffic to and from the host.
+    """
+    from pycalico.datastore import Rules, Rule
+    host_net = str(_shared_lookup("host_ip_net", _get_host_ip_net))
     _log.info("adding accept rule for %s" % host_net)
     allow_from_slave = Rule(action="allow", src_net=host_net)
     allow_to_slave = Rule(action="allow", dst_net=host_net)
-    prof.rules = Rules(id=profile_name,
-                       inbound_rules=[allow_from_slave],
-                       outbound_rules=[allow_to_slave])
-    datastore.profile_update_rules(prof)
+    return Rules(id=profile_name,
+                 inbound_rules=[allow_from_slave],
+                 outbound_rules=[allow_to_slave])
 
-def _create_profile_for_netgroup(profile_name):
+def _netgroup_rules(profile_name):
     """
-    Create a profile which allows traffic from other Endpoints in the same
+    Rules for a profile which allows traffic from other Endpoints in the same
     profile.
     """
-    _log.info("Autocreating profile %s", profile_name)
-    datastore.create_profile(profile_name)
-    prof = datastore.get_profile(profile_name)
+    from pycalico.datastore import Rules, Rule
     allow_from_profile = Rule(action="allow", src_tag=profile_name)
     allow_to_all = Rule(action="allow")
-    prof.rules = Rules(id=profile_name,
-                       inbound_rules=[allow_from_profile],
-                       outbound_rules=[allow_to_all])
-    datastore.profile_update_rules(prof)
+    return Rules(id=profile_name,
+                 inbound_rules=[allow_from_profile],
+                 outbound_rules=[allow_to_all])
 
-def _create_profile_for_public_communication(profile_name):
+def _public_communication_rules(profile_name):
     """
-    Create a public profile which allows open traffic from all.
+    Rules for a public profile which allows open traffic from all.
     """
-    _log.info("Creating public profile: %s", profile_name)
-    datastore.create_profile(profile_name)
-    prof = datastore.get_profile(profile_name)
+    from pycalico.datastore import Rules, Rule
     allow_all = Rule(action="allow")
-    prof.rules = Rules(id=profile_name,
-                       inbound_rules=[allow_all],
-                       outbound_rules=[allow_all])
-    datastore.profile_update_rules(prof)
+    return Rules(id=profile_name,
+                 inbound_rules=[allow_all],
+                 outbound_rules=[allow_all])
+
+def _create_profile(profile_name, rules):
+    """
+    Create a profile with the given rules, writing the rules directly rather
+    than creating a default profile, reading it back and updating it.
+
+    :return: True if the profile was created, False if it already existed.
+    """
+    from etcd import EtcdAlreadyExist
+    from pycalico.datastore import PROFILE_PATH
+    profile_path = PROFILE_PATH % {"profile_id": profile_name}
+    try:
+        # Creating the rules key is what claims the profile: if another
+        # agent races us to create it, or the profile already exists, only
+        # one of these writes succeeds, and nothing existing is overwritten.
+        datastore.etcd_client.write(profile_path + "rules", rules.to_json(),
+                                    prevExist=False)
+    except EtcdAlreadyExist:
+        return False
+    try:
+        datastore.etcd_client.write(profile_path + "tags",
+                                    json.dumps([profile_name]),
+                                    prevExist=False)
+    except EtcdAlreadyExist:
+        # Tagged by someone else in the meantime; keep their tags.
+        pass
+    except Exception:
+        # Give up the claim, so that the next attempt creates the profile
+        # with its tags rather than finding it already exists.
+        datastore.etcd_client.delete(profile_path + "rules")
+        raise
+    _log.info("Autocreated profile %s", profile_name)
+    return True
+
+
+def _ensure_profiles(profiles):
+    """
+    Create any of the given profiles which do not already exist.  Missing
+    profiles are created concurrently.
+
+    :param profiles: List of (profile name, rules function) tuples.  The rules
+    function is called with the profile name to build the rules for a
+    profile which needs creating.
+    """
+    missing = [(profile_name, rules_func)
+               for profile_name, rules_func in profiles
+               if not _profile_known(profile_name)]
+
+    def ensure(profile):
+        profile_name, rules_func = profile
+
+        def create():
+            with _locked([("profile", profile_name)]) as waited:
+                # Another request may have created it while this one waited.
+                if waited and _profile_known(profile_name):
+                    return True
+                try:
+                    _create_profile(profile_name, rules_func(profile_name))
+                except Exception:
+                    # Whatever state the profile is in now, don't trust the
+                    # cache for it.
+                    _profile_cache.invalidate(profile_name)
+                    raise
+                _profile_cache.add(profile_name)
+            return True
+        _shared_lookup(("profile", profile_name), create)
+
+    check_results(run_parallel(ensure, missing, len(missing)))
+
+
+def _profile_known(profile_name):
+    """
+    :return: True if the profile is known to exist, from the datastore mirror
+    if it is in sync, otherwise from the profile cache.
+    """
+    exists = _mirrored("profile_exists", profile_name)
+    if exists is None:
+        return _profile_cache.contains(profile_name)
+    return exists
+
+
+def _mirrored(read, *args):
+    """
+    :return: The result of the datastore mirror's read method, or None if
+    there is no mirror or it is out of sync with the datastore.
+    """
+    if _datastore_mirror is None:
+        return None
+    return getattr(_datastore_mirror, read)(*args)
+
 
 def _get_host_ip_net():
     """
     Gets the IP Address / subnet of the host.
 
-    Ignores Loopback and docker0 Addresses.
+    Ignores Loopback Addresses and those on EXCLUDED_INTERFACES.
     """
-    IP_SUBNET_RE = re.compile(r'inet ((?:\d+\.){3}\d+\/\d+)')
-    INTERFACE_SPLIT_RE = re.compile(r'(\d+:.*(?:\n\s+.*)+)')
-    IFACE_RE = re.compile(r'^\d+: (\S+):')
+    from netaddr import IPNetwork
 
-    # Call `ip addr`.
     try:
-        ip_addr_output = check_output(["ip", "-4", "addr"])
-    except CalledProcessError, OSError:
+        addresses = _host_addresses.get()
+    except (socket.error, OSError) as e:
+        _log.error("Could not read host addresses: %s", e)
         raise IsolatorException("Could not read host IP")
 
-    # Separate interface blocks from ip addr output and iterate.
-    for iface_block in INTERFACE_SPLIT_RE.findall(ip_addr_output):
-        # Exclude certain interfaces.
-        match = IFACE_RE.match(iface_block)
-        if match and match.group(1) not in ["docker0", "lo"]:
-            # Iterate through Addresses on interface.
-            for address in IP_SUBNET_RE.findall(iface_block):
-                ip_net = IPNetwork(address)
-                if not ip_net.ip.is_loopback():
-                    return ip_net.cidr
+    for label, address, prefixlen in addresses:
+        # Address labels of interface aliases take the form "<iface>:<n>".
+        if label and label.split(":")[0] in EXCLUDED_INTERFACES:
+            continue
+        ip_net = IPNetwork("%s/%d" % (address, prefixlen))
+        if not ip_net.ip.is_loopback():
+            return ip_net.cidr
     raise IsolatorException("Couldn't determine host's IP Address.")
 
 
@@ -223,16 +841,16 @@ def isolate(args):
     # Validate Container ID
     if not container_id:
         raise IsolatorException(ERROR_MISSING_CONTAINER_ID)
+    if not isinstance(container_id, basestring):
+        raise IsolatorException("container_id must be a string")
     if not hostname:
         raise IsolatorException(ERROR_MISSING_HOSTNAME)
     if not pid:
         raise IsolatorException(ERROR_MISSING_PID)
 
-    # Validate IPv4 Addresses
-    ipv4_addrs_validated = _validate_ip_addrs(ipv4_addrs, 4)
-
-    # Validate IPv6 Addresses
-    ipv6_addrs_validated = _validate_ip_addrs(ipv6_addrs, 6)
+    with _span("validate"):
+        ipv4_addrs_validated, ipv6_addrs_validated = _validate_ip_addrs(
+            (ipv4_addrs, 4), (ipv6_addrs, 6))
 
     if not ipv4_addrs_validated + ipv6_addrs_validated:
         raise IsolatorException("Must provide at least one IPv4 or IPv6 address.")
@@ -263,25 +881,27 @@ def _isolate(hostname, ns_pid, container_id, ipv4_addrs, ipv6_addrs, profiles, l
     :param labels: TODO
     :return: None
     """
+    from pycalico import netns
+
     _log.info("Preparing network for Container with ID %s", container_id)
     _log.info("IP: %s, Profile %s", ipv4_addrs, profiles)
 
-
-    # Exit if the endpoint has already been configured
-    if len(datastore.get_endpoints(hostname=HOSTNAME,
-                                   orchestrator_id=ORCHESTRATOR_ID,
-                                   workload_id=container_id)) == 1:
-        raise IsolatorException("This container has already been configured "
-                                "with Calico Networking.")
-
-    # Create the endpoint
-    ep = datastore.create_endpoint(hostname=HOSTNAME,
-                                   orchestrator_id=ORCHESTRATOR_ID,
-                                   workload_id=container_id,
-                                   ip_list=ipv4_addrs)
+    # Check whether the endpoint has already been configured.  A container
+    # missing from a complete endpoint index has no endpoint; otherwise ask
+    # the datastore mirror, or failing that the datastore, provisioning the
+    # profiles while the check is in flight.
+    check_datastore = False
+    with _span("existence_check"):
+        if (_endpoint_index.get(container_id) is not None or
+                not _endpoint_index.is_complete()):
+            mirrored = _mirrored("get_endpoints", container_id)
+            if mirrored:
+                raise IsolatorException(ERROR_ALREADY_CONFIGURED)
+            check_datastore = mirrored is None
 
     # Create any profiles in etcd that do not already exist
     assigned_profiles = []
+    profile_rules = []
     _log.info("Assigning Profiles: %s" % profiles)
     # First remove any keyword profile names
     try:
@@ -290,42 +910,101 @@ def _isolate(hostname, ns_pid, container_id, ipv4_addrs, ipv6_addrs, profiles, l
         pass
     else:
         _log.info("Assigning Public Profile")
-        if not datastore.profile_exists("public"):
-            _create_profile_for_public_communication("public")
+        profile_rules.append(("public", _public_communication_rules))
         assigned_profiles.append("public")
 
     # Assign remaining netgroup profiles
     for profile in profiles:
         profile = "ng_%s" % profile
-        if not datastore.profile_exists(profile):
-            _log.info("Assigning Netgroup Profile: %s" % profile)
-            _create_profile_for_netgroup(profile)
+        _log.info("Assigning Netgroup Profile: %s" % profile)
+        profile_rules.append((profile, _netgroup_rules))
         assigned_profiles.append(profile)
 
     # Insert the host-communication profile
     default_profile_name = "default_%s" % hostname
     _log.info("Assigning Default Host Profile: %s" % default_profile_name)
-    if not datastore.profile_exists(default_profile_name):
-        _create_profile_for_host_communication(default_profile_name)
+    profile_rules.append((default_profile_name, _host_communication_rules))
     assigned_profiles.insert(0, default_profile_name)
 
-    # Call through to complete the network setup matching this endpoint
-    ep.profile_ids = assigned_profiles
-    try:
-        ep.mac = ep.provision_veth(netns.PidNamespace(ns_pid), "eth0")
-    except netns.NamespaceError as e:
-        raise IsolatorException(e.message)
-
-    datastore.set_endpoint(ep)
+    def ensure_profiles():
+        with _span("profiles"):
+            _ensure_profiles(profile_rules)
+        return assigned_profiles
+
+    def check_existing():
+        # Exit if the endpoint has already been configured
+        with _span("existence_check"):
+            existing_endpoints = datastore.get_endpoints(
+                hostname=HOSTNAME,
+                orchestrator_id=ORCHESTRATOR_ID,
+                workload_id=container_id)
+        if len(existing_endpoints) == 1:
+            raise IsolatorException(ERROR_ALREADY_CONFIGURED)
+
+    def provision(*_):
+        # Create the endpoint
+        with _span("create_endpoint"):
+            ep = datastore.create_endpoint(hostname=HOSTNAME,
+                                           orchestrator_id=ORCHESTRATOR_ID,
+                                           workload_id=container_id,
+                                           ip_list=ipv4_addrs)
+
+        # Call through to complete the network setup matching this endpoint
+        with _span("veth"):
+            try:
+                ep.mac = _provision_veth(ep, netns.PidNamespace(ns_pid))
+            except netns.NamespaceError as e:
+                raise IsolatorException(e.message)
+        return ep
+
+    def write_endpoint(ep, profile_ids):
+        ep.profile_ids = profile_ids
+        with _span("set_endpoint"):
+            # Index the endpoint before writing it, so that the index never
+            # misses an endpoint in the datastore.
+            _endpoint_index.add(container_id, ep)
+            datastore.set_endpoint(ep)
+            if _datastore_mirror:
+                _datastore_mirror.endpoint_written(ep)
+
+    # The profiles are independent of the existence check and the veth
+    # until the endpoint is written.  If anything fails, the veth is removed
+    # again.
+    graph = TaskGraph()
+    graph.add("profiles", _in_request(ensure_profiles))
+    checks = []
+    if check_datastore:
+        graph.add("existence_check", _in_request(check_existing))
+        checks.append("existence_check")
+    graph.add("veth", _in_request(provision), after=checks,
+              undo=_in_request(_remove_veth))
+    graph.add("set_endpoint", _in_request(write_endpoint),
+              after=["veth", "profiles"])
+    graph.run()
     _log.info("Finished networking for container %s", container_id)
 
 
+def _provision_veth(endpoint, namespace):
+    """
+    Create the endpoint's veth, from the veth pool if there is one with a
+    pair to spare.
+    :return: The MAC address of the veth in the namespace.
+    """
+    pair = _veth_pool and _veth_pool.take()
+    if pair is None:
+        return endpoint.provision_veth(namespace, "eth0")
+    from veth_pool import provision_pooled_veth
+    return provision_pooled_veth(endpoint, namespace, "eth0", pair)
+
+
 def cleanup(args):
     hostname = args.get("hostname")
     container_id = args.get("container_id")
 
     if not container_id:
         raise IsolatorException(ERROR_MISSING_CONTAINER_ID)
+    if not isinstance(container_id, basestring):
+        raise IsolatorException("container_id must be a string")
     if not hostname:
         raise IsolatorException(ERROR_MISSING_HOSTNAME)
 
@@ -335,35 +1014,304 @@ def cleanup(args):
 def _cleanup(hostname, container_id):
     _log.info("Cleaning executor with Container ID %s.", container_id)
 
-    try:
-        endpoint = datastore.get_endpoint(hostname=HOSTNAME,
-                                          orchestrator_id=ORCHESTRATOR_ID,
-                                          workload_id=container_id)
-    except KeyError:
-        raise IsolatorException("No endpoint found with container-id: %s" % container_id)
+    with _span("lookup"):
+        record = _endpoint_index.get(container_id)
+        mirrored = None if record else _mirrored("get_endpoints",
+                                                 container_id)
+        if record:
+            endpoint = endpoint_from_record(record)
+        elif mirrored is not None:
+            if not mirrored:
+                raise IsolatorException("No endpoint found with container-id: %s" % container_id)
+            endpoint = mirrored[0]
+        else:
+            try:
+                endpoint = datastore.get_endpoint(
+                    hostname=HOSTNAME,
+                    orchestrator_id=ORCHESTRATOR_ID,
+                    workload_id=container_id)
+            except KeyError:
+                raise IsolatorException("No endpoint found with container-id: %s" % container_id)
+
+    if _cleanup_worker:
+        # Only the veth has to go before the container's resources are
+        # reused.  The rest is done by the cleanup worker.
+        with _span("veth"):
+            _remove_veth(endpoint)
+        with _span("queue"):
+            _cleanup_worker.add(container_id, endpoint_record(endpoint))
+        _log.info("Queued cleanup of container %s", container_id)
+        return
+
+    _cleanup_endpoint(container_id, endpoint)
+    _log.info("Cleanup complete for container %s", container_id)
+
 
+def _cleanup_endpoint(container_id, endpoint):
+    """
+    Unassign the endpoint's addresses, and remove it and its workload from
+    the datastore.
+    """
     # Unassign any address it has.
+    ips = []
     for net in endpoint.ipv4_nets | endpoint.ipv6_nets:
         assert(net.size == 1)
-        ip = net.ip
-        _log.info("Attempting to un-allocate IP %s", ip)
-        pools = datastore.get_ip_pools(ip.version)
-        for pool in pools:
-            if ip in pool:
-                # Ignore failure to unassign address, since we're not
-                # enforcing assignments strictly in datastore.py.
-                _log.info("Un-allocate IP %s from pool %s", ip, pool)
-                datastore.unassign_address(pool, ip)
-
-    # Remove the endpoint
-    _log.info("Removing veth for endpoint %s", endpoint.endpoint_id)
-    datastore.remove_endpoint(endpoint)
-
-    # Remove the container from the datastore.
-    datastore.remove_workload(hostname=HOSTNAME,
-                              orchestrator_id=ORCHESTRATOR_ID,
-                              workload_id=container_id)
-    _log.info("Cleanup complete for container %s", container_id)
+        ips.append(net.ip)
+
+    def remove_endpoint():
+        _log.info("Removing endpoint %s", endpoint.endpoint_id)
+        with _span("remove_endpoint"):
+            try:
+                datastore.remove_endpoint(endpoint)
+            except KeyError:
+                # Removed by an earlier attempt whose later steps failed, or
+                # an indexed endpoint which was never written, because
+                # isolate failed after indexing it.  Either way, carry on
+                # with the rest.
+                _log.info("Endpoint %s already removed", endpoint.endpoint_id)
+
+    def unassign():
+        _log.info("Attempting to un-allocate IPs %s", ips)
+        with _span("unassign"):
+            _unassign_addresses(ips)
+
+    def remove_workload(_):
+        # Remove the container from the datastore.
+        with _span("remove_workload"):
+            try:
+                datastore.remove_workload(hostname=HOSTNAME,
+                                          orchestrator_id=ORCHESTRATOR_ID,
+                                          workload_id=container_id)
+            except KeyError:
+                _log.info("Workload %s already removed", container_id)
+
+    # The addresses are unassigned while the endpoint, then the workload,
+    # are removed.  The container stays indexed until all have succeeded,
+    # so that a failed cleanup can be retried.
+    graph = TaskGraph()
+    graph.add("remove_endpoint", _in_request(remove_endpoint))
+    graph.add("unassign", _in_request(unassign))
+    graph.add("remove_workload", _in_request(remove_workload),
+              after=["remove_endpoint"])
+    graph.run()
+    _endpoint_index.remove(container_id)
+    if _datastore_mirror:
+        _datastore_mirror.workload_removed(container_id)
+
+
+def _remove_veth(endpoint):
+    from pycalico import netns
+    _log.info("Removing veth %s", endpoint.name)
+    try:
+        netns.remove_veth(endpoint.name)
+    except CalledProcessError as e:
+        raise IsolatorException("Couldn't remove veth %s: %s" %
+                                (endpoint.name, e))
+
+
+def _deferred_cleanup(entry):
+    """
+    Complete a cleanup queued in the cleanup journal.
+    """
+    # Failing to get the lock fails the entry, so that it is retried.
+    with _locked([("container", entry["container_id"])]):
+        try:
+            _cleanup_endpoint(entry["container_id"],
+                              endpoint_from_record(entry["endpoint"]))
+        except IsolatorException as e:
+            # The endpoint is already gone, so there is nothing to retry.
+            _log.warning("Deferred cleanup of container %s: %s",
+                         entry["container_id"], e)
+        else:
+            _log.info("Deferred cleanup complete for container %s",
+                      entry["container_id"])
+
+
+def cleanup_queue(args):
+    """
+    Report the cleanups queued by deferred cleanup, optionally completing
+    them all first.
+
+    "args": {
+        "flush": true   # Optional.  Process every queued cleanup now,
+                        # retrying failed ones without waiting.
+    }
+
+    :return: JSON-serialized dictionary of the result in the following
+    format:
+    {
+        "flushed": {"completed": 3, "failed": 1},   # None unless flushing
+        "pending": 1,
+        "entries": [{"container_id": "ba11f1de-...", "queued_at": 1449100000.0,
+                     "attempts": 2, "last_error": "..."}],
+        "error": None
+    }
+    """
+    flush = args.get("flush", False)
+    if type(flush) is not bool:
+        raise IsolatorException("flush must be a boolean")
+    # Outside the daemon, the journal is read, and flushed, directly.
+    worker = _cleanup_worker
+    if worker is None:
+        from cleanup_journal import CleanupJournal, CleanupWorker
+        worker = CleanupWorker(CleanupJournal(CLEANUP_JOURNAL),
+                               _deferred_cleanup)
+    result = {"flushed": None}
+    if flush:
+        with _span("flush"):
+            result["flushed"] = worker.drain(retry_all=True)
+    result.update(worker.status())
+    result["error"] = None
+    return json.dumps(result)
+
+
+def cleanup_all(args):
+    """
+    Clean up every container on this host, as when the agent is drained.
+    The host's endpoints are listed with one query, containers are torn down
+    DRAIN_WORKERS at a time, and the addresses of the containers torn down
+    are then released, with one release per allocation block.  A container
+    which fails keeps its addresses, so that it can be cleaned up again.
+
+    "args": {
+        "hostname": "slave-0-1", # Required
+    }
+
+    :return: JSON-serialized dictionary of the result in the following
+    format:
+    {
+        "containers": 3,                                  # Found
+        "removed": ["ba11f1de-fc4d-46fd-9f15-424f4ef05a3a",
+                    "3cbd9f62-1c1e-4a0a-b4d4-83f4b5d1d2a7"],
+        "addresses": 2,                                   # Released
+        "failures": {"0cd47986-24ad-4c00-b9d3-5db9e5c02028": "..."},
+        "release_failures": {"192.168.23.0/26": "..."},
+        "error": None
+    }
+    """
+    if not args.get("hostname"):
+        raise IsolatorException(ERROR_MISSING_HOSTNAME)
+
+    with _span("list"):
+        endpoints = _mirrored("get_endpoints")
+        if endpoints is None:
+            endpoints = datastore.get_endpoints(
+                hostname=HOSTNAME, orchestrator_id=ORCHESTRATOR_ID)
+    containers = {}
+    for endpoint in endpoints:
+        containers.setdefault(endpoint.workload_id, []).append(endpoint)
+    _log.info("Draining %d containers", len(containers))
+
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
+    report_every = max(1, len(containers) / 10)
+
+    def drain(container):
+        container_id, container_endpoints = container
+        try:
+            with _locked([("container", container_id)]):
+                _drain_container(container_id, container_endpoints)
+        finally:
+            with progress_lock:
+                progress["done"] += 1
+                done = progress["done"]
+            if done % report_every == 0 or done == len(containers):
+                _log.info("Drained %d of %d containers", done,
+                          len(containers))
+
+    items = sorted(containers.items())
+    with _span("teardown"):
+        results = run_parallel(drain, items, DRAIN_WORKERS)
+    removed = []
+    failures = {}
+    for (container_id, _), (_, exc_info) in zip(items, results):
+        if exc_info:
+            failures[container_id] = str(exc_info[1]) or \
+                exc_info[0].__name__
+            _log.error("Couldn't clean up container %s: %s", container_id,
+                       failures[container_id])
+        else:
+            removed.append(container_id)
+
+    from ipam_blocks import group_by_block
+    ips = [net.ip for container_id in removed
+           for endpoint in containers[container_id]
+           for net in endpoint.ipv4_nets | endpoint.ipv6_nets]
+    blocks = group_by_block(ips).items()
+    with _span("release"):
+        results = run_parallel(
+            lambda (block_cidr, addresses): datastore.release_ips(
+                set(addresses)), blocks, RESERVE_WORKERS)
+    release_failures = {}
+    for (block_cidr, _), (_, exc_info) in zip(blocks, results):
+        if exc_info:
+            release_failures[str(block_cidr)] = str(exc_info[1])
+            _log.error("Couldn't release addresses in %s: %s", block_cidr,
+                       exc_info[1])
+    return json.dumps({"containers": len(containers),
+                       "removed": removed,
+                       "addresses": len(ips),
+                       "failures": failures,
+                       "release_failures": release_failures,
+                       "error": None})
+
+
+def _drain_container(container_id, endpoints):
+    """
+    Remove a container's endpoints and its workload from the datastore,
+    leaving its addresses assigned.
+    """
+    # Either may already have been removed, by a cleanup racing this one.
+    for endpoint in endpoints:
+        try:
+            datastore.remove_endpoint(endpoint)
+        except KeyError:
+            pass
+    try:
+        datastore.remove_workload(hostname=HOSTNAME,
+                                  orchestrator_id=ORCHESTRATOR_ID,
+                                  workload_id=container_id)
+    except KeyError:
+        pass
+    _endpoint_index.remove(container_id)
+    if _datastore_mirror:
+        _datastore_mirror.workload_removed(container_id)
+    _forget_response(container_id)
+
+
+def _pool_index(version):
+    """
+    :return: PoolIndex of the IP pools of the given version, from the
+    datastore mirror if it is in sync, otherwise read from the datastore once
+    per request.
+    """
+    def read():
+        pools = _mirrored("get_ip_pools", version)
+        if pools is None:
+            pools = datastore.get_ip_pools(version)
+        return PoolIndex(pools)
+    return _shared_lookup(("pool_index", version), read)
+
+
+def _unassign_addresses(ips):
+    """
+    Unassign each address from the pool containing it.  Addresses are grouped
+    by pool, and the groups are unassigned concurrently.
+    """
+    groups = []
+    for version in sorted(set(ip.version for ip in ips)):
+        groups.extend(_pool_index(version).group_by_pool(
+            [ip for ip in ips if ip.version == version]))
+
+    def unassign(group):
+        pool, pool_ips = group
+        _log.info("Un-allocate IPs %s from pool %s", pool_ips, pool)
+        for ip in pool_ips:
+            # Ignore failure to unassign address, since we're not
+            # enforcing assignments strictly in datastore.py.
+            datastore.unassign_address(pool, ip)
+
+    check_results(run_parallel(unassign, groups, len(groups)))
 
 
 def reserve(args):
@@ -375,8 +1323,8 @@ def reserve(args):
     "args": {
 		"hostname": "slave-0-1", # Required
 		# At least one of "ipv4_addrs" and "ipv6_addrs" must be present.
-	 	"ipv4_addrs": ["192.168.23.4"],
-		"ipv6_addrs": ["2001:3ac3:f90b:1111::1", "2001:3ac3:f90b:1111::2"],
+	 	"ipv4_addrs": ["192.168.23.4", "192.168.24.0/28"],
+		"ipv6_addrs": ["2001:3ac3:f90b:1111::1-2001:3ac3:f90b:1111::8"],
 		"uid": "0cd47986-24ad-4c00-b9d3-5db9e5c02028",
 	 	"netgroups": ["prod", "frontend"], # Optional.
 	 	"labels": {  # Optional.
@@ -403,10 +1351,11 @@ def reserve(args):
         raise IsolatorException(ERROR_MISSING_HOSTNAME)
 
     # Validate IP addresses
-    ipv4_addrs_validated = _validate_ip_addrs(ipv4_addrs, 4)
-    ipv6_addrs_validated = _validate_ip_addrs(ipv6_addrs, 6)
+    with _span("validate"):
+        ipv4_addrs_validated, ipv6_addrs_validated = _validate_ip_ranges(
+            (ipv4_addrs, 4), (ipv6_addrs, 6))
 
-    if not ipv4_addrs_validated + ipv6_addrs_validated:
+    if not ipv4_addrs_validated and not ipv6_addrs_validated:
         raise IsolatorException("Must provide at least one IPv4 or IPv6 address.")
 
     return _reserve(hostname, uid, ipv4_addrs_validated, ipv6_addrs_validated)
@@ -418,24 +1367,46 @@ def _reserve(hostname, uid, ipv4_addrs, ipv6_addrs):
     :param hostname: The host agent which is reserving this IP
     :param uid: A unique ID, which is indexed by the IPAM module and can be
     used to release all addresses with the uid.
-    :param ipv4_addrs: List of strings specifiying requested IPv4 addresses
-    :param ipv6_addrs: List of strings specifiying requested IPv6 addresses
+    :param ipv4_addrs: List or AddressRanges of requested IPv4 addresses
+    :param ipv6_addrs: List or AddressRanges of requested IPv6 addresses
     :return:
+
+    Addresses are grouped by allocation block, and each block's addresses
+    are assigned with a single compare-and-swap.  Blocks are assigned
+    concurrently.  Either every address is reserved, or none are.
     """
+    from ipam_blocks import group_by_block, assign_block_addresses, \
+        AssignmentFailed
+
     _log.info("Reserving. hostname: %s, uid: %s, ipv4_addrs: %s, ipv6_addrs: %s" % \
               (HOSTNAME, uid, ipv4_addrs, ipv6_addrs))
+    # Keep track of succesfully assigned ip_addrs in case we need to rollback
     assigned_ips = []
-    try:
-        for ip_addr in ipv4_addrs + ipv6_addrs:
-            datastore.assign_ip(ip_addr, uid, {}, HOSTNAME)
-            assigned_ips.append(ip_addr)
-            # Keep track of succesfully assigned ip_addrs in case we need to rollback
-    except (RuntimeError, ValueError, AlreadyAssignedError):
-        failed_addr = ip_addr
-        _log.error("Couldn't reserve %s. Attempting rollback." % (ip_addr))
+
+    def assign(block):
+        block_cidr, addresses = block
+        assign_block_addresses(datastore, block_cidr, addresses, uid, {},
+                               HOSTNAME, assigned_ips)
+
+    if _handle_records:
+        _handle_records.add(uid, reserved=[
+            entry for addresses in (ipv4_addrs, ipv6_addrs)
+            for entry in _address_ranges(addresses).ranges])
+    with _span("assign"):
+        blocks = (group_by_block(ipv4_addrs).items() +
+                  group_by_block(ipv6_addrs).items())
+        failures = [exc_info for _, exc_info in
+                    run_parallel(assign, blocks, RESERVE_WORKERS) if exc_info]
+    if failures:
+        error = failures[0][1]
+        _log.error("Couldn't reserve addresses (%s). Attempting rollback." %
+                   error)
         # Rollback assigned ip_addrs
-        datastore.release_ips(set(assigned_ips))
-        raise IsolatorException("IP '%s' already in use." % failed_addr)
+        with _span("rollback"):
+            datastore.release_ips(set(assigned_ips))
+        if isinstance(error, AssignmentFailed):
+            raise IsolatorException("IP '%s' already in use." % error.address)
+        raise failures[0][0], failures[0][1], failures[0][2]
 
 def allocate(args):
     """
@@ -507,16 +1478,84 @@ def _allocate(num_ipv4, num_ipv6, hostname, uid):
         "error": None  # Not None indicates error and contains error message.
     }
     """
-    result = datastore.auto_assign_ips(num_ipv4, num_ipv6, uid, {},
-                                       hostname=HOSTNAME)
-    ipv4_strs = [str(ip) for ip in result[0]]
-    ipv6_strs = [str(ip) for ip in result[1]]
+    # A retry whose response is not cached (say, the original request
+    # timed out, then the process died) must not assign the uid more
+    # addresses, so if an earlier allocate for the uid may have assigned
+    # some, only assign those it does not already have.
+    record = _handle_records and _handle_records.get(uid)
+    if _handle_records and not (record and record.get("allocated")):
+        _handle_records.add(uid, allocated=True)
+        existing = {4: [], 6: []}
+    else:
+        with _span("lookup"):
+            existing = _allocated_addresses(uid, record)
+    num_ipv4 = max(0, num_ipv4 - len(existing[4]))
+    num_ipv6 = max(0, num_ipv6 - len(existing[6]))
+    if existing[4] or existing[6]:
+        _log.info("uid %s already has addresses %s", uid,
+                  existing[4] + existing[6])
+
+    result = ([], [])
+    if num_ipv4 or num_ipv6:
+        with _span("assign"):
+            result = _assign(num_ipv4, num_ipv6, uid)
+    ipv4_strs = [str(ip) for ip in existing[4] + list(result[0])]
+    ipv6_strs = [str(ip) for ip in existing[6] + list(result[1])]
     result_json = {"ipv4": ipv4_strs,
                    "ipv6": ipv6_strs,
                    "error": None}
     return json.dumps(result_json)
 
 
+def _assign(num_ipv4, num_ipv6, uid):
+    """
+    Assign addresses to the uid, from the reservoir or coalescer if the
+    daemon has them, or else directly.
+    :return: Tuple of (IPv4 addresses, IPv6 addresses).
+    """
+    result = None
+    if _ip_reservoir:
+        result = _ip_reservoir.allocate(num_ipv4, num_ipv6, uid)
+    if result is None and _allocation_coalescer:
+        result = _allocation_coalescer.allocate(num_ipv4, num_ipv6, uid)
+    if result is None:
+        result = datastore.auto_assign_ips(num_ipv4, num_ipv6, uid, {},
+                                           hostname=HOSTNAME)
+    return result
+
+
+def _allocated_addresses(uid, record):
+    """
+    :param record: The uid's handle record, or None if there is none.
+    :return: Dictionary of IP version to the list of addresses allocated to
+    the uid.  Addresses the record shows were reserved are left out.
+    """
+    from ip_ranges import AddressRanges
+    reserved = AddressRanges(tuple(entry) for entry in
+                             (record or {}).get("reserved", []))
+    try:
+        addresses = datastore.get_ip_assignments_by_handle(uid)
+    except KeyError:
+        # No such handle.
+        addresses = []
+    by_version = {4: [], 6: []}
+    for address in sorted(addresses):
+        if address not in reserved:
+            by_version[address.version].append(address)
+    return by_version
+
+
+def _address_ranges(addresses):
+    """
+    :return: AddressRanges of a list or AddressRanges of addresses.
+    """
+    from ip_ranges import AddressRanges
+    if isinstance(addresses, AddressRanges):
+        return addresses
+    return AddressRanges((address.version, int(address), int(address))
+                         for address in addresses)
+
+
 def release(args):
     """
     Toplevel function which validates and sanitizes json args into variables
@@ -526,6 +1565,8 @@ def release(args):
         "uid": "0cd47986-24ad-4c00-b9d3-5db9e5c02028",
         # OR
         "ips": ["192.168.23.4", "2001:3ac3:f90b:1111::1"] # OK to mix 6 & 4
+        # CIDRs ("192.168.24.0/28") and ranges ("192.168.25.1-192.168.25.9")
+        # may be given too.
     }
 
     Must include a uid or ips, but not both.  If a uid is passed, release all
@@ -540,8 +1581,14 @@ def release(args):
         if ips is None:
             raise IsolatorException("Must supply either uid or ips.")
         else:
-            ips_validated = _validate_ip_addrs(ips)
-            return _release_ips(set(ips_validated))
+            with _span("validate"):
+                ips_validated, = _validate_ip_ranges((ips, None))
+            result = _release_ips(ips_validated)
+            if _response_cache:
+                # The uids the addresses had are unknown, so no cached
+                # allocate or reserve response can be trusted.
+                _response_cache.new_generation()
+            return result
 
     else:
         # uid supplied.
@@ -556,15 +1603,21 @@ def release(args):
 
 def _release_ips(ips):
     """
-    Release the given IPs using the data store.
+    Release the given IPs using the data store.  Each allocation block's
+    addresses are released concurrently.
 
-    :param ips: Set of IPAddress objects to release.
+    :param ips: AddressRanges of the addresses to release.
     :return: None
     """
+    from ipam_blocks import group_by_block
     # release_ips returns a set of addresses that were already not allocated
     # when this function was called.  But, Mesos doesn't consume that
     # information, so we ignore it.
-    _ = datastore.release_ips(ips)
+    with _span("release"):
+        groups = group_by_block(ips).values()
+        check_results(run_parallel(
+            lambda addresses: datastore.release_ips(set(addresses)), groups,
+            RESERVE_WORKERS))
 
 
 def _release_uid(uid):
@@ -573,7 +1626,136 @@ def _release_uid(uid):
     :param uid: The unique ID used to allocate the IPs.
     :return: None
     """
-    _ = datastore.release_ip_by_handle(uid)
+    with _span("release"):
+        _ = datastore.release_ip_by_handle(uid)
+    if _handle_records:
+        _handle_records.remove(uid)
+
+
+def stats(args):
+    """
+    Report the isolator's cache and connection counters.  etcd_connections
+    is None if this process has not yet used the datastore, and
+    ip_reservoir, veth_pool, allocate_coalescer and datastore_mirror are None
+    unless the daemon is running with them.  response_cache is None if it is
+    disabled.
+
+    :return: JSON-serialized dictionary of the result in the following
+    format:
+    {
+        "profile_cache": {"hits": 10, "misses": 2, "evictions": 0,
+                          "size": 2},
+        "etcd_connections": {"connections": 2, "requests": 40,
+                             "reuse_rate": 0.95, "idle_resets": 0,
+                             "health_checks": 3,
+                             "health_check_failures": 0},
+        "ip_reservoir": {"ipv4": 14, "ipv6": 0, "hits": 5, "misses": 1,
+                         "rebind_failures": 0},
+        "veth_pool": {"size": 8, "hits": 5, "misses": 0},
+        "allocate_coalescer": {"batches": 3, "allocations": 20,
+                               "cas_conflicts": 0, "fallbacks": 1},
+        "datastore_mirror": {"synced": true, "endpoints": 120,
+                             "profiles": 40, "ip_pools": 2, "resyncs": 4,
+                             "events": 530, "watch_failures": 0},
+        "locks": {"acquired": 200, "contended": 3, "timeouts": 0,
+                  "wait_seconds": 0.4, "max_wait_seconds": 0.2, "held": 1,
+                  "waiting": 0},
+        "response_cache": {"hits": 2, "misses": 180, "stores": 178,
+                           "evictions": 0},
+        "error": None
+    }
+    """
+    pool = datastore.pool
+    return json.dumps({"profile_cache": _profile_cache.stats(),
+                       "etcd_connections": pool and pool.stats(),
+                       "ip_reservoir": _ip_reservoir and _ip_reservoir.stats(),
+                       "veth_pool": _veth_pool and _veth_pool.stats(),
+                       "allocate_coalescer": _allocation_coalescer and
+                       _allocation_coalescer.stats(),
+                       "datastore_mirror": _datastore_mirror and
+                       _datastore_mirror.stats(),
+                       "locks": _locks.stats(),
+                       "response_cache": _response_cache and
+                       _response_cache.stats(),
+                       "error": None})
+
+
+def reconcile(args):
+    """
+    Remove this host's orphaned endpoints and release its orphaned
+    addresses: those left behind by containers which are no longer running.
+    An orphan is only released once it has been found by two passes at
+    least CALICO_MESOS_RECONCILE_GRACE seconds apart, and each pass releases
+    at most CALICO_MESOS_RECONCILE_BATCH_SIZE orphans.
+
+    "args": {
+        # IDs of the running containers.  Optional if CALICO_MESOS_AGENT_URL
+        # is set, in which case they are listed from the agent.
+        "containers": ["ba11f1de-fc4d-46fd-9f15-424f4ef05a3a"]
+    }
+
+    :return: JSON-serialized dictionary of the result in the following
+    format:
+    {
+        "endpoints": ["3cbd9f62-1c1e-4a0a-b4d4-83f4b5d1d2a7"],  # Removed
+        "addresses": ["192.168.23.5"],                          # Released
+        "pending": 2,
+        "failures": {},
+        "error": None
+    }
+    """
+    containers = args.get("containers")
+    if containers is None:
+        if not AGENT_URL:
+            raise IsolatorException("Must supply containers, or set "
+                                    "CALICO_MESOS_AGENT_URL.")
+        from reconciler import fetch_agent_containers
+        with _span("list_containers"):
+            try:
+                containers = fetch_agent_containers(AGENT_URL)
+            except (IOError, ValueError, KeyError, TypeError) as e:
+                raise IsolatorException("Couldn't list containers from %s: %s"
+                                        % (AGENT_URL, e))
+    elif type(containers) is not list:
+        raise IsolatorException("containers must be a list")
+
+    with _span("reconcile"):
+        result = _reconciler().run(set(containers))
+    result["error"] = None
+    return json.dumps(result)
+
+
+def _reconciler():
+    from reconciler import Reconciler
+    from ip_reservoir import RESERVOIR_HANDLE
+    return Reconciler(datastore, HOSTNAME, ORCHESTRATOR_ID,
+                      _reconcile_cleanup,
+                      RECONCILE_STATE_FILE, RECONCILE_GRACE,
+                      RECONCILE_BATCH_SIZE,
+                      protected_handles=[RESERVOIR_HANDLE % HOSTNAME],
+                      handles=_handle_records,
+                      handle_age=RECONCILE_HANDLE_AGE,
+                      list_endpoints=_local_endpoints)
+
+
+def _local_endpoints():
+    """
+    :return: This host's endpoints, from the datastore mirror or the endpoint
+    index, or None if neither holds them all.
+    """
+    endpoints = _mirrored("get_endpoints")
+    if endpoints is None and _endpoint_index.is_complete():
+        endpoints = _endpoint_index.endpoints()
+    return endpoints
+
+
+def _reconcile_cleanup(container_id):
+    """
+    Clean up an orphaned container, as a cleanup request for it would.
+    """
+    with _locked([("container", container_id)]):
+        _cleanup(HOSTNAME, container_id)
+        _forget_response(container_id)
 
 
 def _error_message(msg=None):
@@ -587,23 +1769,186 @@ class IsolatorException(Exception):
     pass
 
 
-
-if __name__ == '__main__':
-    _setup_logging(LOGFILE)
+def handle_request(stdin_raw_data):
+    """
+    Process a raw request, converting any failure into an error response.
+    :return: Tuple of (exit code, response string).
+    """
     try:
-        response = calico_mesos()
+        response = process_request(stdin_raw_data)
     except IsolatorException as e:
         _log.error(e)
-        sys.stdout.write(_error_message(str(e)))
-        sys.exit(1)
+        return 1, _error_message(str(e))
     except Exception as e:
         _log.error(e)
-        sys.stdout.write(_error_message("Unhandled error %s\n%s" %
-                         (str(e), traceback.format_exc())))
-        sys.exit(1)
+        return 1, _error_message("Unhandled error %s\n%s" %
+                                 (str(e), traceback.format_exc()))
     else:
         if response == None:
             response = _error_message(None)
-        _log.info("Request completed with response: %s" % response)
-        sys.stdout.write(response)
+        _log.info("Request completed with response: %s", _payload(response))
+        return 0, response
+
+
+def _rebuild_endpoint_index():
+    """
+    Rebuild the endpoint index from this host's endpoints in the datastore.
+    If that fails, the index is left incomplete, so that it is backed by the
+    datastore.
+    """
+    try:
+        _endpoint_index.rebuild(
+            lambda: datastore.get_endpoints(hostname=HOSTNAME,
+                                            orchestrator_id=ORCHESTRATOR_ID))
+    except Exception as e:
+        _log.warning("Could not rebuild endpoint index: %s", e)
+
+
+# Background tasks which only run in the daemon.
+_resident_services = []
+
+
+def _start_resident_services():
+    """
+    Start the daemon's background tasks, once it is accepting requests.
+    """
+    global _ip_reservoir, _veth_pool, _cleanup_worker, \
+        _allocation_coalescer, _datastore_mirror
+    if ETCD_HEALTH_INTERVAL > 0:
+        import etcd_pool
+        client = datastore.get_client()
+        checker = etcd_pool.HealthChecker(
+            datastore.pool, client.etcd_client.base_uri + "/version",
+            ETCD_HEALTH_INTERVAL)
+        checker.start()
+        _resident_services.append(checker)
+
+    if DATASTORE_MIRROR:
+        from datastore_mirror import DatastoreMirror
+        mirror = DatastoreMirror(datastore.etcd_client, HOSTNAME,
+                                 ORCHESTRATOR_ID)
+        mirror.start()
+        _resident_services.append(mirror)
+        _datastore_mirror = mirror
+
+    if any(high for _, high in RESERVOIR_WATERMARKS.values()):
+        from ip_reservoir import IPReservoir
+        reservoir = IPReservoir(datastore, HOSTNAME, RESERVOIR_WATERMARKS)
+        reservoir.start()
+        _resident_services.append(reservoir)
+        _ip_reservoir = reservoir
+
+    if ALLOCATE_COALESCE_WINDOW > 0:
+        from coalescer import AllocationCoalescer
+        _allocation_coalescer = AllocationCoalescer(
+            datastore, HOSTNAME, ALLOCATE_COALESCE_WINDOW)
+
+    if PROMETHEUS_FILE:
+        saver = PeriodicSaver(_histograms, METRICS_STATE_FILE,
+                              PROMETHEUS_FILE, METRICS_SAVE_INTERVAL)
+        saver.start()
+        _resident_services.append(saver)
+
+    if VETH_POOL_SIZE > 0:
+        from veth_pool import VethPool
+        pool = VethPool(VETH_POOL_SIZE)
+        pool.start()
+        _resident_services.append(pool)
+        _veth_pool = pool
+
+    if DEFERRED_CLEANUP:
+        from cleanup_journal import CleanupJournal, CleanupWorker
+        worker = CleanupWorker(CleanupJournal(CLEANUP_JOURNAL),
+                               _deferred_cleanup,
+                               batch_size=CLEANUP_BATCH_SIZE)
+        worker.start()
+        _resident_services.append(worker)
+        _cleanup_worker = worker
+
+    if AGENT_URL and RECONCILE_INTERVAL > 0:
+        from reconciler import PeriodicReconciler, fetch_agent_containers
+        reconciler = PeriodicReconciler(
+            _reconciler(), lambda: fetch_agent_containers(AGENT_URL),
+            RECONCILE_INTERVAL)
+        reconciler.start()
+        _resident_services.append(reconciler)
+
+
+def _stop_resident_services():
+    """
+    Stop the daemon's background tasks, in the reverse order of starting.
+    """
+    global _ip_reservoir, _veth_pool, _cleanup_worker, \
+        _allocation_coalescer, _datastore_mirror
+    _ip_reservoir = None
+    _allocation_coalescer = None
+    _datastore_mirror = None
+    _veth_pool = None
+    _cleanup_worker = None
+    while _resident_services:
+        _resident_services.pop().stop()
+
+
+def _open_request_state(resident=False):
+    """
+    Set up the local state which only the CLI and the daemon keep.
+
+    :param resident: True in the daemon, which flushes handle records to
+    disk.  The one-shot CLI leaves that to the OS, to keep its requests fast.
+    """
+    global _response_cache, _handle_records
+    _handle_records = HandleRecords(HANDLE_RECORDS_DIR, sync=resident)
+    if RESPONSE_CACHE_TTL > 0:
+        _response_cache = ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTL,
+                                        RESPONSE_CACHE_SIZE)
+
+
+def _run_daemon():
+    """
+    Serve requests from calico_mesos_client until terminated, keeping the
+    module, datastore client and host facts loaded between requests.
+    """
+    import isolator_daemon
+    _log.info("Starting isolator daemon on host %s", HOSTNAME)
+    # Leave a running daemon its socket, rather than taking it over and
+    # leaving that daemon unreachable.
+    try:
+        isolator_daemon.remove_stale_socket(SOCKET_PATH)
+    except isolator_daemon.DaemonRunning as e:
+        _log.error(e)
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    # Pay for the pycalico imports and datastore client up front, rather than
+    # on the first request.
+    datastore.get_client()
+    _host_addresses.get()
+    import netaddr
+    import pycalico.netns
+    import pycalico.datastore
+    import pycalico.block
+    _rebuild_endpoint_index()
+    _open_request_state(resident=True)
+    isolator_daemon.serve(SOCKET_PATH, handle_request,
+                          on_start=_start_resident_services,
+                          on_stop=_stop_resident_services)
+
+
+if __name__ == '__main__':
+    _setup_logging(LOGFILE)
+    if sys.argv[1:] == ["daemon"]:
+        _run_daemon()
         sys.exit(0)
+    _profile_cache.path = PROFILE_CACHE_FILE
+    _open_request_state()
+    exit_code, response = handle_request(sys.stdin.read())
+    try:
+        _profile_cache.save()
+    except (IOError, OSError) as e:
+        _log.warning("Could not save profile cache: %s", e)
+    if PROMETHEUS_FILE:
+        try:
+            _histograms.save(METRICS_STATE_FILE, PROMETHEUS_FILE)
+        except (IOError, OSError) as e:
+            _log.warning("Could not save metrics: %s", e)
+    sys.stdout.write(response)
+    sys.exit(exit_code)
@@ -0,0 +1,102 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Thin client for the resident isolator daemon.
+
+Speaks the same stdin/stdout JSON contract as calico_mesos.py so that
+net-modules can point at this binary instead.  Deliberately imports nothing
+beyond the standard library modules it needs, so that start-up is cheap.  If
+the daemon is not running, the request is handed to the full calico_mesos
+binary instead.
+"""
+import os
+import sys
+import json
+import socket
+
+SOCKET_PATH = os.environ.get("CALICO_MESOS_SOCKET",
+                             "/var/run/calico/isolator.sock")
+ISOLATOR_PATH = os.environ.get(
+    "CALICO_MESOS_ISOLATOR",
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                 "calico_mesos"))
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+def send_request(raw_request, socket_path=SOCKET_PATH):
+    """
+    Forward a raw request to the daemon.
+
+    :return: Tuple of (exit code, response string).
+    :raises DaemonUnavailable: if the daemon cannot be reached.  The request
+    has not been seen by the daemon in this case, so it is safe to retry it
+    elsewhere.
+    :raises socket.error: if the connection fails once the request is sent.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error as e:
+            raise DaemonUnavailable(str(e))
+        sock.sendall(raw_request)
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+
+    exit_code, _, response = "".join(chunks).partition("\n")
+    try:
+        return int(exit_code), response
+    except ValueError:
+        raise socket.error("Malformed response from isolator daemon")
+
+
+def run_isolator(raw_request, isolator_path=ISOLATOR_PATH):
+    """
+    Run the request through a one-shot calico_mesos process.
+    :return: Tuple of (exit code, response string).
+    """
+    import subprocess
+    process = subprocess.Popen([isolator_path],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    response, _ = process.communicate(raw_request)
+    return process.returncode, response
+
+
+def main():
+    raw_request = sys.stdin.read()
+    try:
+        exit_code, response = send_request(raw_request)
+    except DaemonUnavailable:
+        # No daemon; fall back to the one-shot isolator.
+        exit_code, response = run_isolator(raw_request)
+    except socket.error as e:
+        exit_code = 1
+        response = json.dumps({"error": "Isolator daemon error: %s" % e})
+    sys.stdout.write(response)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Durable queue of deferred cleanups.
+
+The journal is an append-only file with one JSON object per line, recording
+that a container's cleanup was queued ("add"), that an attempt at it failed
+("failed"), or that it completed ("done").  Each line is flushed to disk
+before the append returns, so queued work survives a crash.  A line torn by a
+crash is skipped when the journal is read.  Once most of the lines are for
+finished cleanups, the journal is rewritten with just the pending ones.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import statefile
+
+_log = logging.getLogger("CALICOMESOS")
+
+# Rewrite the journal once it has this many lines more than twice the
+# number of pending cleanups.
+COMPACT_SLACK = 100
+
+
+class CleanupJournal(object):
+    """
+    The journal file at path.  Safe to use from several threads and
+    processes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def add(self, container_id, endpoint):
+        """
+        Queue the cleanup of a container.
+        :param endpoint: The container's endpoint, as an endpoint_record.
+        """
+        self._append({"op": "add", "container_id": container_id,
+                      "endpoint": endpoint, "queued_at": time.time()})
+
+    def fail(self, container_id, error):
+        self._append({"op": "failed", "container_id": container_id,
+                      "error": error, "time": time.time()})
+
+    def done(self, container_id):
+        self._append({"op": "done", "container_id": container_id})
+
+    def pending(self):
+        """
+        :return: List of the pending cleanups, oldest first, as dictionaries
+        with keys container_id, endpoint, queued_at, attempts, last_error and
+        last_attempt.
+        """
+        return self._read()[0].values()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the pending cleanups, if it has grown
+        well beyond them.
+        """
+        with self._lock, statefile.locked(self.path):
+            entries, lines = self._read()
+            if lines <= 2 * len(entries) + COMPACT_SLACK:
+                return
+            statefile.atomic_write(self.path, "".join(
+                json.dumps(dict(entry, op="add")) + "\n"
+                for entry in entries.values()), sync=True)
+
+    def _append(self, line):
+        data = json.dumps(line) + "\n"
+        with self._lock, statefile.locked(self.path):
+            with open(self.path, "a+") as journal:
+                # Start a new line after any line torn by a crash, so that
+                # only the torn line is lost.
+                journal.seek(0, os.SEEK_END)
+                if journal.tell():
+                    journal.seek(-1, os.SEEK_END)
+                    if journal.read(1) != "\n":
+                        data = "\n" + data
+                journal.write(data)
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def _read(self):
+        """
+        :return: Tuple of (OrderedDict of container ID to pending cleanup,
+        number of lines in the journal).
+        """
+        entries = OrderedDict()
+        lines = 0
+        try:
+            journal = open(self.path)
+        except IOError:
+            return entries, lines
+        with journal:
+            for line in journal:
+                lines += 1
+                try:
+                    line = json.loads(line)
+                    op = line.pop("op")
+                    container_id = line["container_id"]
+                except (ValueError, KeyError):
+                    continue
+                if op == "add":
+                    entry = {"attempts": 0, "last_error": None,
+                             "last_attempt": None}
+                    entry.update(line)
+                    entries.setdefault(container_id, entry)
+                elif op == "failed" and container_id in entries:
+                    entry = entries[container_id]
+                    entry["attempts"] += 1
+                    entry["last_error"] = line["error"]
+                    entry["last_attempt"] = line["time"]
+                elif op == "done":
+                    entries.pop(container_id, None)
+        return entries, lines
+
+
+class CleanupWorker(object):
+    """
+    Drains a CleanupJournal, passing each pending cleanup to process.  A
+    cleanup which fails is retried after retry_delay seconds, doubling with
+    each failure up to max_retry_delay.
+
+    :param journal: The CleanupJournal.
+    :param process: Function taking a pending cleanup, as returned by
+    CleanupJournal.pending, which completes it.
+    :param interval: Seconds between drains, in addition to the drains made
+    whenever a cleanup is queued.
+    :param batch_size: Most cleanups processed by one drain.
+    """
+    def __init__(self, journal, process, interval=5, batch_size=20,
+                 retry_delay=10, max_retry_delay=600):
+        self.journal = journal
+        self.process = process
+        self.interval = interval
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._drain_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start draining in the background, beginning with any cleanups left
+        queued by a previous run.
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop draining.  Cleanups still queued stay in the journal.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def add(self, container_id, endpoint):
+        self.journal.add(container_id, endpoint)
+        self._wakeup.set()
+
+    def status(self):
+        """
+        :return: Dictionary of the number of pending cleanups, and a summary
+        of each of them.
+        """
+        entries = [dict((key, entry[key]) for key in
+                        ("container_id", "queued_at", "attempts",
+                         "last_error"))
+                   for entry in self.journal.pending()]
+        return {"pending": len(entries), "entries": entries}
+
+    def drain(self, batch_size=None, retry_all=False):
+        """
+        Process the pending cleanups which are due.
+
+        :param batch_size: Most cleanups to process, or None for all.
+        :param retry_all: If True, failed cleanups are retried now rather
+        than when their retry delay has passed.
+        :return: Dictionary of the numbers of cleanups completed and failed.
+        """
+        result = {"completed": 0, "failed": 0}
+        # Only one drain at a time, across processes, so that no cleanup is
+        # processed twice at once.
+        with self._drain_lock, \
+                statefile.locked(self.journal.path + ".drain"):
+            now = time.time()
+            due = [entry for entry in self.journal.pending()
+                   if retry_all or self._due(entry, now)]
+            for entry in due[:batch_size]:
+                try:
+                    self.process(entry)
+                except Exception as e:
+                    _log.warning("Deferred cleanup of container %s failed: "
+                                 "%s", entry["container_id"], e)
+                    self.journal.fail(entry["container_id"], str(e))
+                    result["failed"] += 1
+                else:
+                    self.journal.done(entry["container_id"])
+                    result["completed"] += 1
+            self.journal.compact()
+        return result
+
+    def _due(self, entry, now):
+        if not entry["attempts"]:
+            return True
+        delay = min(self.retry_delay * 2 ** (entry["attempts"] - 1),
+                    self.max_retry_delay)
+        return now - entry["last_attempt"] >= delay
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            full_batch = False
+            try:
+                result = self.drain(self.batch_size)
+                full_batch = (result["completed"] + result["failed"] ==
+                              self.batch_size)
+            except Exception:
+                _log.exception("Couldn't drain the cleanup journal")
+            # Go straight on to the next batch if there may be one.
+            if not full_batch:
+                self._wakeup.wait(self.interval)
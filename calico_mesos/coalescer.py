@@ -0,0 +1,200 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Coalescing of concurrent allocate requests.
+
+Each auto_assign_ips call reads and compare-and-swaps one of this host's
+blocks, so a burst of allocations contends on the same block, and most of
+them retry.  Instead, the first allocation to arrive waits for a short
+window, then assigns addresses for every allocation that arrived meanwhile,
+each to its own handle, with one compare-and-swap per block.  Whatever the
+host's blocks cannot supply is assigned by individual auto_assign_ips calls.
+"""
+import sys
+import time
+import logging
+import threading
+
+from pycalico.ipam import CASError
+
+from parallel import run_parallel, check_results
+
+_log = logging.getLogger("CALICOMESOS")
+
+RETRIES = 100
+
+
+class _Allocation(object):
+    def __init__(self, num_ipv4, num_ipv6, handle_id):
+        self.wanted = {4: num_ipv4, 6: num_ipv6}
+        self.handle_id = handle_id
+        self.assigned = {4: [], 6: []}
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def needed(self, version):
+        return self.wanted[version] - len(self.assigned[version])
+
+
+class AllocationCoalescer(object):
+    """
+    Merges allocations made within window seconds of each other.
+
+    :param client: The IPAMClient.
+    :param hostname: This host, whose affine blocks the addresses come from.
+    :param window: Seconds the first allocation of a batch waits for others.
+    """
+    def __init__(self, client, hostname, window):
+        self.client = client
+        self.hostname = hostname
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = []
+        self._counters = {"batches": 0, "allocations": 0, "cas_conflicts": 0,
+                          "fallbacks": 0}
+
+    def allocate(self, num_ipv4, num_ipv6, handle_id):
+        """
+        Assign addresses to handle_id, as auto_assign_ips does.
+        :return: Tuple of (list of IPv4 addresses, list of IPv6 addresses).
+        """
+        allocation = _Allocation(num_ipv4, num_ipv6, handle_id)
+        with self._lock:
+            self._pending.append(allocation)
+            leader = len(self._pending) == 1
+        if leader:
+            # Assign the batch in this request's thread.
+            time.sleep(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._counters["batches"] += 1
+                self._counters["allocations"] += len(batch)
+            self._assign(batch)
+        else:
+            allocation.done.wait()
+        if allocation.exc_info:
+            raise allocation.exc_info[0], allocation.exc_info[1], \
+                allocation.exc_info[2]
+        return allocation.assigned[4], allocation.assigned[6]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _assign(self, batch):
+        try:
+            for version in (4, 6):
+                if any(allocation.needed(version) for allocation in batch):
+                    try:
+                        self._assign_from_blocks(batch, version)
+                    except Exception:
+                        # The rest are assigned individually.
+                        _log.exception("Couldn't assign IPv%d addresses from "
+                                       "this host's blocks", version)
+            run_parallel(self._assign_individually, batch, len(batch))
+        finally:
+            for allocation in batch:
+                allocation.done.set()
+
+    def _assign_from_blocks(self, batch, version):
+        """
+        Assign addresses from this host's blocks to each allocation in turn,
+        with one compare-and-swap per block.
+        """
+        for block_cidr in self.client._get_affine_blocks(self.hostname,
+                                                         version, None):
+            if not any(allocation.needed(version) for allocation in batch):
+                return
+            for _ in xrange(RETRIES):
+                try:
+                    block = self.client._read_block(block_cidr)
+                except KeyError:
+                    # Released since it was listed.
+                    break
+                unconfirmed = []
+                for allocation in batch:
+                    needed = allocation.needed(version)
+                    if needed:
+                        addresses = block.auto_assign(
+                            needed, allocation.handle_id, {},
+                            affinity_check=False)
+                        if addresses:
+                            unconfirmed.append((allocation, addresses))
+                if not unconfirmed:
+                    # The block is full.
+                    break
+
+                # Each handle must count its addresses before the block
+                # refers to them, as in IPAMClient.assign_ip.  The handles
+                # are distinct, so are updated concurrently.
+                results = self._update_handles(
+                    self.client._increment_handle, block_cidr, unconfirmed)
+                incremented = [item for item, (_, exc_info) in
+                               zip(unconfirmed, results) if not exc_info]
+                try:
+                    check_results(results)
+                    self.client._compare_and_swap_block(block)
+                except CASError:
+                    with self._lock:
+                        self._counters["cas_conflicts"] += 1
+                    self._update_handles(self.client._decrement_handle,
+                                         block_cidr, incremented)
+                    continue
+                except Exception:
+                    self._update_handles(self.client._decrement_handle,
+                                         block_cidr, incremented)
+                    raise
+                for allocation, addresses in unconfirmed:
+                    allocation.assigned[version].extend(addresses)
+                break
+
+    def _update_handles(self, update, block_cidr, assignments):
+        """
+        Call update(handle ID, block_cidr, count) for each of a list of
+        (allocation, addresses).
+        :return: The results, as returned by run_parallel.
+        """
+        return run_parallel(
+            lambda (allocation, addresses): update(allocation.handle_id,
+                                                   block_cidr,
+                                                   len(addresses)),
+            assignments, len(assignments))
+
+    def _assign_individually(self, allocation):
+        """
+        Assign whatever the host's blocks could not supply with
+        auto_assign_ips.  If that fails, the allocation's addresses are
+        released, and it fails with the error.
+        """
+        num_ipv4, num_ipv6 = allocation.needed(4), allocation.needed(6)
+        if not num_ipv4 and not num_ipv6:
+            return
+        with self._lock:
+            self._counters["fallbacks"] += 1
+        try:
+            ipv4, ipv6 = self.client.auto_assign_ips(
+                num_ipv4, num_ipv6, allocation.handle_id, {},
+                hostname=self.hostname)
+        except Exception:
+            allocation.exc_info = sys.exc_info()
+            assigned = allocation.assigned[4] + allocation.assigned[6]
+            if assigned:
+                try:
+                    self.client.release_ips(set(assigned))
+                except Exception as e:
+                    _log.error("Couldn't release addresses %s of failed "
+                               "allocation: %s", assigned, e)
+            return
+        allocation.assigned[4].extend(ipv4)
+        allocation.assigned[6].extend(ipv6)
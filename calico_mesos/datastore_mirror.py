@@ -0,0 +1,385 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-memory mirror of the datastore state which requests read: this host's
+endpoints, the names of the profiles, and the IP pools.
+
+Each is loaded by one recursive read, then kept up to date by an etcd watch
+from the index of that read.  If etcd has discarded events the watch has not
+yet seen, or the watch fails, that part of the mirror is out of sync until it
+has been read again.  Meanwhile its reads return None, and callers ask the
+datastore instead.
+"""
+import json
+import time
+import logging
+import threading
+
+from etcd import EtcdKeyNotFound, EtcdEventIndexCleared
+
+from endpoint_index import endpoint_record, endpoint_from_record
+
+_log = logging.getLogger("CALICOMESOS")
+
+# Seconds each watch request waits for an event before it is reissued.
+WATCH_TIMEOUT = 60
+DELETE_ACTIONS = frozenset(["delete", "expire", "compareAndDelete"])
+
+
+class EndpointRecord(object):
+    """
+    The details of an endpoint, in much less memory than a pycalico Endpoint.
+    """
+    __slots__ = ("workload_id", "endpoint_id", "state", "mac", "ipv4_nets",
+                 "ipv6_nets", "profile_ids")
+
+    def __init__(self, workload_id, endpoint_id, state, mac, ipv4_nets,
+                 ipv6_nets, profile_ids):
+        self.workload_id = workload_id
+        self.endpoint_id = endpoint_id
+        self.state = state
+        self.mac = mac
+        self.ipv4_nets = tuple(ipv4_nets)
+        self.ipv6_nets = tuple(ipv6_nets)
+        self.profile_ids = tuple(profile_ids)
+
+    @classmethod
+    def from_json(cls, workload_id, endpoint_id, json_str):
+        data = json.loads(json_str)
+        return cls(workload_id, endpoint_id, data.get("state"),
+                   data.get("mac"), data.get("ipv4_nets", ()),
+                   data.get("ipv6_nets", ()), data.get("profile_ids", ()))
+
+    @classmethod
+    def from_endpoint(cls, endpoint):
+        record = endpoint_record(endpoint)
+        return cls(endpoint.workload_id, endpoint.endpoint_id,
+                   record["state"], record["mac"], record["ipv4_nets"],
+                   record["ipv6_nets"], record["profile_ids"])
+
+    def to_endpoint(self, hostname, orchestrator_id):
+        return endpoint_from_record({
+            "hostname": hostname, "orchestrator_id": orchestrator_id,
+            "workload_id": self.workload_id, "endpoint_id": self.endpoint_id,
+            "state": self.state, "mac": self.mac,
+            "ipv4_nets": self.ipv4_nets, "ipv6_nets": self.ipv6_nets,
+            "profile_ids": list(self.profile_ids)})
+
+
+class _Subtree(object):
+    """
+    The mirror of one etcd directory.  Subclasses hold the data, which
+    apply() updates for one watch event, or one key of a full read.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.synced = False
+        # The etcd index from which to watch.
+        self.index = None
+
+    def path(self, key):
+        """
+        :return: The components of key below the prefix, which are none if
+        key is the directory itself.
+        """
+        relative = key[len(self.prefix):] if key.startswith(self.prefix) \
+            else ""
+        return [part for part in relative.split("/") if part]
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def apply(self, action, key, value):
+        raise NotImplementedError()
+
+    def loaded(self, keys):
+        """
+        Called once a full read has been applied, with the keys it returned.
+        """
+        pass
+
+
+class _Endpoints(_Subtree):
+    """
+    Endpoints by workload ID and endpoint ID, from keys of the form
+    <workload_id>/endpoint/<endpoint_id>.
+
+    Workloads this host has removed are kept as tombstones until the watch
+    reports their deletion, or a full read no longer finds them.  Until then,
+    events and reads for them predate the removal, so are ignored.
+    """
+    def __init__(self, prefix):
+        super(_Endpoints, self).__init__(prefix)
+        self.removed = set()
+
+    def clear(self):
+        self.workloads = {}
+
+    def __len__(self):
+        return sum(len(endpoints) for endpoints in self.workloads.values())
+
+    def apply(self, action, key, value):
+        path = self.path(key)
+        if path and path[0] in self.removed:
+            if action not in DELETE_ACTIONS:
+                return
+            if len(path) == 1:
+                # The removal itself.
+                self.removed.discard(path[0])
+        elif not path and action in DELETE_ACTIONS:
+            self.removed.clear()
+        if action in DELETE_ACTIONS:
+            if not path:
+                self.clear()
+            elif len(path) < 3:
+                self.workloads.pop(path[0], None)
+            else:
+                self.workloads.get(path[0], {}).pop(path[2], None)
+                if not self.workloads.get(path[0], True):
+                    del self.workloads[path[0]]
+        elif len(path) == 3 and path[1] == "endpoint" and value:
+            self.add(EndpointRecord.from_json(path[0], path[2], value))
+
+    def loaded(self, keys):
+        self.removed.intersection_update(
+            self.path(key)[0] for key in keys if self.path(key))
+
+    def add(self, record):
+        self.workloads.setdefault(record.workload_id, {})[
+            record.endpoint_id] = record
+
+
+class _Profiles(_Subtree):
+    """
+    Names of the profiles, each of which exists once its rules key does.
+    """
+    def clear(self):
+        self.names = set()
+
+    def __len__(self):
+        return len(self.names)
+
+    def apply(self, action, key, value):
+        path = self.path(key)
+        if action in DELETE_ACTIONS:
+            if not path:
+                self.clear()
+            elif len(path) == 1 or path[1] == "rules":
+                self.names.discard(path[0])
+        elif len(path) == 2 and path[1] == "rules":
+            self.names.add(path[0])
+
+
+class _Pools(_Subtree):
+    """
+    IPPools of one IP version, by key.
+    """
+    def clear(self):
+        self.pools = {}
+
+    def __len__(self):
+        return len(self.pools)
+
+    def apply(self, action, key, value):
+        from pycalico.datastore_datatypes import IPPool
+        path = self.path(key)
+        if action in DELETE_ACTIONS:
+            if not path:
+                self.clear()
+            else:
+                self.pools.pop(path[0], None)
+        elif len(path) == 1 and value:
+            self.pools[path[0]] = IPPool.from_json(value)
+
+
+class DatastoreMirror(object):
+    """
+    Keeps the mirror in sync, with one watch thread per etcd directory.  Each
+    thread holds one etcd connection while it waits for events.
+
+    :param client: The etcd client.
+    :param hostname: This host, whose endpoints are mirrored.
+    :param orchestrator_id: The orchestrator whose endpoints are mirrored.
+    :param retry_delay: Seconds to wait before reading a directory again
+    after a failure.
+    """
+    def __init__(self, client, hostname, orchestrator_id, retry_delay=5):
+        from pycalico.datastore import ORCHESTRATOR_PATH, PROFILES_PATH, \
+            IP_POOLS_PATH
+        self.client = client
+        self.hostname = hostname
+        self.orchestrator_id = orchestrator_id
+        self.retry_delay = retry_delay
+        self._endpoints = _Endpoints(ORCHESTRATOR_PATH % {
+            "hostname": hostname, "orchestrator_id": orchestrator_id})
+        self._profiles = _Profiles(PROFILES_PATH)
+        self._pools = dict((version,
+                            _Pools(IP_POOLS_PATH % {"version": version}))
+                           for version in (4, 6))
+        self._subtrees = [self._endpoints, self._profiles, self._pools[4],
+                          self._pools[6]]
+        for subtree in self._subtrees:
+            subtree.clear()
+        self._lock = threading.Lock()
+        self._counters = {"resyncs": 0, "events": 0, "watch_failures": 0}
+        self._stopping = threading.Event()
+
+    def start(self):
+        for subtree in self._subtrees:
+            thread = threading.Thread(target=self._run, args=(subtree,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """
+        Stop following the datastore.  Watches in progress are abandoned,
+        rather than waited for.
+        """
+        self._stopping.set()
+        with self._lock:
+            for subtree in self._subtrees:
+                subtree.synced = False
+
+    def get_endpoints(self, workload_id=None):
+        """
+        :return: List of this host's Endpoints, only those of workload_id if
+        it is given, or None if the mirror is out of sync.
+        """
+        with self._lock:
+            if not self._endpoints.synced:
+                return None
+            if workload_id is None:
+                records = [record for endpoints in
+                           self._endpoints.workloads.values()
+                           for record in endpoints.values()]
+            else:
+                records = self._endpoints.workloads.get(workload_id,
+                                                        {}).values()
+        return [record.to_endpoint(self.hostname, self.orchestrator_id)
+                for record in records]
+
+    def profile_exists(self, name):
+        """
+        :return: Whether the profile exists, or None if the mirror is out of
+        sync.
+        """
+        with self._lock:
+            if not self._profiles.synced:
+                return None
+            return name in self._profiles.names
+
+    def get_ip_pools(self, version):
+        """
+        :return: List of the IPPools of the given IP version, or None if the
+        mirror is out of sync.
+        """
+        with self._lock:
+            if not self._pools[version].synced:
+                return None
+            return self._pools[version].pools.values()
+
+    def endpoint_written(self, endpoint):
+        """
+        Record an endpoint this host has written, without waiting for the
+        watch to report it.
+        """
+        with self._lock:
+            self._endpoints.removed.discard(endpoint.workload_id)
+            self._endpoints.add(EndpointRecord.from_endpoint(endpoint))
+
+    def workload_removed(self, workload_id):
+        """
+        Forget a workload this host has removed, without waiting for the
+        watch to report it.  Events from before the removal which the watch
+        has yet to report do not bring it back.
+        """
+        with self._lock:
+            self._endpoints.workloads.pop(workload_id, None)
+            self._endpoints.removed.add(workload_id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["synced"] = all(subtree.synced
+                                  for subtree in self._subtrees)
+            stats["endpoints"] = len(self._endpoints)
+            stats["profiles"] = len(self._profiles)
+            stats["ip_pools"] = sum(len(pools)
+                                    for pools in self._pools.values())
+            return stats
+
+    def _run(self, subtree):
+        while not self._stopping.is_set():
+            try:
+                if not subtree.synced:
+                    self._resync(subtree)
+                self._watch(subtree)
+            except EtcdEventIndexCleared:
+                _log.info("Missed events under %s, reading it again",
+                          subtree.prefix)
+                with self._lock:
+                    subtree.synced = False
+            except Exception:
+                _log.exception("Lost sync with %s", subtree.prefix)
+                with self._lock:
+                    subtree.synced = False
+                    self._counters["watch_failures"] += 1
+                self._stopping.wait(self.retry_delay)
+
+    def _resync(self, subtree):
+        """
+        Replace the subtree's data with a full read of its directory.
+        """
+        try:
+            result = self.client.read(subtree.prefix, recursive=True)
+            leaves = [leaf for leaf in result.leaves if not leaf.dir]
+            index = result.etcd_index
+        except EtcdKeyNotFound as e:
+            # Nothing has been written there yet.  The error carries the
+            # index to watch from.
+            leaves = []
+            index = (getattr(e, "payload", None) or {}).get("index")
+            if index is None:
+                raise
+        with self._lock:
+            subtree.clear()
+            for leaf in leaves:
+                subtree.apply("get", leaf.key, leaf.value)
+            subtree.loaded([leaf.key for leaf in leaves])
+            subtree.index = index + 1
+            subtree.synced = not self._stopping.is_set()
+            self._counters["resyncs"] += 1
+        _log.info("Mirrored %d keys under %s", len(leaves), subtree.prefix)
+
+    def _watch(self, subtree):
+        """
+        Wait for the next change under the subtree's directory, and apply
+        it.
+        """
+        start = time.time()
+        try:
+            result = self.client.read(subtree.prefix, recursive=True,
+                                      wait=True, waitIndex=subtree.index,
+                                      timeout=WATCH_TIMEOUT)
+        except EtcdEventIndexCleared:
+            raise
+        except Exception:
+            if time.time() - start >= WATCH_TIMEOUT:
+                # No changes.
+                return
+            raise
+        with self._lock:
+            subtree.apply(result.action, result.key, result.value)
+            subtree.index = result.modifiedIndex + 1
+            self._counters["events"] += 1
@@ -0,0 +1,131 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Durable local index of the endpoints this host has created, by container ID.
+"""
+import os
+import json
+
+import statefile
+
+SYNCED_MARKER = ".synced"
+
+
+class EndpointIndex(object):
+    """
+    Keeps one file per container, holding the details of its endpoint.
+    Files are written with fsync before the endpoint is written to the
+    datastore, and removed only after the endpoint has been removed, so after
+    a crash the index may list endpoints the datastore lacks, but not the
+    reverse.
+
+    The index only covers every endpoint once it has been rebuilt from the
+    datastore, which is recorded by a marker file.  Until then, a container
+    missing from the index may still have an endpoint.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, container_id):
+        """
+        :return: Dictionary of the container's endpoint details, or None.
+        """
+        return statefile.read_json(self._path(container_id))
+
+    def endpoints(self):
+        """
+        :return: List of the indexed endpoints, as pycalico Endpoints.
+        """
+        endpoints = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith("."):
+                continue
+            record = statefile.read_json(os.path.join(self.directory,
+                                                      filename))
+            if record is not None:
+                endpoints.append(endpoint_from_record(record))
+        return endpoints
+
+    def add(self, container_id, endpoint):
+        with statefile.locked(self._marker_path()):
+            statefile.atomic_write(self._path(container_id),
+                                   json.dumps(endpoint_record(endpoint)),
+                                   sync=True)
+
+    def remove(self, container_id):
+        with statefile.locked(self._marker_path()):
+            statefile.remove(self._path(container_id), sync=True)
+
+    def is_complete(self):
+        """
+        :return: True if every endpoint this host has is in the index.
+        """
+        return os.path.exists(self._marker_path())
+
+    def rebuild(self, list_endpoints):
+        """
+        Replace the index with the endpoints returned by list_endpoints(), and
+        mark it complete.  The index is locked while the endpoints are listed,
+        so that no endpoint is added or removed meanwhile.
+        """
+        with statefile.locked(self._marker_path()):
+            statefile.remove(self._marker_path(), sync=True)
+            endpoints = dict((endpoint.workload_id, endpoint)
+                             for endpoint in list_endpoints())
+            for filename in os.listdir(self.directory):
+                if filename.startswith("."):
+                    continue
+                if statefile.unquote(filename) not in endpoints:
+                    os.unlink(os.path.join(self.directory, filename))
+            for container_id, endpoint in endpoints.iteritems():
+                statefile.atomic_write(self._path(container_id),
+                                       json.dumps(endpoint_record(endpoint)),
+                                       sync=True)
+            statefile.atomic_write(self._marker_path(), "", sync=True)
+
+    def _path(self, container_id):
+        return os.path.join(self.directory, statefile.quote(container_id))
+
+    def _marker_path(self):
+        return os.path.join(self.directory, SYNCED_MARKER)
+
+
+def endpoint_record(endpoint):
+    """
+    :return: JSON-serializable dictionary of the endpoint's details.
+    """
+    return {"hostname": endpoint.hostname,
+            "orchestrator_id": endpoint.orchestrator_id,
+            "workload_id": endpoint.workload_id,
+            "endpoint_id": endpoint.endpoint_id,
+            "state": endpoint.state,
+            "mac": endpoint.mac,
+            "ipv4_nets": sorted(str(net) for net in endpoint.ipv4_nets),
+            "ipv6_nets": sorted(str(net) for net in endpoint.ipv6_nets),
+            "profile_ids": endpoint.profile_ids}
+
+
+def endpoint_from_record(record):
+    """
+    :return: The pycalico Endpoint described by a record from the index.
+    """
+    from netaddr import IPNetwork
+    from pycalico.datastore_datatypes import Endpoint
+    endpoint = Endpoint(record["hostname"], record["orchestrator_id"],
+                        record["workload_id"], record["endpoint_id"],
+                        record["state"], record["mac"])
+    endpoint.ipv4_nets = set(IPNetwork(net) for net in record["ipv4_nets"])
+    endpoint.ipv6_nets = set(IPNetwork(net) for net in record["ipv6_nets"])
+    endpoint.profile_ids = record["profile_ids"]
+    return endpoint
@@ -0,0 +1,149 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Keep-alive connection pooling for the etcd client used by the datastore.
+"""
+import time
+import logging
+import threading
+from urllib3 import PoolManager
+
+_log = logging.getLogger("CALICOMESOS")
+
+
+class EtcdPoolManager(PoolManager):
+    """
+    urllib3 PoolManager which keeps up to pool_size keep-alive connections
+    per etcd server, drops them all once they have been idle for
+    idle_timeout seconds, and counts how often connections are reused.
+    """
+    def __init__(self, pool_size, idle_timeout, num_pools=10,
+                 **connection_pool_kw):
+        connection_pool_kw["maxsize"] = pool_size
+        PoolManager.__init__(self, num_pools=num_pools, **connection_pool_kw)
+        self.idle_timeout = idle_timeout
+        self._stats_lock = threading.Lock()
+        self._last_used = time.time()
+        # Counts from pools which have since been discarded.
+        self._closed_connections = 0
+        self._closed_requests = 0
+        self.idle_resets = 0
+        self.health_checks = 0
+        self.health_check_failures = 0
+
+    def urlopen(self, method, url, *args, **kwargs):
+        now = time.time()
+        if self.idle_timeout and now - self._last_used > self.idle_timeout:
+            # The server (or something in between) may well have closed
+            # connections which have been idle this long.
+            _log.debug("etcd connections idle for %ds, dropping them",
+                       now - self._last_used)
+            self.idle_resets += 1
+            self.clear()
+        self._last_used = now
+        return PoolManager.urlopen(self, method, url, *args, **kwargs)
+
+    def clear(self):
+        with self._stats_lock:
+            connections, requests = self._pool_counts()
+            self._closed_connections += connections
+            self._closed_requests += requests
+            PoolManager.clear(self)
+
+    def health_check(self, url):
+        """
+        Issue a GET to url over the pool, keeping a connection warm.  If it
+        fails, drop all connections so that the next request starts afresh.
+
+        :return: True if the check succeeded.
+        """
+        self.health_checks += 1
+        try:
+            response = self.urlopen("GET", url, retries=0, timeout=5)
+            healthy = response.status == 200
+        except Exception as e:
+            _log.warning("etcd health check failed: %s", e)
+            healthy = False
+        if not healthy:
+            self.health_check_failures += 1
+            self.clear()
+        return healthy
+
+    def stats(self):
+        """
+        :return: Dictionary of connection counters.  reuse_rate is the
+        fraction of requests which were sent on an existing connection.
+        """
+        with self._stats_lock:
+            connections, requests = self._pool_counts()
+            connections += self._closed_connections
+            requests += self._closed_requests
+        return {"connections": connections,
+                "requests": requests,
+                "reuse_rate": (1 - float(connections) / requests
+                               if requests else 0.0),
+                "idle_resets": self.idle_resets,
+                "health_checks": self.health_checks,
+                "health_check_failures": self.health_check_failures}
+
+    def _pool_counts(self):
+        connections = requests = 0
+        for key in self.pools.keys():
+            pool = self.pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests += pool.num_requests
+        return connections, requests
+
+
+def install(etcd_client, pool_size, idle_timeout):
+    """
+    Replace the HTTP pool of a python-etcd Client with an EtcdPoolManager,
+    keeping its existing connection settings (timeouts, TLS and so on).
+
+    :return: The EtcdPoolManager.
+    """
+    connection_pool_kw = dict(etcd_client.http.connection_pool_kw)
+    connection_pool_kw.pop("maxsize", None)
+    etcd_client.http = EtcdPoolManager(pool_size, idle_timeout,
+                                       **connection_pool_kw)
+    return etcd_client.http
+
+
+class HealthChecker(object):
+    """
+    Background thread which checks the etcd connection every interval
+    seconds, whenever the pool has not otherwise been used in that time.
+    """
+    def __init__(self, pool, url, interval):
+        self.pool = pool
+        self.url = url
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if time.time() - self.pool._last_used >= self.interval:
+                self.pool.health_check(self.url)
@@ -0,0 +1,86 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Durable local record of the handles this host has assigned addresses to.
+"""
+import os
+import json
+import time
+
+import statefile
+
+
+class HandleRecords(object):
+    """
+    Keeps one file per handle (the uid of an allocate or reserve request),
+    written before any address is assigned to it.  So after a crash, every
+    handle this host may have assigned addresses to is recorded, which lets
+    reconcile release only addresses this host assigned, and lets a retried
+    allocate tell whether an earlier attempt may have assigned addresses.
+
+    Files are only flushed to disk if sync is set.  Otherwise a record
+    survives the process crashing but may not survive the host crashing, in
+    which case the handle's addresses are never released by reconcile, but
+    are not handed out twice either.
+
+    Each record notes whether allocate has assigned addresses to the handle,
+    and the ranges reserve has assigned to it, as [IP version, first, last]
+    lists.
+    """
+    def __init__(self, directory, sync=True):
+        self.directory = directory
+        self.sync = sync
+
+    def get(self, handle_id):
+        """
+        :return: Dictionary of the handle's record, or None.
+        """
+        return statefile.read_json(self._path(handle_id))
+
+    def add(self, handle_id, allocated=False, reserved=()):
+        """
+        Record that addresses are about to be assigned to the handle, by
+        allocate if allocated is set, and by reserve for the given ranges.
+        """
+        record = self.get(handle_id) or {}
+        record["allocated"] = record.get("allocated", False) or allocated
+        record["reserved"] = (record.get("reserved", []) +
+                              [list(entry) for entry in reserved])
+        record["recorded"] = time.time()
+        statefile.atomic_write(self._path(handle_id), json.dumps(record),
+                               sync=self.sync)
+
+    def remove(self, handle_id):
+        statefile.remove(self._path(handle_id), sync=self.sync)
+
+    def recorded(self):
+        """
+        :return: Dictionary of each recorded handle to the time it was last
+        recorded.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return {}
+        handles = {}
+        for name in names:
+            if name.startswith("."):
+                continue
+            record = statefile.read_json(os.path.join(self.directory, name))
+            if record is not None:
+                handles[statefile.unquote(name)] = record.get("recorded", 0)
+        return handles
+
+    def _path(self, handle_id):
+        return os.path.join(self.directory, statefile.quote(handle_id))
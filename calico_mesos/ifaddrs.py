@@ -0,0 +1,175 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reads the host's IPv4 interface addresses from the kernel over rtnetlink,
+rather than forking `ip -4 addr` and scraping its output.
+"""
+import os
+import errno
+import socket
+import struct
+import threading
+
+NETLINK_ROUTE = 0
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+NLM_F_REQUEST = 0x1
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTMGRP_IPV4_IFADDR = 0x10
+IFA_LOCAL = 2
+IFA_LABEL = 3
+
+NLMSGHDR = struct.Struct("=LHHLL")
+IFADDRMSG = struct.Struct("=BBBBi")
+RTATTR = struct.Struct("=HH")
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_addr_messages(data):
+    """
+    Parse a buffer of netlink messages.
+
+    :return: Tuple of (addresses, done) where addresses is a list of
+    (interface label, address string, prefix length) tuples for the
+    RTM_NEWADDR messages in data, and done is True if the buffer ended the
+    dump.
+    """
+    addresses = []
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if msg_len < NLMSGHDR.size:
+            break
+        if msg_type == NLMSG_DONE:
+            return addresses, True
+        if msg_type == NLMSG_ERROR:
+            error, = struct.unpack_from("=i", data, offset + NLMSGHDR.size)
+            raise OSError(-error, os.strerror(-error))
+        if msg_type == RTM_NEWADDR:
+            addresses.extend(_parse_ifaddrmsg(
+                data[offset + NLMSGHDR.size:offset + msg_len]))
+        offset += _align(msg_len)
+    return addresses, False
+
+
+def _parse_ifaddrmsg(payload):
+    family, prefixlen, _, _, _ = IFADDRMSG.unpack_from(payload)
+    if family != socket.AF_INET:
+        return []
+    local = label = None
+    offset = IFADDRMSG.size
+    while offset + RTATTR.size <= len(payload):
+        attr_len, attr_type = RTATTR.unpack_from(payload, offset)
+        if attr_len < RTATTR.size:
+            break
+        value = payload[offset + RTATTR.size:offset + attr_len]
+        if attr_type == IFA_LOCAL:
+            local = socket.inet_ntoa(value)
+        elif attr_type == IFA_LABEL:
+            label = value.rstrip("\0")
+        offset += _align(attr_len)
+    if local is None:
+        return []
+    return [(label, local, prefixlen)]
+
+
+def get_ipv4_addresses():
+    """
+    Dump the host's IPv4 addresses from the kernel.
+
+    :return: List of (interface label, address string, prefix length)
+    tuples, in interface order.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        request = (NLMSGHDR.pack(NLMSGHDR.size + IFADDRMSG.size, RTM_GETADDR,
+                                 NLM_F_REQUEST | NLM_F_DUMP, 1, 0) +
+                   IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0))
+        sock.sendall(request)
+        addresses = []
+        while True:
+            batch, done = parse_addr_messages(sock.recv(65536))
+            addresses.extend(batch)
+            if done:
+                return addresses
+    finally:
+        sock.close()
+
+
+class AddressCache(object):
+    """
+    Caches the host's IPv4 addresses until the kernel reports a change.
+
+    Listens on the rtnetlink IPv4 address multicast group; any queued
+    notification (or lost notifications) invalidates the cache, which is
+    then refreshed on the next call to get().
+    """
+    def __init__(self, reader=get_ipv4_addresses):
+        self._reader = reader
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._addresses = None
+
+    def get(self):
+        with self._lock:
+            if self._monitor is None:
+                # Subscribe before reading, so that no change is missed.
+                self._monitor = self._open_monitor()
+            if self._changed():
+                self._addresses = None
+            if self._addresses is None:
+                self._addresses = self._reader()
+            return self._addresses
+
+    def invalidate(self):
+        with self._lock:
+            self._addresses = None
+
+    def close(self):
+        with self._lock:
+            if self._monitor is not None:
+                self._monitor.close()
+                self._monitor = None
+            self._addresses = None
+
+    def _open_monitor(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_IPV4_IFADDR))
+        sock.setblocking(False)
+        return sock
+
+    def _changed(self):
+        changed = False
+        while True:
+            try:
+                self._monitor.recv(65536)
+            except socket.error as e:
+                if e.errno == errno.ENOBUFS:
+                    # Notifications were dropped.
+                    changed = True
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                raise
+            changed = True
@@ -0,0 +1,192 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Parsing of IP address lists, which may include CIDRs ("10.0.0.0/24") and
+ranges ("10.0.0.10-10.0.0.20"), into sorted, merged ranges of packed
+integers.
+
+Addresses are parsed with inet_pton, falling back to netaddr only for the
+forms inet_pton rejects.  CIDRs and ranges are only expanded into IPAddress
+objects when they are split into allocation blocks.
+"""
+import socket
+import struct
+from collections import OrderedDict
+
+from netaddr import IPAddress, AddrFormatError
+
+_BITS = {4: 32, 6: 128}
+
+
+def _parse_address(text):
+    """
+    :return: Tuple of (IP version, address as an integer), or None if text
+    is not an address.
+    """
+    try:
+        return 4, struct.unpack("!I", socket.inet_pton(socket.AF_INET,
+                                                       text))[0]
+    except (socket.error, TypeError, ValueError):
+        pass
+    try:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6,
+                                                          text))
+        return 6, high << 64 | low
+    except (socket.error, TypeError, ValueError):
+        pass
+    # Forms such as integers, which netaddr has always accepted.
+    try:
+        address = IPAddress(text)
+    except (AddrFormatError, TypeError, ValueError):
+        return None
+    return address.version, int(address)
+
+
+def _parse_range(text):
+    """
+    :return: Tuple of (IP version, first, last) for a CIDR or start-end
+    range, or None if text is not one.
+    """
+    if "/" in text:
+        address, _, prefixlen = text.partition("/")
+        parsed = _parse_address(address)
+        if parsed is None or not prefixlen.isdigit():
+            return None
+        version, first = parsed
+        host_bits = _BITS[version] - int(prefixlen)
+        if host_bits < 0 or first & ((1 << host_bits) - 1):
+            # Out of range prefix length, or host bits set.
+            return None
+        return version, first, first + (1 << host_bits) - 1
+    start, _, end = text.partition("-")
+    start, end = _parse_address(start.strip()), _parse_address(end.strip())
+    if start is None or end is None or start[0] != end[0] or \
+            start[1] > end[1]:
+        return None
+    return start[0], start[1], end[1]
+
+
+def parse(entries, ip_version=None, allow_ranges=True):
+    """
+    Parse a list of addresses, and CIDRs and ranges if allow_ranges is set.
+
+    :param ip_version: If set, every entry must be of this IP version.
+    :return: Tuple of (list of (IP version, first, last) in the order of the
+    entries, list of error messages for the invalid entries).
+    """
+    parsed = []
+    errors = []
+    for entry in entries:
+        is_range = (allow_ranges and isinstance(entry, basestring) and
+                    ("/" in entry or "-" in entry))
+        if is_range:
+            result = _parse_range(entry)
+            if result is None:
+                errors.append("IP range could not be parsed: %s" % entry)
+                continue
+        else:
+            result = _parse_address(entry)
+            if result is None:
+                errors.append("IP address could not be parsed: %s" % entry)
+                continue
+            result = result + (result[1],)
+        if ip_version and result[0] != ip_version:
+            errors.append("IPv%d address must not be placed in IPv%d "
+                          "address field." % (result[0], ip_version))
+            continue
+        parsed.append(result)
+    return parsed, errors
+
+
+class AddressRanges(object):
+    """
+    A set of addresses, held as sorted, disjoint ranges of integers.
+
+    :param ranges: Iterable of (IP version, first, last), which may overlap.
+    """
+    def __init__(self, ranges):
+        self.ranges = []
+        for version, first, last in sorted(ranges):
+            if self.ranges:
+                previous = self.ranges[-1]
+                if previous[0] == version and first <= previous[2] + 1:
+                    self.ranges[-1] = (version, previous[1],
+                                       max(previous[2], last))
+                    continue
+            self.ranges.append((version, first, last))
+
+    def size(self):
+        """
+        :return: The number of addresses.  (len() cannot exceed sys.maxint,
+        which an IPv6 CIDR easily does.)
+        """
+        return sum(last - first + 1 for _, first, last in self.ranges)
+
+    def __len__(self):
+        return self.size()
+
+    def __nonzero__(self):
+        return bool(self.ranges)
+
+    def __contains__(self, address):
+        version, value = address.version, int(address)
+        return any(version == range_version and first <= value <= last
+                   for range_version, first, last in self.ranges)
+
+    def __iter__(self):
+        for version, first, last in self.ranges:
+            for address in _addresses(version, first, last):
+                yield address
+
+    def __eq__(self, other):
+        return isinstance(other, AddressRanges) and \
+            self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return "[%s]" % ", ".join(
+            str(IPAddress(first, version)) if first == last else
+            "%s-%s" % (IPAddress(first, version), IPAddress(last, version))
+            for version, first, last in self.ranges)
+
+    __repr__ = __str__
+
+    def by_block(self):
+        """
+        :return: OrderedDict of allocation block CIDR to the list of
+        addresses in it, as ipam_blocks.group_by_block returns.
+        """
+        from pycalico.block import get_block_cidr_for_address
+        blocks = OrderedDict()
+        for version, first, last in self.ranges:
+            while first <= last:
+                block_cidr = get_block_cidr_for_address(
+                    IPAddress(first, version))
+                end = min(last, int(block_cidr.last))
+                blocks.setdefault(block_cidr, []).extend(
+                    _addresses(version, first, end))
+                first = end + 1
+        return blocks
+
+
+def _addresses(version, first, last):
+    """
+    Yield the IPAddresses from first to last.  (xrange cannot count past
+    sys.maxint, as IPv6 addresses do.)
+    """
+    while first <= last:
+        yield IPAddress(first, version)
+        first += 1
@@ -0,0 +1,204 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reservoir of addresses assigned ahead of time to this host, so that allocate
+requests can be served without waiting for the IPAM to find free addresses.
+"""
+import logging
+import threading
+from collections import deque
+
+from ipam_blocks import group_by_block, rebind_block_addresses, \
+    AssignmentFailed
+
+_log = logging.getLogger("CALICOMESOS")
+
+RESERVOIR_HANDLE = "calico-mesos-reservoir-%s"
+
+
+class IPReservoir(object):
+    """
+    Holds addresses assigned to this host's reservoir handle.  A background
+    thread tops each IP version up to its high watermark whenever it falls to
+    its low watermark.
+
+    :param datastore: The IPAMClient.
+    :param hostname: This host, whose affine blocks the addresses come from.
+    :param watermarks: Dictionary of IP version to (low, high) counts.
+    :param interval: Seconds between checks, in addition to the checks made
+    whenever addresses are taken.
+    """
+    def __init__(self, datastore, hostname, watermarks, interval=10):
+        self.datastore = datastore
+        self.hostname = hostname
+        self.handle_id = RESERVOIR_HANDLE % hostname
+        self.watermarks = watermarks
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._addresses = {4: deque(), 6: deque()}
+        # Number of addresses moved off the reservoir handle in each block,
+        # by which the handle is yet to be decremented.
+        self._moved = {}
+        self._counters = {"hits": 0, "misses": 0, "rebind_failures": 0}
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """
+        Return any addresses left on the reservoir handle by a previous run,
+        then start filling the reservoir in the background.
+        """
+        self._release_handle()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop refilling and return the reservoir's addresses to the IPAM.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            for addresses in self._addresses.values():
+                addresses.clear()
+        self._decrement_moved()
+        self._release_handle()
+
+    def allocate(self, num_ipv4, num_ipv6, handle_id):
+        """
+        Move addresses from the reservoir to handle_id.
+
+        Each block's addresses move with one compare-and-swap, so they are
+        never free to other hosts in between.  Addresses which have left the
+        reservoir handle by other means are replaced by auto-assigned ones.
+        If this fails, the addresses already moved are released.
+
+        :return: Tuple of (IPv4 list, IPv6 list), or None if the reservoir
+        does not hold enough addresses, in which case none are taken.
+        """
+        wanted = {4: num_ipv4, 6: num_ipv6}
+        with self._lock:
+            if any(len(self._addresses[version]) < count
+                   for version, count in wanted.iteritems()):
+                self._counters["misses"] += 1
+                taken = None
+            else:
+                self._counters["hits"] += 1
+                taken = [self._addresses[version].popleft()
+                         for version, count in wanted.iteritems()
+                         for _ in xrange(count)]
+        self._wakeup.set()
+        if taken is None:
+            return None
+        if not taken:
+            return [], []
+
+        assigned = []
+        try:
+            for block_cidr, addresses in group_by_block(taken).iteritems():
+                moved = len(assigned)
+                try:
+                    rebind_block_addresses(self.datastore, block_cidr,
+                                           addresses, self.handle_id,
+                                           handle_id, {}, assigned)
+                except AssignmentFailed as e:
+                    _log.warning("Couldn't rebind reservoir addresses: %s", e)
+                    with self._lock:
+                        self._counters["rebind_failures"] += 1
+                        # Still on the reservoir handle, so keep them.
+                        for address in addresses:
+                            self._addresses[address.version].append(address)
+                    continue
+                with self._lock:
+                    self._moved[block_cidr] = \
+                        self._moved.get(block_cidr, 0) + len(assigned) - moved
+
+            ipv4 = [ip for ip in assigned if ip.version == 4]
+            ipv6 = [ip for ip in assigned if ip.version == 6]
+            if len(ipv4) < num_ipv4 or len(ipv6) < num_ipv6:
+                extra_ipv4, extra_ipv6 = self.datastore.auto_assign_ips(
+                    num_ipv4 - len(ipv4), num_ipv6 - len(ipv6), handle_id, {},
+                    hostname=self.hostname)
+                ipv4.extend(extra_ipv4)
+                ipv6.extend(extra_ipv6)
+        except Exception:
+            if assigned:
+                _log.warning("Releasing %d addresses given to %s",
+                             len(assigned), handle_id)
+                self.datastore.release_ips(set(assigned))
+            raise
+        return ipv4, ipv6
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["ipv4"] = len(self._addresses[4])
+            stats["ipv6"] = len(self._addresses[6])
+            return stats
+
+    def refill(self):
+        """
+        Top up each IP version which is at or below its low watermark.
+        """
+        wanted = {}
+        with self._lock:
+            for version, (low, high) in self.watermarks.iteritems():
+                count = len(self._addresses[version])
+                wanted[version] = high - count if count <= low else 0
+        if not any(wanted.values()):
+            return
+        ipv4, ipv6 = self.datastore.auto_assign_ips(
+            wanted.get(4, 0), wanted.get(6, 0), self.handle_id, {},
+            hostname=self.hostname)
+        _log.debug("Added %d IPv4 and %d IPv6 addresses to the reservoir",
+                   len(ipv4), len(ipv6))
+        with self._lock:
+            self._addresses[4].extend(ipv4)
+            self._addresses[6].extend(ipv6)
+
+    def _decrement_moved(self):
+        """
+        Decrement the reservoir handle by the addresses moved off it, outside
+        the allocate requests which moved them.
+        """
+        with self._lock:
+            moved, self._moved = self._moved, {}
+        for block_cidr, count in moved.iteritems():
+            try:
+                self.datastore._decrement_handle(self.handle_id, block_cidr,
+                                                 count)
+            except Exception:
+                # The handle is released in full on stop and start anyway.
+                _log.exception("Couldn't decrement the reservoir handle")
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            self._decrement_moved()
+            try:
+                self.refill()
+            except Exception:
+                _log.exception("Couldn't refill the IP reservoir")
+            self._wakeup.wait(self.interval)
+
+    def _release_handle(self):
+        try:
+            self.datastore.release_ip_by_handle(self.handle_id)
+        except KeyError:
+            # The handle doesn't exist, so holds no addresses.
+            pass
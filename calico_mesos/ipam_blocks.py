@@ -0,0 +1,155 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Block-level IPAM operations which let several addresses share one
+compare-and-swap of their allocation block.
+
+These follow IPAMClient.assign_ip, but operate on all the requested addresses
+of a block at once.  They use the IPAMClient's block and handle primitives.
+"""
+from collections import OrderedDict
+from pycalico.block import get_block_cidr_for_address, AlreadyAssignedError
+from pycalico.ipam import CASError
+
+from ip_ranges import AddressRanges
+
+RETRIES = 100
+
+
+class AssignmentFailed(Exception):
+    """
+    An address could not be assigned.  Carries the address concerned.
+    """
+    def __init__(self, address, reason):
+        super(AssignmentFailed, self).__init__(
+            "Couldn't assign %s: %s" % (address, reason))
+        self.address = address
+
+
+def group_by_block(addresses):
+    """
+    :param addresses: Iterable of IPAddresses, or an AddressRanges.
+    :return: OrderedDict of block CIDR to the list of addresses in it.
+    """
+    if isinstance(addresses, AddressRanges):
+        # Split each range at block boundaries, without looking up the block
+        # of every address.
+        return addresses.by_block()
+    blocks = OrderedDict()
+    for address in addresses:
+        blocks.setdefault(get_block_cidr_for_address(address),
+                          []).append(address)
+    return blocks
+
+
+def assign_block_addresses(client, block_cidr, addresses, handle_id,
+                           attributes, hostname, assigned):
+    """
+    Assign addresses, which must all be in block_cidr, to handle_id.
+
+    :param client: The IPAMClient.
+    :param assigned: List to which each address is appended once its
+    assignment is committed, so that the caller can roll back on failure.
+    :raises AssignmentFailed: if an address is already assigned, is not in a
+    configured pool, or the block could not be updated.
+    """
+    pending = list(addresses)
+    for _ in xrange(RETRIES):
+        try:
+            block = client._read_block(block_cidr)
+        except KeyError:
+            # The block doesn't exist yet.  assign_ip checks the address is in
+            # a pool, then creates and claims the block while assigning it.
+            # The remaining addresses go in with a CAS on the next pass.
+            address = pending[0]
+            try:
+                client.assign_ip(address, handle_id, attributes, hostname)
+            except (RuntimeError, ValueError, AlreadyAssignedError) as e:
+                raise AssignmentFailed(address, e)
+            assigned.append(pending.pop(0))
+            if not pending:
+                return
+            continue
+
+        for address in pending:
+            try:
+                block.assign(address, handle_id, attributes)
+            except AlreadyAssignedError as e:
+                raise AssignmentFailed(address, e)
+
+        # The handle must count the addresses before the block refers to
+        # them, as in IPAMClient.assign_ip.
+        client._increment_handle(handle_id, block_cidr, len(pending))
+        try:
+            client._compare_and_swap_block(block)
+        except CASError:
+            client._decrement_handle(handle_id, block_cidr, len(pending))
+            continue
+        assigned.extend(pending)
+        return
+    raise AssignmentFailed(pending[0],
+                           "max retries hit updating block %s" % block_cidr)
+
+
+def rebind_block_addresses(client, block_cidr, addresses, old_handle_id,
+                           handle_id, attributes, assigned):
+    """
+    Move addresses, which must all be in block_cidr, from old_handle_id to
+    handle_id with one compare-and-swap of the block, so that they are never
+    free in between.
+
+    Addresses not assigned to old_handle_id are left alone and not moved.
+    The caller must decrement old_handle_id by the number moved, which can
+    wait, as an overcount only delays deletion of the handle.
+
+    :param client: The IPAMClient.
+    :param assigned: List to which the moved addresses are appended once the
+    block is updated, so that the caller can roll back on failure.
+    :raises AssignmentFailed: if the block could not be updated, in which
+    case none of the addresses were moved.
+    """
+    pending = list(addresses)
+    for _ in xrange(RETRIES):
+        try:
+            block = client._read_block(block_cidr)
+        except KeyError:
+            # No block, so nothing is assigned to the old handle.
+            return
+
+        lost = []
+        for address in pending:
+            _, handles = block.release(set([address]))
+            if handles != {old_handle_id: 1}:
+                lost.append(address)
+        if lost:
+            # The block copy may now be wrong for those addresses, so start
+            # again with the rest.
+            pending = [address for address in pending if address not in lost]
+            if not pending:
+                return
+            continue
+
+        for address in pending:
+            block.assign(address, handle_id, attributes)
+
+        client._increment_handle(handle_id, block_cidr, len(pending))
+        try:
+            client._compare_and_swap_block(block)
+        except CASError:
+            client._decrement_handle(handle_id, block_cidr, len(pending))
+            continue
+        assigned.extend(pending)
+        return
+    raise AssignmentFailed(pending[0],
+                           "max retries hit updating block %s" % block_cidr)
@@ -0,0 +1,133 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Resident isolator server.
+
+Accepts requests from calico_mesos_client over a Unix socket.  Each
+connection carries exactly one request: the client writes the raw JSON it
+received on stdin and shuts down its write side, and the server replies with
+"<exit code>\n<response>" before closing the connection.
+"""
+import os
+import errno
+import socket
+import signal
+import logging
+import SocketServer
+
+_log = logging.getLogger("CALICOMESOS")
+
+
+class _Shutdown(Exception):
+    pass
+
+
+class DaemonRunning(Exception):
+    """
+    Another daemon is already serving on the socket.
+    """
+    pass
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        raw_request = self.rfile.read()
+        exit_code, response = self.server.request_handler(raw_request)
+        self.wfile.write("%d\n%s" % (exit_code, response))
+
+
+class IsolatorServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, request_handler):
+        """
+        :param socket_path: Path of the Unix socket to listen on.
+        :param request_handler: Callable taking the raw request string and
+        returning a tuple of (exit code, response string).
+        :raises DaemonRunning: if another daemon is serving on socket_path.
+        """
+        remove_stale_socket(socket_path)
+        socket_dir = os.path.dirname(socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+        self.socket_path = socket_path
+        self.request_handler = request_handler
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _RequestHandler)
+        os.chmod(socket_path, 0600)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        _unlink(self.socket_path)
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket left by a daemon which is no longer running.
+
+    :raises DaemonRunning: if a daemon accepts connections on socket_path,
+    which is then left alone.
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error as e:
+        if e.errno == errno.ENOENT:
+            return
+        if e.errno != errno.ECONNREFUSED:
+            raise
+    else:
+        raise DaemonRunning("A daemon is already serving on %s" %
+                            socket_path)
+    finally:
+        probe.close()
+    _unlink(socket_path)
+
+
+def _unlink(socket_path):
+    try:
+        os.unlink(socket_path)
+    except OSError as oserr:
+        if oserr.errno != errno.ENOENT:
+            raise
+
+
+def _raise_shutdown(signum, frame):
+    raise _Shutdown()
+
+
+def serve(socket_path, request_handler, on_start=None, on_stop=None):
+    """
+    Serve requests on socket_path until SIGTERM or SIGINT is received.
+
+    :param on_start: Optional callable run once the socket is bound, used to
+    warm up state and start background work.
+    :param on_stop: Optional callable run after the server stops accepting
+    requests.
+    """
+    server = IsolatorServer(socket_path, request_handler)
+    signal.signal(signal.SIGTERM, _raise_shutdown)
+    signal.signal(signal.SIGINT, _raise_shutdown)
+    _log.info("Isolator daemon listening on %s", socket_path)
+    try:
+        if on_start:
+            on_start()
+        server.serve_forever()
+    except _Shutdown:
+        _log.info("Isolator daemon shutting down")
+    finally:
+        server.server_close()
+        if on_stop:
+            on_stop()
@@ -0,0 +1,145 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Locks on named resources, such as containers and profiles, so that requests
+for the same resource run one at a time, while requests for different ones
+run concurrently.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+
+class LockTimeout(Exception):
+    """
+    A lock was not acquired in time.  Carries the key concerned.
+    """
+    def __init__(self, key, timeout):
+        super(LockTimeout, self).__init__(
+            "Timed out after %gs waiting for %s %s" % (timeout, key[0],
+                                                       key[1]))
+        self.key = key
+
+
+class _Entry(object):
+    __slots__ = ("held", "users", "condition")
+
+    def __init__(self, lock):
+        self.held = False
+        # Threads holding or waiting for the lock.
+        self.users = 0
+        self.condition = threading.Condition(lock)
+
+
+class KeyedLocks(object):
+    """
+    A lock per key, which exists only while a thread holds or waits for it.
+
+    Keys are (kind, name) tuples.  acquire() takes its keys in sorted order,
+    so that two calls with overlapping keys cannot deadlock.  Where one call
+    is made while holding the keys of another, every thread must nest the
+    kinds of key in the same order, for the same reason.  Locks are not
+    reentrant.
+
+    :param timeout: Seconds to wait for each lock.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._counters = {"acquired": 0, "contended": 0, "timeouts": 0,
+                          "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def acquire(self, keys):
+        """
+        Acquire the locks of all the keys.
+        :return: Seconds spent waiting for locks other threads held.
+        :raises LockTimeout: if a lock is not acquired within the timeout,
+        in which case none are held.
+        """
+        acquired = []
+        waited = 0.0
+        try:
+            for key in sorted(set(keys)):
+                waited += self._acquire(key)
+                acquired.append(key)
+        except LockTimeout:
+            self.release(acquired)
+            raise
+        return waited
+
+    def release(self, keys):
+        for key in sorted(set(keys), reverse=True):
+            self._release(key)
+
+    @contextmanager
+    def hold(self, keys):
+        """
+        Hold the locks of all the keys for the duration of the block.
+        """
+        self.acquire(keys)
+        try:
+            yield
+        finally:
+            self.release(keys)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["held"] = sum(1 for entry in self._entries.values()
+                                if entry.held)
+            stats["waiting"] = sum(entry.users - entry.held
+                                   for entry in self._entries.values())
+            return stats
+
+    def _acquire(self, key):
+        start = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(self._lock)
+            entry.users += 1
+            contended = entry.held
+            if contended:
+                self._counters["contended"] += 1
+            while entry.held:
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    self._forget(key, entry)
+                    raise LockTimeout(key, self.timeout)
+                entry.condition.wait(remaining)
+            entry.held = True
+            waited = time.time() - start
+            self._counters["acquired"] += 1
+            self._counters["wait_seconds"] += waited
+            self._counters["max_wait_seconds"] = max(
+                self._counters["max_wait_seconds"], waited)
+            return waited if contended else 0.0
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            entry.held = False
+            self._forget(key, entry)
+            entry.condition.notify()
+
+    def _forget(self, key, entry):
+        """
+        Drop this thread's use of the entry, and the entry itself once it is
+        unused.  Called with the lock held.
+        """
+        entry.users -= 1
+        if not entry.users:
+            del self._entries[key]
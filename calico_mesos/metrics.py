@@ -0,0 +1,256 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-request timing of command phases and datastore calls, and histograms of
+them in the Prometheus text format.
+"""
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import statefile
+
+_log = logging.getLogger("CALICOMESOS")
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+REQUEST_DURATION = "calico_mesos_request_duration_seconds"
+PHASE_DURATION = "calico_mesos_phase_duration_seconds"
+DATASTORE_DURATION = "calico_mesos_datastore_call_duration_seconds"
+
+HELP = {
+    REQUEST_DURATION: "Time taken to handle a request, by command.",
+    PHASE_DURATION: "Time spent in each phase of a command.",
+    DATASTORE_DURATION: "Time taken by datastore calls, by operation.",
+}
+
+
+class RequestMetrics(object):
+    """
+    Collects the timings of one request.  Datastore calls may be timed from
+    any thread; phases are timed by the thread handling the request.
+    """
+    def __init__(self, command, **fields):
+        self.command = command
+        self.fields = fields
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._calls = []
+
+    @contextmanager
+    def span(self, phase):
+        """
+        Time the enclosed block as the named phase.  Repeated phases add up.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.time() - start)
+
+    def add_phase(self, phase, seconds):
+        """
+        Count seconds towards the named phase.
+        """
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0) + seconds
+
+    def timed(self, operation, func):
+        """
+        :return: func, wrapped to count and time its calls as operation.
+        """
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record_call(operation, time.time() - start)
+        return call
+
+    def record_call(self, operation, seconds):
+        with self._lock:
+            self._calls.append((operation, seconds))
+
+    def calls(self):
+        """
+        :return: List of (operation, seconds) for each datastore call.
+        """
+        with self._lock:
+            return list(self._calls)
+
+    def finish(self, error=None):
+        """
+        :return: JSON-serializable dictionary describing the request.
+        """
+        datastore = {}
+        for operation, seconds in self.calls():
+            call = datastore.setdefault(operation,
+                                        {"count": 0, "duration": 0.0})
+            call["count"] += 1
+            call["duration"] += seconds
+        with self._lock:
+            record = dict(self.fields)
+            record.update({
+                "command": self.command,
+                "start": self._start,
+                "duration": time.time() - self._start,
+                "error": error,
+                "phases": dict(self._phases),
+                "datastore": datastore})
+            return record
+
+
+class TimedProxy(object):
+    """
+    Stands in for target, timing calls of its methods with a RequestMetrics
+    as prefix followed by the method name.
+    """
+    def __init__(self, target, metrics, prefix):
+        self._target = target
+        self._metrics = metrics
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if callable(attr):
+            return self._metrics.timed(self._prefix + name, attr)
+        return attr
+
+
+class Histograms(object):
+    """
+    Histograms of request records, which can be merged into a state file
+    shared between processes and written out for node_exporter's textfile
+    collector.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, sorted label items) to [bucket counts, sum, count].
+        self._series = {}
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(BUCKETS), 0.0, 0]
+            index = bisect_left(BUCKETS, value)
+            if index < len(BUCKETS):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def observe_request(self, record, calls):
+        """
+        :param record: Dictionary returned by RequestMetrics.finish.
+        :param calls: List returned by RequestMetrics.calls.
+        """
+        command = record["command"]
+        outcome = "error" if record["error"] else "success"
+        self.observe(REQUEST_DURATION,
+                     {"command": command, "outcome": outcome},
+                     record["duration"])
+        for phase, seconds in record["phases"].iteritems():
+            self.observe(PHASE_DURATION, {"command": command, "phase": phase},
+                         seconds)
+        for operation, seconds in calls:
+            self.observe(DATASTORE_DURATION, {"operation": operation},
+                         seconds)
+
+    def save(self, state_path, textfile_path):
+        """
+        Add the observations made since the last save to those in the state
+        file, and write the totals to textfile_path.
+        """
+        with self._lock:
+            series, self._series = self._series, {}
+        with statefile.locked(state_path):
+            totals = dict(
+                ((entry["name"], tuple(sorted(entry["labels"].items()))),
+                 [entry["buckets"], entry["sum"], entry["count"]])
+                for entry in statefile.read_json(state_path, []))
+            for key, (buckets, total, count) in series.iteritems():
+                merged = totals.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+            statefile.atomic_write(state_path, json.dumps([
+                {"name": name, "labels": dict(labels), "buckets": buckets,
+                 "sum": total, "count": count}
+                for (name, labels), (buckets, total, count)
+                in totals.iteritems()]))
+            statefile.atomic_write(textfile_path, render(totals))
+
+
+def render(series):
+    """
+    :param series: Dictionary of (name, sorted label items) to
+    [bucket counts, sum, count].
+    :return: The histograms in the Prometheus text exposition format.
+    """
+    lines = []
+    for name in sorted(set(name for name, _ in series)):
+        lines.append("# HELP %s %s" % (name, HELP.get(name, name)))
+        lines.append("# TYPE %s histogram" % name)
+        for key in sorted(key for key in series if key[0] == name):
+            buckets, total, count = series[key]
+            labels = ",".join('%s="%s"' % item for item in key[1])
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%sle="%s"} %d' %
+                             (name, prefix, bound, cumulative))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, count))
+            lines.append("%s_sum{%s} %s" % (name, labels, repr(total)))
+            lines.append("%s_count{%s} %d" % (name, labels, count))
+    return "\n".join(lines) + "\n"
+
+
+class PeriodicSaver(object):
+    """
+    Background thread which saves Histograms every interval seconds, and once
+    more when stopped.
+    """
+    def __init__(self, histograms, state_path, textfile_path, interval):
+        self.histograms = histograms
+        self.state_path = state_path
+        self.textfile_path = textfile_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.histograms.save(self.state_path, self.textfile_path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.histograms.save(self.state_path, self.textfile_path)
+            except (IOError, OSError) as e:
+                _log.warning("Could not save metrics: %s", e)
@@ -0,0 +1,185 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for running independent pieces of work concurrently.
+
+Every call starts its own short-lived worker threads rather than sharing a
+pool, so that work running on a worker can itself fan out without risk of
+exhausting a shared pool and deadlocking.
+"""
+import sys
+import logging
+import threading
+from Queue import Queue, Empty
+
+_log = logging.getLogger("CALICOMESOS")
+
+
+def run_parallel(func, items, max_workers):
+    """
+    Call func(item) for every item, using at most max_workers threads.
+
+    :return: List of (result, exc_info) tuples in the same order as items.
+    exc_info is None if the call succeeded, otherwise the sys.exc_info() of
+    the exception it raised, so that one failure does not affect the others.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if len(items) <= 1 or max_workers <= 1:
+        for index, item in enumerate(items):
+            results[index] = _call(func, item)
+        return results
+
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            results[index] = _call(func, item)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check_results(results):
+    """
+    Re-raise the first failure in a list returned by run_parallel.
+
+    :return: List of the results, if there were no failures.
+    """
+    for _, exc_info in results:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return [result for result, _ in results]
+
+
+def _call(func, item):
+    try:
+        return func(item), None
+    except Exception:
+        return None, sys.exc_info()
+
+
+class TaskGraph(object):
+    """
+    The steps of one operation, with the steps each must wait for.  Every
+    step starts on its own thread as soon as those steps have succeeded, so
+    that independent steps overlap.
+    """
+    def __init__(self):
+        self._steps = []
+
+    def add(self, name, func, after=(), undo=None):
+        """
+        :param func: Called to run the step, with the results of the after
+        steps as its arguments.
+        :param after: Names of previously added steps which must succeed
+        before this one starts.
+        :param undo: Called with func's result to roll the step back, if the
+        operation fails after the step succeeded.
+        """
+        names = set(step[0] for step in self._steps)
+        unknown = set(after) - names
+        if name in names or unknown:
+            raise ValueError("Bad step %s after %s" % (name, list(after)))
+        self._steps.append((name, func, tuple(after), undo))
+
+    def run(self):
+        """
+        Run the steps, and wait for them all.
+
+        Once a step fails, no more steps start.  When those already started
+        have finished, the steps which succeeded are undone, latest first,
+        and the first failure is raised.
+
+        :return: Dictionary of step name to result.
+        """
+        finished = dict((name, threading.Event())
+                        for name, _, _, _ in self._steps)
+        lock = threading.Lock()
+        results = {}
+        # Names of the steps which succeeded, in order of completion.
+        succeeded = []
+        failures = []
+
+        def run_step(name, func, after):
+            try:
+                for dependency in after:
+                    finished[dependency].wait()
+                with lock:
+                    if failures:
+                        return
+                    args = [results[dependency] for dependency in after]
+                result, exc_info = _call(lambda args: func(*args), args)
+                with lock:
+                    if exc_info:
+                        failures.append(exc_info)
+                    else:
+                        results[name] = result
+                        succeeded.append(name)
+            finally:
+                finished[name].set()
+
+        threads = [threading.Thread(target=run_step,
+                                    args=(name, func, after))
+                   for name, func, after, _ in self._steps]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            undos = dict((name, undo) for name, _, _, undo in self._steps)
+            for name in reversed(succeeded):
+                if undos[name]:
+                    try:
+                        undos[name](results[name])
+                    except Exception:
+                        _log.exception("Couldn't undo %s", name)
+            raise failures[0][0], failures[0][1], failures[0][2]
+        return results
+
+
+class OnceCache(object):
+    """
+    Thread-safe memo of lookups.  Concurrent callers asking for the same key
+    wait for a single computation rather than each repeating it.  Failed
+    computations are not cached.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._values = {}
+
+    def get(self, key, func, *args):
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._values:
+                self._values[key] = func(*args)
+            return self._values[key]
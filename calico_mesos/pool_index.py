@@ -0,0 +1,69 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Index from IP addresses to the IP pools which contain them.
+"""
+from bisect import bisect_right
+
+
+class PoolIndex(object):
+    """
+    Holds the pools of one IP version as integer ranges sorted by their first
+    address, so that the pool containing an address is found by binary
+    search rather than by testing every pool.
+    """
+    def __init__(self, pools):
+        ranges = sorted((pool.cidr.first, pool.cidr.last, pool)
+                        for pool in pools)
+        self._firsts = [first for first, _, _ in ranges]
+        self._lasts = [last for _, last, _ in ranges]
+        self._pools = [pool for _, _, pool in ranges]
+        # Highest last address of any range up to each index, which bounds
+        # the search for an enclosing range if pools overlap.
+        self._max_lasts = []
+        max_last = -1
+        for last in self._lasts:
+            max_last = max(max_last, last)
+            self._max_lasts.append(max_last)
+
+    def lookup(self, ip):
+        """
+        :return: The pool containing ip (the one with the highest first
+        address, if pools overlap), or None.
+        """
+        value = int(ip)
+        index = bisect_right(self._firsts, value) - 1
+        while index >= 0 and self._max_lasts[index] >= value:
+            if self._lasts[index] >= value:
+                return self._pools[index]
+            index -= 1
+        return None
+
+    def group_by_pool(self, ips):
+        """
+        :return: List of (pool, [ips in that pool]) tuples.  Addresses which
+        are not in any pool are left out.
+        """
+        groups = {}
+        order = []
+        for ip in ips:
+            pool = self.lookup(ip)
+            if pool is None:
+                continue
+            key = id(pool)
+            if key not in groups:
+                groups[key] = (pool, [])
+                order.append(key)
+            groups[key][1].append(ip)
+        return [groups[pool_key] for pool_key in order]
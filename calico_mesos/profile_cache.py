@@ -0,0 +1,125 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local cache of the names of profiles known to exist in the datastore.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import statefile
+
+
+class ProfileCache(object):
+    """
+    Remembers profiles which have been seen to exist, for ttl seconds each.
+    Holds at most max_entries names, evicting the least recently used.
+
+    Kept in memory only, unless a path is set, in which case entries are
+    loaded from that file on first use and, if any were added or
+    invalidated, merged back into it by save().  This lets one-shot CLI
+    processes share the cache.  Counters are kept in memory only.
+    """
+    def __init__(self, ttl, max_entries, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._invalidated = set()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self._loaded = False
+        self._dirty = False
+
+    def contains(self, name):
+        """
+        :return: True if name is cached as existing.  Counts a hit or miss.
+        """
+        with self._lock:
+            self._load()
+            added = self._entries.pop(name, None)
+            if added is not None and time.time() - added < self.ttl:
+                # Re-insert to mark as most recently used.
+                self._entries[name] = added
+                self._counters["hits"] += 1
+                hit = True
+            else:
+                self._counters["misses"] += 1
+                hit = False
+            return hit
+
+    def add(self, name):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._load()
+            self._entries.pop(name, None)
+            self._entries[name] = time.time()
+            self._invalidated.discard(name)
+            self._evict()
+            self._dirty = True
+
+    def invalidate(self, name):
+        with self._lock:
+            self._load()
+            self._entries.pop(name, None)
+            self._invalidated.add(name)
+            self._dirty = True
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            stats = dict(self._counters)
+            stats["size"] = len(self._entries)
+            return stats
+
+    def save(self):
+        """
+        Merge this process's additions and invalidations into the cache
+        file, if there is one.
+        """
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            with statefile.locked(self.path):
+                on_disk = statefile.read_json(self.path, {})
+                profiles = on_disk.get("profiles", {})
+                for name in self._invalidated:
+                    profiles.pop(name, None)
+                for name, added in self._entries.iteritems():
+                    profiles[name] = max(added, profiles.get(name, 0))
+                entries = sorted(profiles.items(), key=lambda item: item[1])
+                statefile.atomic_write(self.path, json.dumps({
+                    "profiles": dict(entries[-self.max_entries:])}))
+            self._invalidated.clear()
+            self._loaded = False
+            self._dirty = False
+
+    def _load(self):
+        if self._loaded or not self.path:
+            return
+        self._loaded = True
+        on_disk = statefile.read_json(self.path, {})
+        now = time.time()
+        for name, added in sorted(on_disk.get("profiles", {}).items(),
+                                  key=lambda item: item[1]):
+            if now - added < self.ttl and name not in self._entries:
+                self._entries[name] = added
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
@@ -0,0 +1,296 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reconciliation of this host's endpoints and IP assignments with the
+containers the Mesos agent is running.
+
+An agent which crashes between allocate and isolate, or part way through a
+cleanup, leaves endpoints and assigned addresses behind in the datastore.  A
+reconcile pass finds these orphans:
+
+- endpoints of containers which are not running, and
+- addresses in this host's blocks which no endpoint on the host uses, and
+  whose handle is one this host recorded assigning addresses to at least
+  handle_age seconds ago, but not a running container's.
+
+Other hosts may assign addresses in this host's blocks, and their endpoints
+are not on this host, so addresses of handles this host did not record are
+never released.  Nor are addresses without a handle.  An allocate uid is not
+a container ID, and its addresses are unused until the task's container is
+isolated, which may be long after, so a handle is only a candidate once its
+record is much older than any allocate to isolate gap.  Until some handle is,
+the blocks are not read at all.  Recorded handles that old which no longer
+have addresses in this host's blocks are orphans too, and are forgotten.
+
+An orphan is only released once a later pass, at least grace seconds after
+the first, still finds it, so that requests in flight are left alone.  Each
+pass releases at most batch_size orphans, continuing after the last orphan
+the previous pass released.
+"""
+import json
+import time
+import logging
+import threading
+import urllib2
+
+from pycalico.block import AllocationBlock
+
+import statefile
+
+_log = logging.getLogger("CALICOMESOS")
+
+
+def fetch_agent_containers(agent_url, timeout=5):
+    """
+    :return: Set of the IDs of the containers run by the Mesos agent at
+    agent_url.
+    """
+    response = urllib2.urlopen(agent_url.rstrip("/") + "/containers",
+                               timeout=timeout)
+    try:
+        containers = json.load(response)
+    finally:
+        response.close()
+    return set(container["container_id"] for container in containers)
+
+
+def affine_assignments(client, hostname, versions=(4, 6)):
+    """
+    Yield (address, handle ID) for each address assigned in the blocks with
+    affinity to hostname.
+
+    :param client: The IPAMClient.
+    """
+    for version in versions:
+        for block_cidr in client._get_affine_blocks(hostname, version, None):
+            try:
+                block = client._read_block(block_cidr)
+            except KeyError:
+                # Released since it was listed.
+                continue
+            for ordinal, attributes_index in enumerate(block.allocations):
+                if attributes_index is None:
+                    continue
+                attributes = block.attributes[attributes_index]
+                yield (block.cidr[ordinal],
+                       attributes[AllocationBlock.ATTR_HANDLE_ID])
+
+
+class Reconciler(object):
+    """
+    Finds and releases this host's orphaned endpoints and addresses.  The
+    orphans found, and the cursor, are kept in a state file, so that passes
+    made by separate processes follow on from each other.
+
+    :param datastore: The IPAMClient.
+    :param hostname: This host.
+    :param orchestrator_id: The orchestrator whose endpoints are reconciled.
+    Endpoints of other orchestrators only count as users of addresses.
+    :param cleanup: Function taking a container ID, which removes the
+    container's endpoint and unassigns its addresses.
+    :param state_path: Path of the state file.
+    :param grace: Seconds an orphan must stay orphaned before release.
+    :param batch_size: Most orphans released by one pass.
+    :param protected_handles: Handles whose addresses are never released.
+    :param handles: HandleRecords of the handles this host has assigned
+    addresses to.  Only their addresses are released, so none are if it is
+    None.
+    :param handle_age: Seconds since a handle was recorded before its
+    addresses may be released.
+    :param list_endpoints: Function returning this host's endpoints of the
+    orchestrator from local state, or None if that does not cover them all.
+    The datastore is only asked for the host's endpoints when it returns
+    None, or if it is None.
+    """
+    def __init__(self, datastore, hostname, orchestrator_id, cleanup,
+                 state_path, grace=300, batch_size=50, protected_handles=(),
+                 handles=None, handle_age=86400, list_endpoints=None):
+        self.datastore = datastore
+        self.hostname = hostname
+        self.orchestrator_id = orchestrator_id
+        self.cleanup = cleanup
+        self.state_path = state_path
+        self.grace = grace
+        self.batch_size = batch_size
+        self.protected_handles = set(protected_handles)
+        self.handles = handles
+        self.handle_age = handle_age
+        self.list_endpoints = list_endpoints
+
+    def find_orphans(self, live_containers):
+        """
+        :param live_containers: Set of the IDs of running containers.
+        :return: Dictionary of orphan key to ("endpoint", container ID),
+        ("address", address) or ("handle", handle ID).  Keys identify the
+        endpoint, assignment or handle, so that a reused container ID or
+        address is a different orphan.
+        """
+        orphans = {}
+        in_use = set()
+        for endpoint in self._endpoints():
+            for net in endpoint.ipv4_nets | endpoint.ipv6_nets:
+                in_use.add(net.ip)
+            if (endpoint.orchestrator_id == self.orchestrator_id and
+                    endpoint.workload_id not in live_containers):
+                key = "endpoint %s %s" % (endpoint.workload_id,
+                                          endpoint.endpoint_id)
+                orphans[key] = ("endpoint", endpoint.workload_id)
+
+        recorded = self.handles.recorded() if self.handles else {}
+        now = time.time()
+        candidates = set(handle_id
+                         for handle_id, recorded_at in recorded.iteritems()
+                         if now - recorded_at >= self.handle_age)
+        candidates -= live_containers | self.protected_handles
+        if not candidates:
+            return orphans
+
+        unused = set(candidates)
+        for address, handle_id in affine_assignments(self.datastore,
+                                                     self.hostname):
+            unused.discard(handle_id)
+            if handle_id not in candidates or address in in_use:
+                continue
+            orphans["address %s %s" % (address, handle_id)] = \
+                ("address", address)
+        for handle_id in unused:
+            orphans["handle %s" % handle_id] = ("handle", handle_id)
+        return orphans
+
+    def _endpoints(self):
+        """
+        :return: This host's endpoints, from local state if possible.  Local
+        state only holds the orchestrator's endpoints, which are the only
+        ones using addresses of recorded handles.
+        """
+        endpoints = self.list_endpoints() if self.list_endpoints else None
+        if endpoints is None:
+            endpoints = self.datastore.get_endpoints(hostname=self.hostname)
+        return endpoints
+
+    def run(self, live_containers):
+        """
+        Make one pass.
+
+        :param live_containers: Set of the IDs of running containers.
+        :return: Dictionary of the results, in the following format:
+        {
+            "endpoints": ["ba11f1de-fc4d-46fd-9f15-424f4ef05a3a"],  # Removed
+            "addresses": ["192.168.23.4"],                          # Released
+            "pending": 3,   # Orphans waiting out the grace period or batch
+            "failures": {"ba11f1de-...": "error message"}
+        }
+        """
+        orphans = self.find_orphans(live_containers)
+        now = time.time()
+        with statefile.locked(self.state_path):
+            state = statefile.read_json(self.state_path, {})
+            first_seen = state.get("first_seen", {})
+            # Orphans no longer found are forgotten.
+            first_seen = dict((key, first_seen.get(key, now))
+                              for key in orphans)
+            confirmed = sorted(key for key, seen in first_seen.iteritems()
+                               if now - seen >= self.grace)
+            cursor = state.get("cursor", "")
+            batch = ([key for key in confirmed if key > cursor] +
+                     [key for key in confirmed if key <= cursor])
+            batch = batch[:self.batch_size]
+
+            released, result = self._release(
+                [(key, orphans[key]) for key in batch])
+            for key in released:
+                del first_seen[key]
+            result["pending"] = len(first_seen)
+            statefile.atomic_write(self.state_path, json.dumps(
+                {"first_seen": first_seen,
+                 "cursor": batch[-1] if batch else ""}))
+        if result["endpoints"] or result["addresses"] or result["failures"]:
+            _log.info("Reconciled orphans: %s", result)
+        return result
+
+    def _release(self, batch):
+        """
+        Remove the orphaned endpoints one at a time, then release the
+        orphaned addresses together.
+        :return: Tuple of (released keys, result dictionary).
+        """
+        released = []
+        result = {"endpoints": [], "addresses": [], "failures": {}}
+        addresses = []
+        for key, (kind, value) in batch:
+            if kind == "address":
+                addresses.append((key, value))
+                continue
+            if kind == "handle":
+                # No addresses left to release.
+                try:
+                    self.handles.remove(value)
+                except (IOError, OSError) as e:
+                    result["failures"][value] = str(e)
+                else:
+                    released.append(key)
+                continue
+            try:
+                self.cleanup(value)
+            except Exception as e:
+                _log.warning("Couldn't clean up orphaned container %s: %s",
+                             value, e)
+                result["failures"][value] = str(e)
+            else:
+                released.append(key)
+                result["endpoints"].append(value)
+
+        if addresses:
+            try:
+                self.datastore.release_ips(set(address
+                                               for _, address in addresses))
+            except Exception as e:
+                _log.warning("Couldn't release orphaned addresses: %s", e)
+                for _, address in addresses:
+                    result["failures"][str(address)] = str(e)
+            else:
+                for key, address in addresses:
+                    released.append(key)
+                    result["addresses"].append(str(address))
+        return released, result
+
+
+class PeriodicReconciler(object):
+    """
+    Background thread which makes a reconcile pass every interval seconds,
+    against the containers listed by list_containers.
+    """
+    def __init__(self, reconciler, list_containers, interval):
+        self.reconciler = reconciler
+        self.list_containers = list_containers
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.reconciler.run(self.list_containers())
+            except Exception:
+                _log.exception("Couldn't reconcile orphans")
@@ -0,0 +1,157 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Durable local cache of the responses of successful requests, so that a
+retried request returns the original response instead of being run again.
+"""
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+
+import statefile
+
+GENERATION_FILE = ".generation"
+
+
+def request_hash(command, args):
+    """
+    :return: Digest identifying the command and its arguments, whatever the
+    order of their keys.
+    """
+    return hashlib.sha1(json.dumps([command, args],
+                                   sort_keys=True)).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    Keeps the response of the latest successful request for each key (the
+    container or uid the request is for), in one file per key.  A request
+    matches that response only if its command and request hash are the same,
+    so any other successful request for the key replaces it.
+
+    Responses are kept for ttl seconds.  One put in every evict_every also
+    removes the expired responses, and the least recently stored beyond
+    max_entries, so the directory is not listed on every put.  A one-shot
+    process starts counting at random, so that one in evict_every of them
+    evicts.  Files are written before the response is returned, so the CLI
+    processes and the daemon share them, and they survive restarts.
+    Counters are kept in memory only.
+
+    A response may be stored with the current generation, in which case it
+    only matches until new_generation() is called.  This covers responses
+    which other requests can make stale without naming their key.
+    """
+    def __init__(self, directory, ttl, max_entries, evict_every=64):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._puts = random.randrange(evict_every)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stores": 0,
+                          "evictions": 0}
+
+    def get(self, key, command, request_hash):
+        """
+        :return: Tuple of (True, response) if an unexpired response of the
+        same request is stored for key, or (False, None).
+        """
+        entry = statefile.read_json(self._path(key))
+        hit = (isinstance(entry, dict) and
+               entry.get("command") == command and
+               entry.get("hash") == request_hash and
+               time.time() - entry.get("stored", 0) < self.ttl and
+               entry.get("generation") in (None, self.generation()))
+        with self._lock:
+            self._counters["hits" if hit else "misses"] += 1
+        if not hit:
+            return False, None
+        return True, entry.get("response")
+
+    def put(self, key, command, request_hash, response, generation=None):
+        """
+        Store the response of a successful request, replacing any other
+        response stored for key.
+
+        :param generation: The generation() read before the request ran, if
+        the response is only valid until the next new_generation().
+        """
+        entry = {"command": command, "hash": request_hash,
+                 "response": response, "stored": time.time()}
+        if generation is not None:
+            entry["generation"] = generation
+        statefile.atomic_write(self._path(key), json.dumps(entry))
+        with self._lock:
+            self._counters["stores"] += 1
+            self._puts += 1
+            evict = self._puts % self.evict_every == 0
+        if evict:
+            self._evict()
+
+    def forget(self, key):
+        """
+        Drop the response stored for key, if any, once what it describes has
+        been undone by other means.
+        """
+        statefile.remove(self._path(key))
+
+    def generation(self):
+        return statefile.read_json(
+            os.path.join(self.directory, GENERATION_FILE), 0)
+
+    def new_generation(self):
+        """
+        Invalidate every response stored with a generation.
+        """
+        path = os.path.join(self.directory, GENERATION_FILE)
+        with statefile.locked(path):
+            statefile.atomic_write(path, json.dumps(self.generation() + 1))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _evict(self):
+        """
+        Remove expired responses, and the oldest beyond max_entries.
+        """
+        names = [name for name in os.listdir(self.directory)
+                 if not name.startswith(".")]
+        if len(names) <= self.max_entries:
+            return
+        now = time.time()
+        stored = []
+        for name in names:
+            try:
+                stored.append((os.path.getmtime(
+                    os.path.join(self.directory, name)), name))
+            except OSError:
+                # Removed by another process.
+                continue
+        stored.sort()
+        excess = len(stored) - self.max_entries
+        evicted = 0
+        for index, (mtime, name) in enumerate(stored):
+            if index >= excess and now - mtime < self.ttl:
+                break
+            statefile.remove(os.path.join(self.directory, name))
+            evicted += 1
+        with self._lock:
+            self._counters["evictions"] += evicted
+
+    def _path(self, key):
+        return os.path.join(self.directory, statefile.quote(key))
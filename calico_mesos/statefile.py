@@ -0,0 +1,139 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for the small local state files kept under STATE_DIR.
+"""
+import os
+import json
+import fcntl
+import errno
+import string
+import tempfile
+from contextlib import contextmanager
+
+STATE_DIR = os.environ.get("CALICO_MESOS_STATE_DIR", "/var/lib/calico/mesos")
+
+_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + "_.-")
+
+
+def quote(name):
+    """
+    Encode name for use as a file name, as urllib.quote(name, safe="")
+    does.  (urllib imports ssl, which a one-shot request should not pay
+    for.)
+    """
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    return "".join(char if char in _SAFE_CHARS else "%%%02X" % ord(char)
+                   for char in name)
+
+
+def unquote(name):
+    """
+    :return: The name which quote() encoded as name.
+    """
+    parts = name.split("%")
+    return parts[0] + "".join(chr(int(part[:2], 16)) + part[2:]
+                              for part in parts[1:])
+
+
+def ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as oserr:
+        if oserr.errno != errno.EEXIST:
+            raise
+
+
+def atomic_write(path, data, sync=False):
+    """
+    Replace the contents of path with data, such that readers (and a crash)
+    see either the old or the new contents, never a partial write.
+
+    :param sync: If True, the data and the rename are flushed to disk before
+    returning.
+    """
+    directory = os.path.dirname(path)
+    ensure_dir(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(data)
+            if sync:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    if sync:
+        _sync_dir(directory)
+
+
+def remove(path, sync=False):
+    """
+    Remove path, if it exists.
+
+    :param sync: If True, the removal is flushed to disk before returning.
+    """
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    if sync:
+        _sync_dir(os.path.dirname(path))
+
+
+def _sync_dir(directory):
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_json(path, default=None):
+    """
+    Return the JSON content of path, or default if it does not exist or is
+    not valid JSON.
+    """
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        pass
+    return default
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on "<path>.lock" for the duration of the block,
+    serializing read-modify-write cycles across processes.
+    """
+    ensure_dir(os.path.dirname(path))
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
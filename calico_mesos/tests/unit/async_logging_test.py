@@ -0,0 +1,81 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import unittest
+from Queue import Queue
+from mock import patch
+from async_logging import QueueHandler, QueueListener, Payload
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestQueueLogging(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("CALICOMESOS.async_logging_test")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.handlers = []
+
+    def test_stop_writes_queued_records(self):
+        queue_handler = QueueHandler(Queue())
+        self.logger.addHandler(queue_handler)
+        debug = _ListHandler()
+        info = _ListHandler(logging.INFO)
+        listener = QueueListener(queue_handler.queue, debug, info)
+        listener.start()
+
+        args = ["request"]
+        self.logger.debug("Received %s", args)
+        # Arguments are formatted when logged, not when written.
+        args.append("changed")
+        self.logger.info("Completed")
+        listener.stop()
+
+        self.assertEqual(debug.messages, ["Received ['request']", "Completed"])
+        self.assertEqual(info.messages, ["Completed"])
+
+    def test_full_queue_drops_records(self):
+        queue_handler = QueueHandler(Queue(1))
+        self.logger.addHandler(queue_handler)
+        self.logger.info("first")
+        self.logger.info("second")
+        self.assertEqual(queue_handler.dropped, 1)
+        self.assertEqual(queue_handler.queue.get_nowait().getMessage(),
+                         "first")
+
+
+class TestPayload(unittest.TestCase):
+    def test_short_payload_unchanged(self):
+        self.assertEqual(str(Payload("abc", 3, 1)), "abc")
+        self.assertEqual(str(Payload("a" * 100, 0, 1)), "a" * 100)
+
+    def test_long_payload_truncated(self):
+        self.assertEqual(str(Payload("abcdef", 2, 1)),
+                         "ab...<4 bytes truncated>")
+
+    @patch('random.random', autospec=True)
+    def test_sampling(self, m_random):
+        m_random.return_value = 0.5
+        self.assertEqual(str(Payload("abcdef", 0, 0.25)),
+                         "<6 bytes, not sampled>")
+        self.assertEqual(str(Payload("abcdef", 0, 0.75)), "abcdef")
@@ -0,0 +1,122 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from mock import Mock, patch
+from cleanup_journal import CleanupJournal, CleanupWorker
+
+
+class TestCleanupJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cleanup.journal")
+        self.journal = CleanupJournal(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('time.time', return_value=100.0)
+    def test_pending(self, m_time):
+        self.journal.add("a", {"endpoint_id": "1"})
+        self.journal.add("b", {"endpoint_id": "2"})
+        self.journal.fail("b", "etcd unavailable")
+        self.journal.done("a")
+        self.assertEqual(self.journal.pending(), [
+            {"container_id": "b", "endpoint": {"endpoint_id": "2"},
+             "queued_at": 100.0, "attempts": 1,
+             "last_error": "etcd unavailable", "last_attempt": 100.0}])
+
+    def test_torn_line_skipped(self):
+        self.journal.add("a", {})
+        with open(self.path, "a") as journal:
+            journal.write('{"op": "done", "contai')
+        self.journal.add("b", {})
+        self.assertEqual([entry["container_id"]
+                          for entry in self.journal.pending()], ["a", "b"])
+
+    @patch('cleanup_journal.COMPACT_SLACK', 2)
+    def test_compact(self):
+        for container_id in "abcd":
+            self.journal.add(container_id, {})
+        self.journal.fail("d", "error")
+        for container_id in "abc":
+            self.journal.done(container_id)
+        pending = self.journal.pending()
+
+        self.journal.compact()
+        with open(self.path) as journal:
+            self.assertEqual(len(journal.readlines()), 1)
+        self.assertEqual(self.journal.pending(), pending)
+
+
+class TestCleanupWorker(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = CleanupJournal(os.path.join(self.tmpdir,
+                                                   "cleanup.journal"))
+        self.process = Mock()
+        self.worker = CleanupWorker(self.journal, self.process,
+                                    retry_delay=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('time.time')
+    def test_failures_retried_with_backoff(self, m_time):
+        m_time.return_value = 100.0
+        self.worker.add("a", {})
+        self.worker.add("b", {})
+        self.process.side_effect = [IOError("etcd unavailable"), None]
+        self.assertEqual(self.worker.drain(),
+                         {"completed": 1, "failed": 1})
+        self.assertEqual(self.worker.status(), {
+            "pending": 1,
+            "entries": [{"container_id": "a", "queued_at": 100.0,
+                         "attempts": 1, "last_error": "etcd unavailable"}]})
+
+        self.process.side_effect = IOError("etcd unavailable")
+        m_time.return_value = 109.0
+        self.assertEqual(self.worker.drain(), {"completed": 0, "failed": 0})
+        m_time.return_value = 110.0
+        self.assertEqual(self.worker.drain(), {"completed": 0, "failed": 1})
+        # The delay doubles.
+        m_time.return_value = 129.0
+        self.assertEqual(self.worker.drain(), {"completed": 0, "failed": 0})
+
+        self.process.side_effect = None
+        self.assertEqual(self.worker.drain(retry_all=True),
+                         {"completed": 1, "failed": 0})
+        self.assertEqual(self.worker.status()["pending"], 0)
+
+    def test_drain_in_batches(self):
+        for container_id in "abc":
+            self.worker.add(container_id, {})
+        self.assertEqual(self.worker.drain(2), {"completed": 2, "failed": 0})
+        self.assertEqual([entry["container_id"]
+                          for entry in self.journal.pending()], ["c"])
+
+    def test_background_worker_drains_queue(self):
+        self.worker.start()
+        try:
+            self.worker.add("a", {})
+            for _ in range(100):
+                if self.process.called:
+                    break
+                time.sleep(0.05)
+        finally:
+            self.worker.stop()
+        self.assertEqual(self.process.call_args[0][0]["container_id"], "a")
@@ -0,0 +1,95 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+from mock import Mock, call
+from netaddr import IPAddress, IPNetwork
+from pycalico.ipam import IPAMClient, CASError
+from coalescer import AllocationCoalescer, _Allocation
+
+BLOCK = IPNetwork("192.168.1.0/30")
+
+
+class _Block(object):
+    """
+    Block with the given free addresses, handed out in order.
+    """
+    def __init__(self, free):
+        self.free = list(free)
+
+    def auto_assign(self, num, handle_id, attributes, affinity_check=True):
+        assigned, self.free = self.free[:num], self.free[num:]
+        return assigned
+
+
+class TestAllocationCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock(spec=IPAMClient)
+        self.client._get_affine_blocks.side_effect = \
+            lambda host, version, pool: [BLOCK] if version == 4 else []
+        self.client._read_block.side_effect = lambda cidr: _Block(BLOCK)
+        self.client.auto_assign_ips.return_value = ([IPAddress("10.0.0.1")],
+                                                    [])
+        self.coalescer = AllocationCoalescer(self.client, "host", 0.01)
+
+    def test_concurrent_allocations_share_one_swap(self):
+        self.coalescer.window = 0.2
+        results = {}
+
+        def allocate(uid, num_ipv4):
+            results[uid] = self.coalescer.allocate(num_ipv4, 0, uid)
+        threads = [threading.Thread(target=allocate, args=(uid, num))
+                   for uid, num in (("a", 1), ("b", 2))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results["a"][0] + results["b"][0]),
+                         list(BLOCK)[:3])
+        self.assertEqual(len(results["b"][0]), 2)
+        self.assertEqual(self.client._compare_and_swap_block.call_count, 1)
+        self.assertEqual(sorted(self.client._increment_handle.call_args_list),
+                         [call("a", BLOCK, 1), call("b", BLOCK, 2)])
+        self.assertEqual(self.coalescer.stats(),
+                         {"batches": 1, "allocations": 2, "cas_conflicts": 0,
+                          "fallbacks": 0})
+
+    def test_conflict_retried(self):
+        self.client._compare_and_swap_block.side_effect = [CASError(), None]
+        allocation = _Allocation(1, 0, "a")
+        self.coalescer._assign([allocation])
+        self.assertEqual(allocation.assigned[4], [BLOCK[0]])
+        self.client._decrement_handle.assert_called_once_with("a", BLOCK, 1)
+        self.assertEqual(self.coalescer.stats()["cas_conflicts"], 1)
+
+    def test_shortfall_assigned_individually(self):
+        allocations = [_Allocation(3, 0, "a"), _Allocation(2, 1, "b")]
+        self.client.auto_assign_ips.return_value = (
+            [IPAddress("10.0.0.1")], [IPAddress("fd00::1")])
+        self.coalescer._assign(allocations)
+
+        self.assertEqual(allocations[0].assigned[4], list(BLOCK)[:3])
+        self.assertEqual(allocations[1].assigned, {
+            4: [BLOCK[3], IPAddress("10.0.0.1")], 6: [IPAddress("fd00::1")]})
+        self.assertFalse(allocations[1].exc_info)
+        self.client.auto_assign_ips.assert_called_once_with(
+            1, 1, "b", {}, hostname="host")
+
+    def test_failed_fallback_releases_addresses(self):
+        self.client.auto_assign_ips.side_effect = IOError("etcd unavailable")
+        allocation = _Allocation(5, 0, "a")
+        self.coalescer._assign([allocation])
+        self.assertEqual(allocation.exc_info[0], IOError)
+        self.client.release_ips.assert_called_once_with(set(BLOCK))
@@ -0,0 +1,99 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+from mock import patch
+import calico_mesos_client
+from calico_mesos_client import DaemonUnavailable
+from isolator_daemon import IsolatorServer, DaemonRunning
+
+
+class TestDaemonRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, "isolator.sock")
+        self.requests = []
+
+        def handler(raw_request):
+            self.requests.append(raw_request)
+            return 1, '{"error": "bad"}'
+
+        self.server = IsolatorServer(self.socket_path, handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_request_is_forwarded(self):
+        result = calico_mesos_client.send_request('{"command": "cleanup"}',
+                                                  self.socket_path)
+        self.assertEqual(result, (1, '{"error": "bad"}'))
+        self.assertEqual(self.requests, ['{"command": "cleanup"}'])
+
+    def test_socket_is_removed_on_close(self):
+        self.server.server_close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_running_daemon_keeps_its_socket(self):
+        self.assertRaises(DaemonRunning, IsolatorServer, self.socket_path,
+                          None)
+        result = calico_mesos_client.send_request('{"command": "cleanup"}',
+                                                  self.socket_path)
+        self.assertEqual(result, (1, '{"error": "bad"}'))
+
+
+class TestStaleSocket(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, "isolator.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stale_socket_is_replaced(self):
+        # Bound by a daemon which died without removing it.
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+
+        server = IsolatorServer(self.socket_path, lambda raw: (0, "{}"))
+        server.server_close()
+
+
+class TestClient(unittest.TestCase):
+    def test_missing_daemon_is_unavailable(self):
+        with self.assertRaises(DaemonUnavailable):
+            calico_mesos_client.send_request("{}", "/nonexistent/socket")
+
+    @patch('calico_mesos_client.run_isolator', return_value=(0, "{}"))
+    @patch('calico_mesos_client.send_request',
+           side_effect=DaemonUnavailable())
+    @patch('sys.stdout')
+    @patch('sys.stdin')
+    def test_falls_back_to_isolator(self, m_stdin, m_stdout, m_send,
+                                    m_run_isolator):
+        m_stdin.read.return_value = '{"command": "release"}'
+        with self.assertRaises(SystemExit) as e:
+            calico_mesos_client.main()
+        self.assertEqual(e.exception.code, 0)
+        m_run_isolator.assert_called_once_with('{"command": "release"}')
+        m_stdout.write.assert_called_once_with("{}")
@@ -0,0 +1,167 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import unittest
+from mock import Mock
+from etcd import EtcdKeyNotFound, EtcdEventIndexCleared
+from netaddr import IPNetwork
+from datastore_mirror import DatastoreMirror
+
+ENDPOINTS = "/calico/v1/host/metaman/workload/mesos/"
+PROFILES = "/calico/v1/policy/profile/"
+POOLS = "/calico/v1/ipam/v4/pool/"
+ENDPOINT_JSON = json.dumps({"state": "active", "name": "cali1234",
+                            "mac": "ee:ee:ee:ee:ee:ee",
+                            "profile_ids": ["ng_prod"],
+                            "ipv4_nets": ["192.168.0.1/32"],
+                            "ipv6_nets": []})
+
+
+def _node(key, value=None, action="get", index=10):
+    return Mock(key=key, value=value, dir=value is None, action=action,
+                modifiedIndex=index)
+
+
+class TestDatastoreMirror(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.mirror = DatastoreMirror(self.client, "metaman", "mesos")
+        self.endpoints = self.mirror._endpoints
+        self.profiles = self.mirror._profiles
+        self.pools = self.mirror._pools[4]
+
+    def _resync(self, subtree, leaves, index=100):
+        self.client.read.return_value = Mock(leaves=leaves, etcd_index=index)
+        self.mirror._resync(subtree)
+
+    def _event(self, subtree, action, key, value=None, index=101):
+        self.client.read.return_value = _node(key, value, action, index)
+        self.mirror._watch(subtree)
+
+    def test_out_of_sync_until_read(self):
+        self.assertIsNone(self.mirror.get_endpoints())
+        self.assertIsNone(self.mirror.profile_exists("ng_prod"))
+        self.assertIsNone(self.mirror.get_ip_pools(4))
+        self._resync(self.pools, [])
+        self.assertEqual(self.mirror.get_ip_pools(4), [])
+        self.assertIsNone(self.mirror.get_ip_pools(6))
+
+    def test_endpoints(self):
+        self._resync(self.endpoints, [
+            _node(ENDPOINTS + "c1/endpoint/e1", ENDPOINT_JSON),
+            _node(ENDPOINTS + "c2/endpoint/e2", ENDPOINT_JSON)])
+        endpoint, = self.mirror.get_endpoints("c1")
+        self.assertEqual((endpoint.hostname, endpoint.orchestrator_id,
+                          endpoint.workload_id, endpoint.endpoint_id),
+                         ("metaman", "mesos", "c1", "e1"))
+        self.assertEqual(endpoint.ipv4_nets,
+                         set([IPNetwork("192.168.0.1/32")]))
+        self.assertEqual(endpoint.profile_ids, ["ng_prod"])
+
+        # Watching continues from the index of the read.
+        self._event(self.endpoints, "delete", ENDPOINTS + "c1")
+        self.assertEqual(self.client.read.call_args[1]["waitIndex"], 101)
+        self._event(self.endpoints, "set", ENDPOINTS + "c3/endpoint/e3",
+                    ENDPOINT_JSON, index=102)
+        self.assertEqual(self.client.read.call_args[1]["waitIndex"], 102)
+        self.assertEqual(sorted(endpoint.workload_id for endpoint in
+                                self.mirror.get_endpoints()), ["c2", "c3"])
+        self.assertEqual(self.mirror.get_endpoints("c1"), [])
+
+    def test_profiles(self):
+        self._resync(self.profiles, [_node(PROFILES + "a/rules", "{}"),
+                                     _node(PROFILES + "a/tags", "[]"),
+                                     _node(PROFILES + "b/tags", "[]")])
+        self.assertTrue(self.mirror.profile_exists("a"))
+        self.assertFalse(self.mirror.profile_exists("b"))
+        self._event(self.profiles, "create", PROFILES + "b/rules", "{}")
+        self._event(self.profiles, "delete", PROFILES + "a")
+        self.assertFalse(self.mirror.profile_exists("a"))
+        self.assertTrue(self.mirror.profile_exists("b"))
+
+    def test_missing_directory(self):
+        self.client.read.side_effect = EtcdKeyNotFound("Key not found",
+                                                       {"index": 42})
+        self.mirror._resync(self.pools)
+        self.assertEqual(self.mirror.get_ip_pools(4), [])
+        self.assertEqual(self.pools.index, 43)
+
+        self.client.read.side_effect = None
+        self._event(self.pools, "set", POOLS + "10.0.0.0-8",
+                    json.dumps({"cidr": "10.0.0.0/8"}))
+        pool, = self.mirror.get_ip_pools(4)
+        self.assertEqual(pool.cidr, IPNetwork("10.0.0.0/8"))
+
+    def test_missed_events_reread(self):
+        self._resync(self.profiles, [_node(PROFILES + "a/rules", "{}")])
+        responses = [
+            EtcdEventIndexCleared(),
+            Mock(leaves=[_node(PROFILES + "b/rules", "{}")], etcd_index=200)]
+
+        def read(*args, **kwargs):
+            if not responses:
+                self.mirror._stopping.set()
+                raise EtcdEventIndexCleared()
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        self.client.read.side_effect = read
+        self.mirror._run(self.profiles)
+
+        self.assertEqual(self.mirror.stats()["resyncs"], 2)
+        self.assertEqual(self.profiles.names, set(["b"]))
+        self.assertEqual(self.profiles.index, 201)
+
+    def test_local_writes(self):
+        self._resync(self.endpoints, [])
+        endpoint = Mock(workload_id="c1", endpoint_id="e1", state="active",
+                        mac="ee:ee:ee:ee:ee:ee", ipv4_nets=set(),
+                        ipv6_nets=set(), profile_ids=["ng_prod"],
+                        hostname="metaman", orchestrator_id="mesos")
+        self.mirror.endpoint_written(endpoint)
+        self.assertEqual(len(self.mirror.get_endpoints("c1")), 1)
+        self.mirror.workload_removed("c1")
+        self.assertEqual(self.mirror.get_endpoints(), [])
+
+    def test_late_events_do_not_restore_removed_workload(self):
+        self._resync(self.endpoints, [])
+        self.mirror.workload_removed("c1")
+
+        # Written before the removal, but reported after it.
+        self._event(self.endpoints, "set", ENDPOINTS + "c1/endpoint/e1",
+                    ENDPOINT_JSON, index=101)
+        self.assertEqual(self.mirror.get_endpoints(), [])
+        self._event(self.endpoints, "delete", ENDPOINTS + "c1/endpoint/e1",
+                    index=102)
+        self._event(self.endpoints, "set", ENDPOINTS + "c1/endpoint/e1",
+                    ENDPOINT_JSON, index=103)
+        self.assertEqual(self.mirror.get_endpoints(), [])
+
+        # Once the watch reports the removal, the workload may come back.
+        self._event(self.endpoints, "delete", ENDPOINTS + "c1", index=104)
+        self._event(self.endpoints, "set", ENDPOINTS + "c1/endpoint/e2",
+                    ENDPOINT_JSON, index=105)
+        self.assertEqual(len(self.mirror.get_endpoints("c1")), 1)
+
+    def test_read_from_before_removal_ignored(self):
+        self.mirror.workload_removed("c1")
+        self._resync(self.endpoints,
+                     [_node(ENDPOINTS + "c1/endpoint/e1", ENDPOINT_JSON)])
+        self.assertEqual(self.mirror.get_endpoints(), [])
+        self.assertEqual(self.endpoints.removed, set(["c1"]))
+
+        # A read without the workload ends the tombstone.
+        self._resync(self.endpoints, [])
+        self.assertEqual(self.endpoints.removed, set())
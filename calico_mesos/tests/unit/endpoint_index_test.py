@@ -0,0 +1,88 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+from netaddr import IPNetwork
+from pycalico.datastore_datatypes import Endpoint
+from endpoint_index import EndpointIndex, endpoint_record, \
+    endpoint_from_record
+
+
+def _endpoint(container_id):
+    endpoint = Endpoint("host", "mesos", container_id, "ep-" + container_id,
+                        "active", "ee:ee:ee:ee:ee:ee")
+    endpoint.ipv4_nets.add(IPNetwork("192.168.0.1/32"))
+    endpoint.ipv6_nets.add(IPNetwork("dead::beef/128"))
+    endpoint.profile_ids = ["default_host", "public"]
+    return endpoint
+
+
+class TestEndpointIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = EndpointIndex(os.path.join(self.tmpdir, "endpoints"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_and_remove(self):
+        self.assertIsNone(self.index.get("a/b"))
+        self.index.add("a/b", _endpoint("a/b"))
+        self.assertEqual(self.index.get("a/b"),
+                         endpoint_record(_endpoint("a/b")))
+        self.index.remove("a/b")
+        self.index.remove("a/b")
+        self.assertIsNone(self.index.get("a/b"))
+
+    def test_file_names_unchanged(self):
+        # Indexes written when file names were made by urllib.quote are
+        # still read.
+        self.index.add("a/b c~", _endpoint("a/b c~"))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, "endpoints", "a%2Fb%20c%7E")))
+
+    def test_rebuild_replaces_entries(self):
+        self.index.add("stale", _endpoint("stale"))
+        self.assertFalse(self.index.is_complete())
+
+        self.index.rebuild(lambda: [_endpoint("live")])
+
+        self.assertTrue(self.index.is_complete())
+        self.assertIsNone(self.index.get("stale"))
+        self.assertEqual(self.index.get("live"),
+                         endpoint_record(_endpoint("live")))
+
+    def test_endpoints(self):
+        self.index.rebuild(lambda: [_endpoint("a"), _endpoint("b")])
+        self.assertEqual(
+            sorted(endpoint.workload_id
+                   for endpoint in self.index.endpoints()), ["a", "b"])
+
+    def test_failed_rebuild_leaves_index_incomplete(self):
+        self.index.rebuild(lambda: [])
+
+        def fail():
+            raise KeyError()
+        self.assertRaises(KeyError, self.index.rebuild, fail)
+        self.assertFalse(self.index.is_complete())
+
+    def test_endpoint_round_trip(self):
+        endpoint = endpoint_from_record(endpoint_record(_endpoint("a")))
+        self.assertEqual(endpoint.endpoint_id, "ep-a")
+        self.assertEqual(endpoint.mac, "ee:ee:ee:ee:ee:ee")
+        self.assertEqual(endpoint.ipv4_nets, set([IPNetwork("192.168.0.1/32")]))
+        self.assertEqual(endpoint.ipv6_nets, set([IPNetwork("dead::beef/128")]))
+        self.assertEqual(endpoint.profile_ids, ["default_host", "public"])
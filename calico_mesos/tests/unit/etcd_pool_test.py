@@ -0,0 +1,88 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from mock import Mock, patch
+from urllib3 import PoolManager
+import etcd_pool
+from etcd_pool import EtcdPoolManager
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        status = 200 if self.path == "/version" else 404
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("{}")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestEtcdPoolManager(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/version" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_reused(self):
+        pool = EtcdPoolManager(4, 60)
+        for _ in range(4):
+            pool.request("GET", self.url)
+        stats = pool.stats()
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["requests"], 4)
+        self.assertEqual(stats["reuse_rate"], 0.75)
+
+    @patch('time.time', return_value=1000)
+    def test_idle_connections_dropped(self, m_time):
+        pool = EtcdPoolManager(4, 60)
+        pool.request("GET", self.url)
+        m_time.return_value = 1061
+        pool.request("GET", self.url)
+        stats = pool.stats()
+        self.assertEqual(stats["idle_resets"], 1)
+        self.assertEqual(stats["connections"], 2)
+        self.assertEqual(stats["requests"], 2)
+
+    def test_failed_health_check_drops_connections(self):
+        pool = EtcdPoolManager(4, 60)
+        self.assertTrue(pool.health_check(self.url))
+        self.assertFalse(pool.health_check(self.url + "/missing"))
+        self.assertEqual(len(pool.pools), 0)
+        stats = pool.stats()
+        self.assertEqual(stats["health_checks"], 2)
+        self.assertEqual(stats["health_check_failures"], 1)
+        self.assertEqual(stats["requests"], 2)
+
+
+class TestInstall(unittest.TestCase):
+    def test_keeps_client_settings(self):
+        client = Mock()
+        client.http = PoolManager(10, cert_reqs="CERT_REQUIRED", maxsize=1)
+        pool = etcd_pool.install(client, 8, 30)
+        self.assertIs(client.http, pool)
+        self.assertEqual(pool.connection_pool_kw,
+                         {"cert_reqs": "CERT_REQUIRED", "maxsize": 8})
+        self.assertEqual(pool.idle_timeout, 30)
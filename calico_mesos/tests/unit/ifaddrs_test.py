@@ -0,0 +1,89 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import errno
+import socket
+import struct
+import unittest
+from mock import patch, Mock
+import ifaddrs
+
+
+def _rtattr(attr_type, value):
+    attr = struct.pack("=HH", 4 + len(value), attr_type) + value
+    return attr + "\0" * (ifaddrs._align(len(attr)) - len(attr))
+
+
+def _newaddr(family, address, prefixlen, label):
+    payload = (struct.pack("=BBBBi", family, prefixlen, 0, 0, 1) +
+               _rtattr(ifaddrs.IFA_LOCAL, socket.inet_pton(family, address)) +
+               _rtattr(ifaddrs.IFA_LABEL, label + "\0"))
+    return struct.pack("=LHHLL", 16 + len(payload), ifaddrs.RTM_NEWADDR,
+                       0, 1, 0) + payload
+
+
+DONE = struct.pack("=LHHLLi", 20, ifaddrs.NLMSG_DONE, 0, 1, 0, 0)
+
+
+class TestParseAddrMessages(unittest.TestCase):
+    def test_parses_ipv4_addresses(self):
+        data = (_newaddr(socket.AF_INET, "127.0.0.1", 8, "lo") +
+                _newaddr(socket.AF_INET, "172.16.0.5", 16, "eth0"))
+        addresses, done = ifaddrs.parse_addr_messages(data)
+        self.assertEqual(addresses, [("lo", "127.0.0.1", 8),
+                                     ("eth0", "172.16.0.5", 16)])
+        self.assertFalse(done)
+
+    def test_ignores_ipv6_and_stops_at_done(self):
+        data = (_newaddr(socket.AF_INET6, "fe80::1", 64, "eth0") + DONE +
+                _newaddr(socket.AF_INET, "172.16.0.5", 16, "eth0"))
+        self.assertEqual(ifaddrs.parse_addr_messages(data), ([], True))
+
+    def test_netlink_error_is_raised(self):
+        data = struct.pack("=LHHLLi", 20, ifaddrs.NLMSG_ERROR, 0, 1, 0,
+                           -errno.EPERM)
+        self.assertRaises(OSError, ifaddrs.parse_addr_messages, data)
+
+
+class TestAddressCache(unittest.TestCase):
+    def setUp(self):
+        self.reader = Mock(return_value=[("eth0", "172.16.0.5", 16)])
+        self.monitor = Mock()
+        self.cache = ifaddrs.AddressCache(self.reader)
+        patcher = patch.object(ifaddrs.AddressCache, "_open_monitor",
+                               return_value=self.monitor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _set_notifications(self, count):
+        self.monitor.recv.side_effect = (
+            ["notification"] * count + [socket.error(errno.EAGAIN, "")])
+
+    def test_cached_until_change(self):
+        self._set_notifications(0)
+        self.cache.get()
+        self._set_notifications(0)
+        self.assertEqual(self.cache.get(), [("eth0", "172.16.0.5", 16)])
+        self.assertEqual(self.reader.call_count, 1)
+
+        self._set_notifications(2)
+        self.cache.get()
+        self.assertEqual(self.reader.call_count, 2)
+
+    def test_dropped_notifications_invalidate(self):
+        self._set_notifications(0)
+        self.cache.get()
+        self.monitor.recv.side_effect = [socket.error(errno.ENOBUFS, ""),
+                                         socket.error(errno.EAGAIN, "")]
+        self.cache.get()
+        self.assertEqual(self.reader.call_count, 2)
@@ -0,0 +1,71 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+from netaddr import IPAddress, IPNetwork
+from nose_parameterized import parameterized
+from ip_ranges import parse, AddressRanges
+
+
+class TestParse(unittest.TestCase):
+    @parameterized.expand([
+        ("10.0.0.1", (4, 0x0a000001, 0x0a000001)),
+        ("10.0.0.0/30", (4, 0x0a000000, 0x0a000003)),
+        ("10.0.0.8 - 10.0.0.9", (4, 0x0a000008, 0x0a000009)),
+        ("fd00::/127", (6, 0xfd << 120, (0xfd << 120) + 1)),
+        (167772161, (4, 0x0a000001, 0x0a000001)),
+    ])
+    def test_valid(self, entry, expected):
+        self.assertEqual(parse([entry]), ([expected], []))
+
+    def test_every_error_reported(self):
+        parsed, errors = parse(["10.0.0.1", "10.0.0.256", "10.0.0.1/33",
+                                "10.0.0.1/30", "10.0.0.1-fd00::1", "fd00::1"],
+                               ip_version=4)
+        self.assertEqual(parsed, [(4, 0x0a000001, 0x0a000001)])
+        self.assertEqual(errors, [
+            "IP address could not be parsed: 10.0.0.256",
+            "IP range could not be parsed: 10.0.0.1/33",
+            "IP range could not be parsed: 10.0.0.1/30",
+            "IP range could not be parsed: 10.0.0.1-fd00::1",
+            "IPv6 address must not be placed in IPv4 address field."])
+
+    def test_ranges_not_allowed(self):
+        self.assertEqual(parse(["10.0.0.0/30"], allow_ranges=False),
+                         ([], ["IP address could not be parsed: 10.0.0.0/30"]))
+
+
+class TestAddressRanges(unittest.TestCase):
+    def test_merged(self):
+        parsed, _ = parse(["10.0.0.4/30", "10.0.0.1-10.0.0.3", "10.0.0.2",
+                           "10.0.0.9", "fd00::1"])
+        addresses = AddressRanges(parsed)
+        self.assertEqual(str(addresses),
+                         "[10.0.0.1-10.0.0.7, 10.0.0.9, fd00::1]")
+        self.assertEqual(len(addresses), 9)
+        self.assertEqual(list(addresses)[:2],
+                         [IPAddress("10.0.0.1"), IPAddress("10.0.0.2")])
+
+    def test_by_block(self):
+        parsed, _ = parse(["10.0.0.62-10.0.0.129", "fd00::3f-fd00::40"])
+        blocks = AddressRanges(parsed).by_block()
+        self.assertEqual(blocks.keys(), [IPNetwork("10.0.0.0/26"),
+                                         IPNetwork("10.0.0.64/26"),
+                                         IPNetwork("10.0.0.128/26"),
+                                         IPNetwork("fd00::/122"),
+                                         IPNetwork("fd00::40/122")])
+        self.assertEqual(len(blocks[IPNetwork("10.0.0.64/26")]), 64)
+        self.assertEqual(blocks[IPNetwork("10.0.0.128/26")],
+                         [IPAddress("10.0.0.128"), IPAddress("10.0.0.129")])
+        self.assertEqual(blocks[IPNetwork("fd00::40/122")],
+                         [IPAddress("fd00::40")])
@@ -0,0 +1,119 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+from mock import Mock, patch
+from netaddr import IPAddress, IPNetwork
+from pycalico.ipam import IPAMClient
+from ip_reservoir import IPReservoir
+from ipam_blocks import AssignmentFailed
+
+ADDRESSES = [IPAddress("192.168.1.1"), IPAddress("192.168.1.2"),
+             IPAddress("192.168.1.65")]
+
+
+class TestIPReservoir(unittest.TestCase):
+    def setUp(self):
+        self.datastore = Mock(spec=IPAMClient)
+        self.datastore.auto_assign_ips.return_value = (list(ADDRESSES), [])
+        self.reservoir = IPReservoir(self.datastore, "host",
+                                     {4: (1, 3), 6: (0, 0)})
+
+    def test_refill_to_high_watermark(self):
+        self.reservoir.refill()
+        self.datastore.auto_assign_ips.assert_called_once_with(
+            3, 0, "calico-mesos-reservoir-host", {}, hostname="host")
+        self.assertEqual(self.reservoir.stats()["ipv4"], 3)
+
+        # Above the low watermark, so no refill.
+        self.reservoir.refill()
+        self.assertEqual(self.datastore.auto_assign_ips.call_count, 1)
+
+    @patch('ip_reservoir.rebind_block_addresses', autospec=True)
+    def test_allocate_rebinds_addresses(self, m_rebind):
+        self.reservoir.refill()
+        m_rebind.side_effect = \
+            lambda client, cidr, addresses, *args: args[-1].extend(addresses)
+
+        result = self.reservoir.allocate(2, 0, "uid")
+
+        self.assertEqual(result, (ADDRESSES[:2], []))
+        self.assertFalse(self.datastore.release_ips.called)
+        m_rebind.assert_called_once_with(
+            self.datastore, IPNetwork("192.168.1.0/26"), ADDRESSES[:2],
+            "calico-mesos-reservoir-host", "uid", {}, ADDRESSES[:2])
+        self.assertEqual(self.reservoir.stats(),
+                         {"ipv4": 1, "ipv6": 0, "hits": 1, "misses": 0,
+                          "rebind_failures": 0})
+
+        # The reservoir handle is decremented outside the request.
+        self.assertFalse(self.datastore._decrement_handle.called)
+        self.reservoir._decrement_moved()
+        self.datastore._decrement_handle.assert_called_once_with(
+            "calico-mesos-reservoir-host", IPNetwork("192.168.1.0/26"), 2)
+
+    @patch('ip_reservoir.rebind_block_addresses', autospec=True)
+    def test_lost_addresses_are_replaced(self, m_rebind):
+        self.reservoir.refill()
+        self.datastore.auto_assign_ips.return_value = \
+            ([IPAddress("192.168.1.9")], [])
+
+        result = self.reservoir.allocate(1, 0, "uid")
+
+        self.assertEqual(result, ([IPAddress("192.168.1.9")], []))
+        self.datastore.auto_assign_ips.assert_called_with(
+            1, 0, "uid", {}, hostname="host")
+
+    @patch('ip_reservoir.rebind_block_addresses', autospec=True)
+    def test_failed_rebind_keeps_addresses(self, m_rebind):
+        self.reservoir.refill()
+        m_rebind.side_effect = AssignmentFailed(ADDRESSES[0], "max retries")
+        self.datastore.auto_assign_ips.return_value = \
+            ([IPAddress("192.168.1.9")], [])
+
+        self.reservoir.allocate(1, 0, "uid")
+
+        stats = self.reservoir.stats()
+        self.assertEqual(stats["rebind_failures"], 1)
+        self.assertEqual(stats["ipv4"], 3)
+
+    @patch('ip_reservoir.rebind_block_addresses', autospec=True)
+    def test_rebound_addresses_released_on_failure(self, m_rebind):
+        self.reservoir.refill()
+
+        def rebind(client, cidr, addresses, *args):
+            # Only the first block's addresses are still in the reservoir.
+            if cidr == IPNetwork("192.168.1.0/26"):
+                args[-1].extend(addresses)
+        m_rebind.side_effect = rebind
+        self.datastore.auto_assign_ips.side_effect = RuntimeError("no pool")
+
+        self.assertRaises(RuntimeError, self.reservoir.allocate, 3, 0, "uid")
+
+        self.datastore.release_ips.assert_called_once_with(
+            set(ADDRESSES[:2]))
+
+    def test_allocate_when_too_few(self):
+        self.assertIsNone(self.reservoir.allocate(1, 0, "uid"))
+        self.assertIsNone(self.reservoir.allocate(0, 1, "uid"))
+        self.assertFalse(self.datastore.release_ips.called)
+        self.assertEqual(self.reservoir.stats()["misses"], 2)
+
+    def test_handle_released_on_start_and_stop(self):
+        self.datastore.release_ip_by_handle.side_effect = KeyError
+        self.reservoir.start()
+        self.reservoir.stop()
+        self.assertEqual(self.datastore.release_ip_by_handle.call_count, 2)
+        self.datastore.release_ip_by_handle.assert_called_with(
+            "calico-mesos-reservoir-host")
+        self.assertEqual(self.reservoir.stats()["ipv4"], 0)
@@ -0,0 +1,113 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+from mock import Mock, call
+from netaddr import IPAddress, IPNetwork
+from pycalico.ipam import IPAMClient, CASError
+import ipam_blocks
+from ipam_blocks import AssignmentFailed
+
+BLOCK = IPNetwork("192.168.1.0/26")
+ADDRESSES = [IPAddress("192.168.1.1"), IPAddress("192.168.1.2")]
+
+
+class TestAssignBlockAddresses(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock(spec=IPAMClient)
+        self.assigned = []
+
+    def test_group_by_block(self):
+        addresses = ADDRESSES + [IPAddress("192.168.1.64")]
+        self.assertEqual(ipam_blocks.group_by_block(addresses).items(),
+                         [(BLOCK, ADDRESSES),
+                          (IPNetwork("192.168.1.64/26"), addresses[2:])])
+
+    def test_cas_is_retried(self):
+        self.client._compare_and_swap_block.side_effect = [CASError(), None]
+
+        ipam_blocks.assign_block_addresses(self.client, BLOCK, ADDRESSES,
+                                           "uid", {}, "host", self.assigned)
+
+        self.assertEqual(self.assigned, ADDRESSES)
+        self.assertEqual(self.client._read_block.call_count, 2)
+        self.assertEqual(self.client._increment_handle.call_args_list,
+                         [call("uid", BLOCK, 2)] * 2)
+        self.client._decrement_handle.assert_called_once_with("uid", BLOCK, 2)
+
+    def test_missing_block_is_claimed_by_first_address(self):
+        self.client._read_block.side_effect = [KeyError(), Mock()]
+
+        ipam_blocks.assign_block_addresses(self.client, BLOCK, ADDRESSES,
+                                           "uid", {}, "host", self.assigned)
+
+        self.client.assign_ip.assert_called_once_with(ADDRESSES[0], "uid", {},
+                                                      "host")
+        self.client._increment_handle.assert_called_once_with("uid", BLOCK, 1)
+        self.assertEqual(self.assigned, ADDRESSES)
+
+    def test_address_not_in_pool(self):
+        self.client._read_block.side_effect = KeyError()
+        self.client.assign_ip.side_effect = ValueError()
+
+        with self.assertRaises(AssignmentFailed) as e:
+            ipam_blocks.assign_block_addresses(self.client, BLOCK, ADDRESSES,
+                                               "uid", {}, "host",
+                                               self.assigned)
+        self.assertEqual(e.exception.address, ADDRESSES[0])
+        self.assertEqual(self.assigned, [])
+
+
+class TestRebindBlockAddresses(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock(spec=IPAMClient)
+        self.block = self.client._read_block.return_value
+        self.block.release.return_value = (set(), {"reservoir": 1})
+        self.assigned = []
+
+    def test_addresses_move_in_one_cas(self):
+        ipam_blocks.rebind_block_addresses(self.client, BLOCK, ADDRESSES,
+                                           "reservoir", "uid", {},
+                                           self.assigned)
+
+        self.assertEqual(self.assigned, ADDRESSES)
+        self.assertEqual(self.block.assign.call_args_list,
+                         [call(address, "uid", {}) for address in ADDRESSES])
+        self.client._increment_handle.assert_called_once_with("uid", BLOCK, 2)
+        self.client._compare_and_swap_block.assert_called_once_with(
+            self.block)
+        self.assertFalse(self.client.release_ips.called)
+        self.assertFalse(self.client._decrement_handle.called)
+
+    def test_addresses_of_other_handles_not_moved(self):
+        self.block.release.side_effect = [
+            (set(), {"reservoir": 1}), (set(), {"other": 1}),
+            (set(), {"reservoir": 1})]
+
+        ipam_blocks.rebind_block_addresses(self.client, BLOCK, ADDRESSES,
+                                           "reservoir", "uid", {},
+                                           self.assigned)
+
+        self.assertEqual(self.assigned, ADDRESSES[:1])
+        self.assertEqual(self.client._read_block.call_count, 2)
+        self.block.assign.assert_called_once_with(ADDRESSES[0], "uid", {})
+
+    def test_cas_is_retried(self):
+        self.client._compare_and_swap_block.side_effect = [CASError(), None]
+
+        ipam_blocks.rebind_block_addresses(self.client, BLOCK, ADDRESSES,
+                                           "reservoir", "uid", {},
+                                           self.assigned)
+
+        self.assertEqual(self.assigned, ADDRESSES)
+        self.client._decrement_handle.assert_called_once_with("uid", BLOCK, 2)
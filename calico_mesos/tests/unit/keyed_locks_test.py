@@ -0,0 +1,79 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import threading
+import unittest
+from keyed_locks import KeyedLocks, LockTimeout
+
+
+class TestKeyedLocks(unittest.TestCase):
+    def setUp(self):
+        self.locks = KeyedLocks(5)
+
+    def _hold_in_thread(self, keys, seconds):
+        acquired = threading.Event()
+
+        def hold():
+            with self.locks.hold(keys):
+                acquired.set()
+                time.sleep(seconds)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait()
+        return thread
+
+    def test_same_key_waits(self):
+        thread = self._hold_in_thread([("container", "a")], 0.1)
+        waited = self.locks.acquire([("container", "a")])
+        self.locks.release([("container", "a")])
+        thread.join()
+        self.assertGreater(waited, 0.05)
+        stats = self.locks.stats()
+        self.assertEqual((stats["acquired"], stats["contended"],
+                          stats["held"], stats["waiting"]), (2, 1, 0, 0))
+
+    def test_other_keys_do_not_wait(self):
+        thread = self._hold_in_thread([("container", "a")], 0.2)
+        self.assertEqual(self.locks.acquire([("container", "b"),
+                                             ("uid", "a")]), 0.0)
+        self.assertEqual(self.locks.stats()["held"], 3)
+        self.locks.release([("container", "b"), ("uid", "a")])
+        thread.join()
+
+    def test_timeout_releases_acquired_keys(self):
+        self.locks.timeout = 0.05
+        thread = self._hold_in_thread([("container", "b")], 0.2)
+        with self.assertRaises(LockTimeout) as e:
+            self.locks.acquire([("container", "b"), ("container", "a")])
+        self.assertEqual(str(e.exception),
+                         "Timed out after 0.05s waiting for container b")
+        # "a" sorts first, so was taken and must have been given back.
+        self.assertEqual(self.locks.acquire([("container", "a")]), 0.0)
+        thread.join()
+        self.assertEqual(self.locks.stats()["timeouts"], 1)
+
+    def test_overlapping_keys_do_not_deadlock(self):
+        def hold(keys):
+            for _ in range(200):
+                with self.locks.hold(keys):
+                    pass
+        threads = [threading.Thread(target=hold, args=(keys,)) for keys in
+                   ([("container", "a"), ("profile", "p")],
+                    [("profile", "p"), ("container", "a")])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.locks.stats()["timeouts"], 0)
+        self.assertEqual(self.locks._entries, {})
@@ -11,17 +11,27 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import shutil
+import tempfile
+import threading
 import unittest
-from mock import patch, MagicMock
+from mock import patch, MagicMock, call
 from mock import Mock
+from etcd import EtcdAlreadyExist
 import json
-from netaddr import IPAddress
+from netaddr import IPAddress, IPNetwork
 from nose_parameterized import parameterized
-from pycalico.datastore_datatypes import Rule, Endpoint, Profile
+from pycalico.datastore_datatypes import Rule, Endpoint
 from pycalico.block import AlreadyAssignedError
 import calico_mesos
 import socket
 from calico_mesos import IsolatorException
+from profile_cache import ProfileCache
+from endpoint_index import endpoint_record
+from keyed_locks import KeyedLocks
+from response_cache import ResponseCache
+from handle_records import HandleRecords
+from metrics import RequestMetrics
 from calico_mesos import ERROR_MISSING_COMMAND, \
     ERROR_MISSING_CONTAINER_ID, \
     ERROR_MISSING_HOSTNAME, \
@@ -73,7 +83,22 @@ class TestIsolate(unittest.TestCase):
           "hostname": "metaman",
           "ipv6_addrs": ["192.168.1.1"],
           "pid": 3789},
-         "IPv4 address must not be placed in IPv6 address field.")
+         "IPv4 address must not be placed in IPv6 address field."),
+
+        ({"container_id": "abcdef12345",
+          "hostname": "metaman",
+          "ipv4_addrs": ["1.1.1.1.1", "192.168.1.1", "fe80::"],
+          "ipv6_addrs": ["192.168.1.2"],
+          "pid": 3789},
+         "IP address could not be parsed: 1.1.1.1.1; "
+         "IPv6 address must not be placed in IPv4 address field.; "
+         "IPv4 address must not be placed in IPv6 address field."),
+
+        ({"container_id": "abcdef12345",
+          "hostname": "metaman",
+          "ipv4_addrs": ["192.168.1.0/30"],
+          "pid": 3789},
+         "IP address could not be parsed: 192.168.1.0/30")
     ])
     @patch('calico_mesos._isolate')
     def test_error_messages_with_invalid_params(self, args, error, m_isolate):
@@ -147,6 +172,91 @@ class TestAllocate(unittest.TestCase):
         self.assertTrue(m_allocate.called)
         self.assertEqual(result, m_allocate())
 
+    @patch('calico_mesos.datastore', autospec=True)
+    @patch('calico_mesos._ip_reservoir')
+    def test_allocate_from_reservoir(self, m_reservoir, m_datastore):
+        m_reservoir.allocate.return_value = ([IPAddress("192.168.1.1")], [])
+        result = calico_mesos._allocate(1, 0, "metaman", "uid")
+        m_reservoir.allocate.assert_called_once_with(1, 0, "uid")
+        self.assertFalse(m_datastore.auto_assign_ips.called)
+        self.assertEqual(json.loads(result),
+                         {"ipv4": ["192.168.1.1"], "ipv6": [], "error": None})
+
+    @patch('calico_mesos.datastore', autospec=True)
+    @patch('calico_mesos._ip_reservoir')
+    def test_allocate_when_reservoir_empty(self, m_reservoir, m_datastore):
+        m_reservoir.allocate.return_value = None
+        m_datastore.auto_assign_ips.return_value = ([], [])
+        calico_mesos._allocate(1, 0, "metaman", "uid")
+        m_datastore.auto_assign_ips.assert_called_once_with(
+            1, 0, "uid", {}, hostname=calico_mesos.HOSTNAME)
+
+    @patch('calico_mesos.datastore', autospec=True)
+    @patch('calico_mesos._allocation_coalescer')
+    def test_allocate_coalesced(self, m_coalescer, m_datastore):
+        m_coalescer.allocate.return_value = ([IPAddress("192.168.1.1")], [])
+        result = calico_mesos._allocate(1, 0, "metaman", "uid")
+        m_coalescer.allocate.assert_called_once_with(1, 0, "uid")
+        self.assertFalse(m_datastore.auto_assign_ips.called)
+        self.assertEqual(json.loads(result)["ipv4"], ["192.168.1.1"])
+
+
+    @patch('calico_mesos._handle_records')
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_allocate_records_handle_first(self, m_datastore, m_records):
+        m_records.get.return_value = None
+
+        def auto_assign_ips(*args, **kwargs):
+            m_records.add.assert_called_once_with("uid", allocated=True)
+            return [], []
+        m_datastore.auto_assign_ips.side_effect = auto_assign_ips
+        calico_mesos._allocate(1, 0, "metaman", "uid")
+        self.assertTrue(m_datastore.auto_assign_ips.called)
+
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_allocate_only_assigns_missing_addresses(self, m_datastore):
+        m_datastore.get_ip_assignments_by_handle.return_value = [
+            IPAddress("fd00::1"), IPAddress("192.168.1.1")]
+        m_datastore.auto_assign_ips.return_value = (
+            [IPAddress("192.168.1.2")], [])
+        result = calico_mesos._allocate(2, 1, "metaman", "uid")
+        m_datastore.auto_assign_ips.assert_called_once_with(
+            1, 0, "uid", {}, hostname=calico_mesos.HOSTNAME)
+        self.assertEqual(json.loads(result),
+                         {"ipv4": ["192.168.1.1", "192.168.1.2"],
+                          "ipv6": ["fd00::1"], "error": None})
+
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_allocate_looks_up_handle_only_on_retry(self, m_datastore):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        records = HandleRecords(tmpdir)
+        records.add("uid", reserved=[(4, int(IPAddress("192.168.2.1")),
+                                      int(IPAddress("192.168.2.1")))])
+        m_datastore.auto_assign_ips.return_value = (
+            [IPAddress("192.168.1.1")], [])
+        with patch('calico_mesos._handle_records', records):
+            calico_mesos._allocate(1, 0, "metaman", "uid")
+            self.assertFalse(m_datastore.get_ip_assignments_by_handle.called)
+            self.assertTrue(records.get("uid")["allocated"])
+
+            # The response was lost, so the request is retried.
+            m_datastore.get_ip_assignments_by_handle.return_value = [
+                IPAddress("192.168.1.1"), IPAddress("192.168.2.1")]
+            result = calico_mesos._allocate(1, 0, "metaman", "uid")
+        m_datastore.get_ip_assignments_by_handle.assert_called_once_with(
+            "uid")
+        self.assertEqual(m_datastore.auto_assign_ips.call_count, 1)
+        self.assertEqual(json.loads(result)["ipv4"], ["192.168.1.1"])
+
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_allocate_retry_assigns_nothing(self, m_datastore):
+        m_datastore.get_ip_assignments_by_handle.return_value = [
+            IPAddress("192.168.1.1")]
+        result = calico_mesos._allocate(1, 0, "metaman", "uid")
+        self.assertFalse(m_datastore.auto_assign_ips.called)
+        self.assertEqual(json.loads(result)["ipv4"], ["192.168.1.1"])
+
 
 class TestReserve(unittest.TestCase):
     @parameterized.expand([
@@ -159,6 +269,17 @@ class TestReserve(unittest.TestCase):
           "ipv6_addrs": ["dead::beef"],
           "uid": "abc-def-gh"},
         ERROR_MISSING_HOSTNAME),
+
+        ({"hostname": "metaman",
+          "ipv4_addrs": ["192.168.1.1/24", "192.168.1.9-192.168.1.2"],
+          "uid": "abc-def-gh"},
+        "IP range could not be parsed: 192.168.1.1/24; "
+        "IP range could not be parsed: 192.168.1.9-192.168.1.2"),
+
+        ({"hostname": "metaman",
+          "ipv6_addrs": ["dead::/64"],
+          "uid": "abc-def-gh"},
+        "Too many IP addresses: 18446744073709551616, the limit is 65536."),
     ])
     @patch('calico_mesos._reserve')
     def test_error_messages_with_invalid_params(self, args, error, m_reserve):
@@ -179,17 +300,46 @@ class TestReserve(unittest.TestCase):
         self.assertTrue(m_reserve.called)
         self.assertEqual(result, m_reserve())
 
+    @patch('calico_mesos._reserve')
+    def test_reserve_ranges(self, m_reserve):
+        calico_mesos.reserve({"hostname": "metaman", "uid": "abc-def-gh",
+                              "ipv4_addrs": ["192.168.1.4/30",
+                                             "192.168.1.2-192.168.1.5"],
+                              "ipv6_addrs": ["dead::beef"]})
+        _, _, ipv4_addrs, ipv6_addrs = m_reserve.call_args[0]
+        self.assertEqual(list(ipv4_addrs),
+                         [IPAddress("192.168.1.%d" % i) for i in range(2, 8)])
+        self.assertEqual(list(ipv6_addrs), [IPAddress("dead::beef")])
+
     @patch('calico_mesos.datastore', autospec=True)
     def test_reserve_is_functional(self, m_datastore):
         hostname = "metaman"
-        ipv4_addrs = ["192.168.1.1", "192.168.1.2"]
-        ipv6_addrs = ["dead::beef"]
+        ipv4_addrs = [IPAddress("192.168.1.1"), IPAddress("192.168.1.2")]
+        ipv6_addrs = [IPAddress("dead::beef")]
         uid = "abc-def-gh"
+        blocks = {}
+
+        def read_block(block_cidr):
+            return blocks.setdefault(block_cidr, Mock())
+        m_datastore._read_block.side_effect = read_block
+
         result = calico_mesos._reserve(hostname, uid, ipv4_addrs, ipv6_addrs)
         self.assertIsNone(result)
-        for ip_addr in ipv4_addrs + ipv6_addrs:
-            # TODO: workaround until hostname can be passed in
-            m_datastore.assign_ip.assert_any_call(ip_addr, uid, {}, HOSTNAME)
+
+        # One compare-and-swap per block.
+        self.assertEqual(sorted(blocks),
+                         [IPNetwork("192.168.1.0/26"),
+                          IPNetwork("dead::bec0/122")])
+        v4_block = blocks[IPNetwork("192.168.1.0/26")]
+        self.assertEqual(v4_block.assign.call_args_list,
+                         [call(ip_addr, uid, {}) for ip_addr in ipv4_addrs])
+        m_datastore._increment_handle.assert_any_call(
+            uid, IPNetwork("192.168.1.0/26"), 2)
+        m_datastore._increment_handle.assert_any_call(
+            uid, IPNetwork("dead::bec0/122"), 1)
+        self.assertEqual(m_datastore._compare_and_swap_block.call_count, 2)
+        self.assertFalse(m_datastore.assign_ip.called)
+        self.assertFalse(m_datastore.release_ips.called)
 
     @parameterized.expand([
         [ValueError],
@@ -199,15 +349,17 @@ class TestReserve(unittest.TestCase):
     @patch('calico_mesos.datastore')
     def test_reserve_rolls_back(self, exception, m_datastore):
         hostname = "metaman"
-        ipv4_addrs = ["192.168.1.1", "192.168.1.2"]
-        ipv6_addrs = ["dead::beef"]
+        ipv4_addrs = [IPAddress("192.168.1.1"), IPAddress("192.168.1.2")]
+        ipv6_addrs = [IPAddress("dead::beef")]
         uid = "abc-def-gh"
 
         def side_effect(address, handle_id, attributes, hostname):
-            if address == "192.168.1.2":
+            if address == IPAddress("192.168.1.2"):
                 # Arbitrarily throw an error when the second address is passed in
                 raise exception
 
+        # Blocks don't exist yet, so each address goes through assign_ip.
+        m_datastore._read_block.side_effect = KeyError
         m_assign_ip = MagicMock(side_effect=side_effect)
         m_datastore.assign_ip = m_assign_ip
 
@@ -216,8 +368,23 @@ class TestReserve(unittest.TestCase):
             calico_mesos._reserve(hostname, uid, ipv4_addrs, ipv6_addrs)
         self.assertEqual(e.exception.message, "IP '192.168.1.2' already in use.")
 
-        # Test that only the first IP was unassigned
-        m_datastore.release_ips.assert_called_once_with(set(["192.168.1.1"]))
+        # Test that every IP which was assigned was unassigned
+        m_datastore.release_ips.assert_called_once_with(
+            set([IPAddress("192.168.1.1"), IPAddress("dead::beef")]))
+
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_reserve_rolls_back_already_assigned_in_block(self, m_datastore):
+        v4_block = Mock()
+        v4_block.assign.side_effect = AlreadyAssignedError
+        m_datastore._read_block.return_value = v4_block
+
+        with self.assertRaises(IsolatorException) as e:
+            calico_mesos._reserve("metaman", "abc-def-gh",
+                                  [IPAddress("192.168.1.1")], [])
+        self.assertEqual(e.exception.message,
+                         "IP '192.168.1.1' already in use.")
+        self.assertFalse(m_datastore._compare_and_swap_block.called)
+        m_datastore.release_ips.assert_called_once_with(set())
 
 
 class TestRelease(unittest.TestCase):
@@ -251,9 +418,19 @@ class TestRelease(unittest.TestCase):
     def test_release_ips(self, args, m_release):
         result = calico_mesos.release(args)
 
-        m_release.assert_called_with(set([IPAddress(ip) for ip in args["ips"]]))
+        self.assertEqual(list(m_release.call_args[0][0]),
+                         [IPAddress(ip) for ip in args["ips"]])
         self.assertEqual(result, m_release())
 
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_release_range_by_block(self, m_datastore):
+        calico_mesos.release({"ips": ["192.168.1.62-192.168.1.65",
+                                      "192.168.1.63", "dead::beef"]})
+        self.assertEqual(sorted(m_datastore.release_ips.call_args_list), [
+            call(set([IPAddress("192.168.1.62"), IPAddress("192.168.1.63")])),
+            call(set([IPAddress("192.168.1.64"), IPAddress("192.168.1.65")])),
+            call(set([IPAddress("dead::beef")]))])
+
     @parameterized.expand([
     ({"uid": "abc-def-gh"},),
     ])
@@ -265,6 +442,36 @@ class TestRelease(unittest.TestCase):
         self.assertEqual(result, m_release())
 
 
+class TestReconcile(unittest.TestCase):
+    @patch('calico_mesos._reconciler', autospec=True)
+    def test_reconcile_given_containers(self, m_reconciler):
+        m_reconciler.return_value.run.return_value = {
+            "endpoints": ["abc"], "addresses": [], "pending": 0,
+            "failures": {}}
+        result = calico_mesos.reconcile({"containers": ["def"]})
+        m_reconciler.return_value.run.assert_called_once_with(set(["def"]))
+        self.assertEqual(json.loads(result), {
+            "endpoints": ["abc"], "addresses": [], "pending": 0,
+            "failures": {}, "error": None})
+
+    @patch('calico_mesos.AGENT_URL', None)
+    def test_reconcile_needs_containers(self):
+        with self.assertRaises(IsolatorException) as e:
+            calico_mesos.reconcile({})
+        self.assertEqual(e.exception.message, "Must supply containers, or "
+                                              "set CALICO_MESOS_AGENT_URL.")
+
+    @patch('calico_mesos.AGENT_URL', "http://localhost:5051")
+    @patch('reconciler.fetch_agent_containers', autospec=True)
+    @patch('calico_mesos._reconciler', autospec=True)
+    def test_reconcile_lists_agent_containers(self, m_reconciler, m_fetch):
+        m_fetch.return_value = set(["def"])
+        m_reconciler.return_value.run.return_value = {}
+        calico_mesos.reconcile({})
+        m_fetch.assert_called_once_with("http://localhost:5051")
+        m_reconciler.return_value.run.assert_called_once_with(set(["def"]))
+
+
 class TestDispatch(unittest.TestCase):
     @parameterized.expand([
         # Missing command
@@ -334,51 +541,268 @@ class TestDispatch(unittest.TestCase):
         calico_mesos.calico_mesos()
         m_release.assert_called_with(input["args"])
 
+    @patch('calico_mesos.process_request', return_value=None)
+    def test_handle_request_success(self, m_process):
+        exit_code, response = calico_mesos.handle_request('{"command": "x"}')
+        m_process.assert_called_once_with('{"command": "x"}')
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(json.loads(response), {"error": None})
+
+    @patch('calico_mesos.process_request',
+           side_effect=IsolatorException("Missing args"))
+    def test_handle_request_error(self, m_process):
+        exit_code, response = calico_mesos.handle_request('{"command": "x"}')
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(json.loads(response), {"error": "Missing args"})
+
+    @patch('calico_mesos._isolate')
+    @patch('calico_mesos._locks', KeyedLocks(0.05))
+    def test_same_container_requests_serialized(self, m_isolate):
+        request = {"command": "isolate",
+                   "args": {"container_id": "abc", "hostname": "metaman",
+                            "ipv4_addrs": ["192.168.1.1"], "pid": 3789}}
+        with calico_mesos._locks.hold([("container", "abc")]):
+            with self.assertRaises(IsolatorException) as e:
+                calico_mesos._dispatch(request)
+        self.assertEqual(e.exception.message,
+                         "Timed out after 0.05s waiting for container abc")
+        self.assertFalse(m_isolate.called)
+
+        request["args"]["container_id"] = "def"
+        with calico_mesos._locks.hold([("container", "abc")]):
+            calico_mesos._dispatch(request)
+        self.assertTrue(m_isolate.called)
+
+    @patch('calico_mesos._metrics_log')
+    def test_request_timings_logged(self, m_metrics_log):
+        lazy_datastore = calico_mesos._LazyDatastore()
+        lazy_datastore._client = Mock()
+
+        with patch('calico_mesos.datastore', lazy_datastore):
+            calico_mesos.process_request(json.dumps(
+                {"command": "release", "args": {"uid": "abc"}}))
+
+        lazy_datastore._client.release_ip_by_handle.assert_called_once_with(
+            "abc")
+        record = json.loads(m_metrics_log.info.call_args[0][0])
+        self.assertEqual(record["command"], "release")
+        self.assertEqual(record["uid"], "abc")
+        self.assertIsNone(record["error"])
+        self.assertEqual(record["phases"].keys(), ["release"])
+        self.assertEqual(
+            record["datastore"]["release_ip_by_handle"]["count"], 1)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.tmpdir, 60, 10)
+        patcher = patch('calico_mesos._response_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('calico_mesos.allocate')
+    def test_retry_returns_original_response(self, m_allocate):
+        m_allocate.side_effect = [
+            json.dumps({"ipv4": ["192.168.1.1"], "ipv6": [], "error": None}),
+            json.dumps({"ipv4": ["192.168.1.2"], "ipv6": [], "error": None})]
+        request = {"command": "allocate",
+                   "args": {"hostname": "metaman", "uid": "abc",
+                            "num_ipv4": 1, "num_ipv6": 0}}
+        first = calico_mesos._dispatch(request)
+        self.assertEqual(calico_mesos._dispatch(request), first)
+        self.assertEqual(m_allocate.call_count, 1)
+
+        # A different request for the uid is run.
+        request["args"]["num_ipv4"] = 2
+        self.assertNotEqual(calico_mesos._dispatch(request), first)
+        self.assertEqual(m_allocate.call_count, 2)
+
+    @patch('calico_mesos._release_ips')
+    @patch('calico_mesos._reserve', return_value=None)
+    def test_release_by_address_invalidates_reserve(self, m_reserve,
+                                                    m_release_ips):
+        request = {"command": "reserve",
+                   "args": {"hostname": "metaman", "uid": "abc",
+                            "ipv4_addrs": ["192.168.1.1"]}}
+        calico_mesos._dispatch(request)
+        calico_mesos._dispatch({"command": "release",
+                                "args": {"ips": ["192.168.1.1"]}})
+        calico_mesos._dispatch(request)
+        self.assertEqual(m_reserve.call_count, 2)
+
+    @patch('calico_mesos.isolate')
+    def test_failure_not_cached(self, m_isolate):
+        m_isolate.side_effect = [IsolatorException("etcd unavailable"), None]
+        request = {"command": "isolate",
+                   "args": {"container_id": "abc", "hostname": "metaman"}}
+        self.assertRaises(IsolatorException, calico_mesos._dispatch, request)
+        calico_mesos._dispatch(request)
+        calico_mesos._dispatch(request)
+        self.assertEqual(m_isolate.call_count, 2)
+
+    @patch('calico_mesos.isolate', return_value=None)
+    def test_drained_container_forgotten(self, m_isolate):
+        request = {"command": "isolate",
+                   "args": {"container_id": "abc", "hostname": "metaman"}}
+        calico_mesos._dispatch(request)
+        with patch('calico_mesos.datastore', autospec=True), \
+                patch('calico_mesos._endpoint_index', autospec=True):
+            calico_mesos._drain_container("abc", [])
+        calico_mesos._dispatch(request)
+        self.assertEqual(m_isolate.call_count, 2)
+
+
+class TestBatch(unittest.TestCase):
+    @patch('calico_mesos.release', return_value=None)
+    @patch('calico_mesos.allocate',
+           return_value=json.dumps({"ipv4": ["192.168.0.1"], "ipv6": [],
+                                    "error": None}))
+    @patch('sys.stdin')
+    def test_batch_returns_result_per_request(self, m_stdin, m_allocate,
+                                              m_release):
+        m_stdin.read.return_value = json.dumps([
+            {"command": "allocate", "args": {"uid": "a"}},
+            {"command": "release", "args": {"uid": "b"}},
+            {"command": "not-a-real-command", "args": {}},
+            {"args": {}}])
+
+        result = json.loads(calico_mesos.calico_mesos())
+
+        self.assertEqual(result, [
+            {"ipv4": ["192.168.0.1"], "ipv6": [], "error": None},
+            {"error": None},
+            {"error": ERROR_UNKNOWN_COMMAND % "not-a-real-command"},
+            {"error": ERROR_MISSING_COMMAND}])
+        m_allocate.assert_called_once_with({"uid": "a"})
+        m_release.assert_called_once_with({"uid": "b"})
+
+    @patch('calico_mesos.cleanup')
+    @patch('calico_mesos.isolate')
+    def test_batch_keeps_order_for_same_container(self, m_isolate,
+                                                  m_cleanup):
+        calls = []
+        m_isolate.side_effect = lambda args: calls.append("isolate")
+        m_cleanup.side_effect = lambda args: calls.append("cleanup")
+
+        calico_mesos.process_request(json.dumps([
+            {"command": "isolate", "args": {"container_id": "c1"}},
+            {"command": "cleanup", "args": {"container_id": "c1"}},
+            {"command": "isolate", "args": {"container_id": "c1"}}]))
+
+        self.assertEqual(calls, ["isolate", "cleanup", "isolate"])
+
+    @patch('calico_mesos._cleanup', autospec=True)
+    def test_batch_item_with_invalid_id_fails_alone(self, m_cleanup):
+        result = json.loads(calico_mesos.process_request(json.dumps([
+            {"command": "cleanup",
+             "args": {"hostname": "h", "container_id": [1]}},
+            {"command": "cleanup",
+             "args": {"hostname": "h", "container_id": "c1"}}])))
+
+        self.assertEqual(result, [{"error": "container_id must be a string"},
+                                  {"error": None}])
+        m_cleanup.assert_called_once_with("h", "c1")
+
+    @patch('calico_mesos._profile_cache', ProfileCache(0, 10))
+    @patch('calico_mesos._create_profile', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_batch_shares_lookups(self, m_datastore, m_create_profile):
+        m_datastore.get_ip_pools.return_value = []
+
+        def run_item(args):
+            calico_mesos._ensure_profiles([("public", Mock())])
+            calico_mesos._shared_lookup(("ip_pools", 4),
+                                        m_datastore.get_ip_pools, 4)
+
+        with patch('calico_mesos.cleanup', side_effect=run_item):
+            calico_mesos.process_request(json.dumps([
+                {"command": "cleanup", "args": {"container_id": "c%d" % i}}
+                for i in range(10)]))
+
+        self.assertEqual(m_create_profile.call_count, 1)
+        m_datastore.get_ip_pools.assert_called_once_with(4)
+
 
 class TestDefaultProfile(unittest.TestCase):
     HOST_IP_NET = "172.16.0.0/16"
 
     @patch('calico_mesos._get_host_ip_net', return_value=HOST_IP_NET)
-    @patch('calico_mesos.datastore', autospec=True)
-    def test_correct_rules_for_host_profile(self, m_datastore, m_get_host_ip_net):
-        new_profile = Mock(spec=Profile)
-        m_datastore.get_profile.return_value = new_profile
-
-        calico_mesos._create_profile_for_host_communication("default")
-        new_rules = new_profile.rules
+    def test_correct_rules_for_host_profile(self, m_get_host_ip_net):
+        new_rules = calico_mesos._host_communication_rules("default")
+        self.assertEqual(new_rules.id, "default")
         self.assertIn(Rule(action="allow", src_net=self.HOST_IP_NET), new_rules.inbound_rules)
         self.assertIn(Rule(action="allow", dst_net=self.HOST_IP_NET), new_rules.outbound_rules)
         self.assertEqual(len(new_rules.inbound_rules) + len(new_rules.outbound_rules), 2)
 
-    @patch('calico_mesos.datastore', autospec=True)
-    def test_correct_rules_for_netgroup_profile(self, m_datastore):
-        new_profile = Mock(spec=Profile)
-        m_datastore.get_profile.return_value = new_profile
-
-        calico_mesos._create_profile_for_netgroup("prof_a")
-        new_rules = new_profile.rules
+    def test_correct_rules_for_netgroup_profile(self):
+        new_rules = calico_mesos._netgroup_rules("prof_a")
+        self.assertEqual(new_rules.id, "prof_a")
         self.assertIn(Rule(action="allow", src_tag="prof_a"), new_rules.inbound_rules)
         self.assertIn(Rule(action="allow"), new_rules.outbound_rules)
         self.assertEqual(len(new_rules.inbound_rules) + len(new_rules.outbound_rules), 2)
 
-    @patch('calico_mesos.datastore', autospec=True)
-    def test_correct_rules_for_public_profile(self, m_datastore):
-        new_profile = Mock(spec=Profile)
-        m_datastore.get_profile.return_value = new_profile
-
-        calico_mesos._create_profile_for_public_communication("public")
-        new_rules = new_profile.rules
+    def test_correct_rules_for_public_profile(self):
+        new_rules = calico_mesos._public_communication_rules("public")
 
+        self.assertEqual(new_rules.id, "public")
         self.assertIn(Rule(action="allow"), new_rules.inbound_rules)
         self.assertIn(Rule(action="allow"), new_rules.outbound_rules)
         self.assertEqual(len(new_rules.inbound_rules) + len(new_rules.outbound_rules), 2)
 
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_create_profile_claims_rules_then_writes_tags(self, m_datastore):
+        rules = calico_mesos._netgroup_rules("ng_prof_a")
+
+        self.assertTrue(calico_mesos._create_profile("ng_prof_a", rules))
+
+        profile_path = "/calico/v1/policy/profile/ng_prof_a/"
+        self.assertEqual(m_datastore.etcd_client.write.call_args_list, [
+            call(profile_path + "rules", rules.to_json(), prevExist=False),
+            call(profile_path + "tags", '["ng_prof_a"]', prevExist=False)])
+        self.assertFalse(m_datastore.get_profile.called)
+
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_existing_profile_not_overwritten(self, m_datastore):
+        m_datastore.etcd_client.write.side_effect = EtcdAlreadyExist()
+        rules = calico_mesos._netgroup_rules("ng_prof_a")
+
+        self.assertFalse(calico_mesos._create_profile("ng_prof_a", rules))
+        self.assertEqual(m_datastore.etcd_client.write.call_count, 1)
+
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_existing_tags_kept(self, m_datastore):
+        m_datastore.etcd_client.write.side_effect = [None,
+                                                     EtcdAlreadyExist()]
+        rules = calico_mesos._netgroup_rules("ng_prof_a")
+
+        self.assertTrue(calico_mesos._create_profile("ng_prof_a", rules))
+        self.assertFalse(m_datastore.etcd_client.delete.called)
+
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_failed_tags_write_releases_claim(self, m_datastore):
+        m_datastore.etcd_client.write.side_effect = [None, IOError("down")]
+        rules = calico_mesos._netgroup_rules("ng_prof_a")
+
+        self.assertRaises(IOError, calico_mesos._create_profile, "ng_prof_a",
+                          rules)
+        m_datastore.etcd_client.delete.assert_called_once_with(
+            "/calico/v1/policy/profile/ng_prof_a/rules")
 
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos._profile_cache', ProfileCache(300, 10))
+    @patch('calico_mesos._get_host_ip_net', return_value=HOST_IP_NET)
+    @patch('calico_mesos._create_profile', autospec=True)
     @patch('calico_mesos.datastore', autospec=True)
-    def test_profiles_are_created(self, m_datastore):
+    def test_profiles_are_created(self, m_datastore, m_create_profile,
+                                  m_get_host_ip_net, m_endpoint_index):
+        m_endpoint_index.get.return_value = None
+        m_endpoint_index.is_complete.return_value = False
         created_endpoint = Mock(spec=Endpoint)
         m_datastore.create_endpoint.return_value = created_endpoint
-        m_datastore.profile_exists.return_value = False
 
         profiles = ["public", "prof_a"]
         calico_mesos._isolate("testhostname", 1234, "container-id-1234", ["192.168.0.0"], [], profiles, None)
@@ -387,6 +811,181 @@ class TestDefaultProfile(unittest.TestCase):
         self.assertIn("ng_prof_a", created_endpoint.profile_ids)
         self.assertIn("default_testhostname", created_endpoint.profile_ids)
         self.assertEqual(len(created_endpoint.profile_ids), 3)
+        created = sorted(args[0] for args, _ in
+                         m_create_profile.call_args_list)
+        self.assertEqual(created,
+                         ["default_testhostname", "ng_prof_a", "public"])
+        m_endpoint_index.add.assert_called_once_with("container-id-1234",
+                                                     created_endpoint)
+
+
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos._ensure_profiles', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_isolate_already_configured(self, m_datastore,
+                                        m_ensure_profiles, m_endpoint_index):
+        m_endpoint_index.get.return_value = {"endpoint_id": "1234"}
+        m_datastore.get_endpoints.return_value = [Mock(spec=Endpoint)]
+
+        with self.assertRaises(IsolatorException):
+            calico_mesos._isolate("testhostname", 1234, "container-id-1234",
+                                  ["192.168.0.0"], [], [], None)
+        m_datastore.get_endpoints.assert_called_once_with(
+            hostname=HOSTNAME, orchestrator_id="mesos",
+            workload_id="container-id-1234")
+        self.assertFalse(m_datastore.create_endpoint.called)
+        self.assertFalse(m_datastore.set_endpoint.called)
+
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos._ensure_profiles', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_isolate_complete_index_skips_lookup(self, m_datastore,
+                                                 m_ensure_profiles,
+                                                 m_endpoint_index):
+        m_endpoint_index.get.return_value = None
+        m_endpoint_index.is_complete.return_value = True
+
+        with patch('pycalico.netns.PidNamespace'):
+            calico_mesos._isolate("testhostname", 1234, "container-id-1234",
+                                  ["192.168.0.0"], [], [], None)
+        self.assertFalse(m_datastore.get_endpoints.called)
+        m_datastore.set_endpoint.assert_called_once_with(
+            m_datastore.create_endpoint.return_value)
+
+    @patch('calico_mesos._remove_veth', autospec=True)
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos._ensure_profiles', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_isolate_removes_veth_on_failure(self, m_datastore,
+                                             m_ensure_profiles,
+                                             m_endpoint_index,
+                                             m_remove_veth):
+        m_endpoint_index.get.return_value = None
+        m_endpoint_index.is_complete.return_value = True
+        veth_done = threading.Event()
+
+        def provision_veth(namespace, name):
+            veth_done.set()
+            return "ee:ee:ee:ee:ee:ee"
+        ep = m_datastore.create_endpoint.return_value
+        ep.provision_veth.side_effect = provision_veth
+
+        def ensure_profiles(profiles):
+            # Fail once the veth has been created alongside.
+            veth_done.wait(5)
+            raise IsolatorException("etcd unavailable")
+        m_ensure_profiles.side_effect = ensure_profiles
+
+        with patch('pycalico.netns.PidNamespace'):
+            with self.assertRaises(IsolatorException):
+                calico_mesos._isolate("testhostname", 1234,
+                                      "container-id-1234", ["192.168.0.0"],
+                                      [], [], None)
+        m_remove_veth.assert_called_once_with(ep)
+        self.assertFalse(m_datastore.set_endpoint.called)
+        self.assertFalse(m_endpoint_index.add.called)
+
+    @patch('calico_mesos._datastore_mirror', autospec=True)
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos._ensure_profiles', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_isolate_already_configured_in_mirror(self, m_datastore,
+                                                  m_ensure_profiles,
+                                                  m_endpoint_index, m_mirror):
+        m_endpoint_index.get.return_value = None
+        m_endpoint_index.is_complete.return_value = False
+        m_mirror.get_endpoints.return_value = [Mock(spec=Endpoint)]
+
+        with self.assertRaises(IsolatorException):
+            calico_mesos._isolate("testhostname", 1234, "container-id-1234",
+                                  ["192.168.0.0"], [], [], None)
+        m_mirror.get_endpoints.assert_called_once_with("container-id-1234")
+        self.assertFalse(m_datastore.get_endpoints.called)
+        self.assertFalse(m_datastore.create_endpoint.called)
+
+    @patch('calico_mesos._datastore_mirror', autospec=True)
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos._ensure_profiles', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_isolate_writes_through_mirror(self, m_datastore,
+                                           m_ensure_profiles,
+                                           m_endpoint_index, m_mirror):
+        m_endpoint_index.get.return_value = None
+        m_endpoint_index.is_complete.return_value = False
+        m_mirror.get_endpoints.return_value = []
+
+        with patch('pycalico.netns.PidNamespace'):
+            calico_mesos._isolate("testhostname", 1234, "container-id-1234",
+                                  ["192.168.0.0"], [], [], None)
+        self.assertFalse(m_datastore.get_endpoints.called)
+        m_mirror.endpoint_written.assert_called_once_with(
+            m_datastore.create_endpoint.return_value)
+
+
+class TestHostIpNet(unittest.TestCase):
+    @patch('calico_mesos._host_addresses')
+    def test_excluded_and_loopback_addresses_skipped(self, m_host_addresses):
+        m_host_addresses.get.return_value = [("lo", "127.0.0.1", 8),
+                                             ("docker0", "172.17.42.1", 16),
+                                             ("docker0:1", "172.18.0.1", 16),
+                                             ("eth1", "127.0.1.1", 8),
+                                             ("eth0", "10.0.2.15", 24)]
+        self.assertEqual(str(calico_mesos._get_host_ip_net()), "10.0.2.0/24")
+
+    @patch('calico_mesos.EXCLUDED_INTERFACES', ["eth0"])
+    @patch('calico_mesos._host_addresses')
+    def test_exclusions_are_configurable(self, m_host_addresses):
+        m_host_addresses.get.return_value = [("eth0", "10.0.2.15", 24),
+                                             ("docker0", "172.17.42.1", 16)]
+        self.assertEqual(str(calico_mesos._get_host_ip_net()),
+                         "172.17.0.0/16")
+
+    @patch('calico_mesos._host_addresses')
+    def test_no_usable_address(self, m_host_addresses):
+        m_host_addresses.get.return_value = [("lo", "127.0.0.1", 8)]
+        with self.assertRaises(IsolatorException) as e:
+            calico_mesos._get_host_ip_net()
+        self.assertEqual(e.exception.message,
+                         "Couldn't determine host's IP Address.")
+
+
+class TestEnsureProfiles(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('calico_mesos._profile_cache', ProfileCache(300, 10))
+        self.profile_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('calico_mesos._create_profile', autospec=True)
+    def test_profiles_are_cached(self, m_create_profile):
+        m_rules = Mock()
+
+        calico_mesos._ensure_profiles([("ng_prod", m_rules)])
+        calico_mesos._ensure_profiles([("ng_prod", m_rules)])
+
+        m_rules.assert_called_once_with("ng_prod")
+        m_create_profile.assert_called_once_with("ng_prod",
+                                                 m_rules.return_value)
+        self.assertEqual(self.profile_cache.stats(),
+                         {"hits": 1, "misses": 1, "evictions": 0, "size": 1})
+
+    @patch('calico_mesos._create_profile', autospec=True)
+    def test_missing_profiles_are_all_created(self, m_create_profile):
+        self.profile_cache.add("public")
+
+        calico_mesos._ensure_profiles([("public", Mock()),
+                                       ("ng_a", Mock()),
+                                       ("ng_b", Mock())])
+
+        created = sorted(args[0] for args, _ in
+                         m_create_profile.call_args_list)
+        self.assertEqual(created, ["ng_a", "ng_b"])
+
+    @patch('calico_mesos._create_profile', autospec=True,
+           side_effect=RuntimeError)
+    def test_failed_create_is_not_cached(self, m_create_profile):
+        self.assertRaises(RuntimeError, calico_mesos._ensure_profiles,
+                          [("ng_prod", Mock())])
+        self.assertFalse(self.profile_cache.contains("ng_prod"))
 
 
 class TestCleanup(unittest.TestCase):
@@ -409,3 +1008,220 @@ class TestCleanup(unittest.TestCase):
         args = {"hostname": "metaman", "container_id": "abcdef-12345"}
         calico_mesos.cleanup(args)
         m_cleanup.assert_called_with(args["hostname"], args["container_id"])
+
+
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_cleanup_unassigns_by_pool(self, m_datastore, m_endpoint_index):
+        m_endpoint_index.get.return_value = None
+        endpoint = Mock(spec=Endpoint)
+        endpoint.endpoint_id = "1234"
+        endpoint.ipv4_nets = set([IPNetwork("192.168.0.1/32"),
+                                  IPNetwork("192.168.0.2/32"),
+                                  IPNetwork("10.0.0.1/32")])
+        endpoint.ipv6_nets = set([IPNetwork("dead::beef/128")])
+        m_datastore.get_endpoint.return_value = endpoint
+        pools = {4: [Mock(cidr=IPNetwork("192.168.0.0/16")),
+                     Mock(cidr=IPNetwork("10.0.0.0/8"))],
+                 6: [Mock(cidr=IPNetwork("dead::/64"))]}
+        m_datastore.get_ip_pools.side_effect = lambda version: pools[version]
+
+        calico_mesos._cleanup("metaman", "abcdef-12345")
+
+        self.assertEqual(sorted(m_datastore.get_ip_pools.call_args_list),
+                         [call(4), call(6)])
+        unassigned = sorted((pool.cidr, ip) for (pool, ip), _ in
+                            m_datastore.unassign_address.call_args_list)
+        self.assertEqual(unassigned, [
+            (IPNetwork("10.0.0.0/8"), IPAddress("10.0.0.1")),
+            (IPNetwork("192.168.0.0/16"), IPAddress("192.168.0.1")),
+            (IPNetwork("192.168.0.0/16"), IPAddress("192.168.0.2")),
+            (IPNetwork("dead::/64"), IPAddress("dead::beef"))])
+        m_datastore.remove_endpoint.assert_called_once_with(endpoint)
+        m_datastore.remove_workload.assert_called_once_with(
+            hostname=HOSTNAME, orchestrator_id="mesos",
+            workload_id="abcdef-12345")
+        m_endpoint_index.remove.assert_called_once_with("abcdef-12345")
+
+    @patch('calico_mesos._unassign_addresses', autospec=True)
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_cleanup_uses_indexed_endpoint(self, m_datastore,
+                                           m_endpoint_index, m_unassign):
+        endpoint = Endpoint(HOSTNAME, "mesos", "abcdef-12345", "1234",
+                            "active", "ee:ee:ee:ee:ee:ee")
+        endpoint.ipv4_nets.add(IPNetwork("192.168.0.1/32"))
+        m_endpoint_index.get.return_value = endpoint_record(endpoint)
+
+        calico_mesos._cleanup("metaman", "abcdef-12345")
+
+        self.assertFalse(m_datastore.get_endpoint.called)
+        m_unassign.assert_called_once_with([IPAddress("192.168.0.1")])
+        removed, = m_datastore.remove_endpoint.call_args[0]
+        self.assertEqual(endpoint_record(removed), endpoint_record(endpoint))
+        m_endpoint_index.remove.assert_called_once_with("abcdef-12345")
+
+    @patch('calico_mesos._unassign_addresses', autospec=True)
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_failed_cleanup_can_be_retried(self, m_datastore,
+                                           m_endpoint_index, m_unassign):
+        endpoint = Endpoint(HOSTNAME, "mesos", "abcdef-12345", "1234",
+                            "active", "ee:ee:ee:ee:ee:ee")
+        endpoint.ipv4_nets.add(IPNetwork("192.168.0.1/32"))
+        m_endpoint_index.get.return_value = endpoint_record(endpoint)
+        m_datastore.remove_workload.side_effect = IOError("etcd unavailable")
+
+        self.assertRaises(IOError, calico_mesos._cleanup, "metaman",
+                          "abcdef-12345")
+        self.assertFalse(m_endpoint_index.remove.called)
+
+        # The endpoint went on the first attempt.
+        m_datastore.remove_endpoint.side_effect = KeyError()
+        m_datastore.remove_workload.side_effect = None
+        calico_mesos._cleanup("metaman", "abcdef-12345")
+
+        self.assertEqual(m_datastore.remove_workload.call_count, 2)
+        m_endpoint_index.remove.assert_called_once_with("abcdef-12345")
+
+        # And a retry after everything but forgetting the container.
+        m_datastore.remove_workload.side_effect = KeyError()
+        calico_mesos._cleanup("metaman", "abcdef-12345")
+        self.assertEqual(m_endpoint_index.remove.call_count, 2)
+
+    @patch('calico_mesos._unassign_addresses', autospec=True)
+    @patch('calico_mesos._datastore_mirror', autospec=True)
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_cleanup_uses_mirrored_endpoint(self, m_datastore,
+                                            m_endpoint_index, m_mirror,
+                                            m_unassign):
+        endpoint = Endpoint(HOSTNAME, "mesos", "abcdef-12345", "1234",
+                            "active", "ee:ee:ee:ee:ee:ee")
+        m_endpoint_index.get.return_value = None
+        m_mirror.get_endpoints.return_value = [endpoint]
+
+        calico_mesos._cleanup("metaman", "abcdef-12345")
+
+        self.assertFalse(m_datastore.get_endpoint.called)
+        m_datastore.remove_endpoint.assert_called_once_with(endpoint)
+        m_mirror.workload_removed.assert_called_once_with("abcdef-12345")
+
+        m_mirror.get_endpoints.return_value = []
+        with self.assertRaises(IsolatorException):
+            calico_mesos._cleanup("metaman", "abcdef-12345")
+        self.assertFalse(m_datastore.get_endpoint.called)
+
+    @patch('pycalico.netns.remove_veth', autospec=True)
+    @patch('calico_mesos._cleanup_worker')
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_deferred_cleanup(self, m_datastore, m_endpoint_index, m_worker,
+                              m_remove_veth):
+        endpoint = Endpoint(HOSTNAME, "mesos", "abcdef-12345", "1234",
+                            "active", "ee:ee:ee:ee:ee:ee")
+        endpoint.ipv4_nets.add(IPNetwork("192.168.0.1/32"))
+        m_endpoint_index.get.return_value = endpoint_record(endpoint)
+
+        calico_mesos._cleanup("metaman", "abcdef-12345")
+
+        m_remove_veth.assert_called_once_with(endpoint.name)
+        m_worker.add.assert_called_once_with("abcdef-12345",
+                                             endpoint_record(endpoint))
+        self.assertFalse(m_datastore.remove_endpoint.called)
+        self.assertFalse(m_endpoint_index.remove.called)
+
+        # The worker completes the cleanup from the queued record.
+        with patch('calico_mesos._unassign_addresses', autospec=True) as \
+                m_unassign:
+            calico_mesos._deferred_cleanup(
+                {"container_id": "abcdef-12345",
+                 "endpoint": endpoint_record(endpoint)})
+        m_unassign.assert_called_once_with([IPAddress("192.168.0.1")])
+        self.assertEqual(m_datastore.remove_endpoint.call_count, 1)
+        m_endpoint_index.remove.assert_called_once_with("abcdef-12345")
+
+
+class TestCleanupAll(unittest.TestCase):
+    @patch('calico_mesos._endpoint_index', autospec=True)
+    @patch('calico_mesos.datastore', autospec=True)
+    def test_cleanup_all(self, m_datastore, m_endpoint_index):
+        endpoints = []
+        for container_id, endpoint_id, ip in (("a", "1", "192.168.0.1"),
+                                              ("b", "2", "192.168.0.2"),
+                                              ("b", "3", "192.168.1.1"),
+                                              ("c", "4", "192.168.0.3")):
+            endpoint = Endpoint(HOSTNAME, "mesos", container_id, endpoint_id,
+                                "active", "ee:ee:ee:ee:ee:ee")
+            endpoint.ipv4_nets.add(IPNetwork(ip))
+            endpoints.append(endpoint)
+        m_datastore.get_endpoints.return_value = endpoints
+
+        def remove_workload(hostname, orchestrator_id, workload_id):
+            if workload_id == "c":
+                raise IOError("etcd unavailable")
+        m_datastore.remove_workload.side_effect = remove_workload
+
+        result = json.loads(calico_mesos.cleanup_all({"hostname": "metaman"}))
+
+        m_datastore.get_endpoints.assert_called_once_with(
+            hostname=HOSTNAME, orchestrator_id="mesos")
+        self.assertEqual(m_datastore.remove_endpoint.call_count, 4)
+        self.assertEqual(result, {"containers": 3, "removed": ["a", "b"],
+                                  "addresses": 3,
+                                  "failures": {"c": "etcd unavailable"},
+                                  "release_failures": {}, "error": None})
+        # One release per block, leaving the failed container's address.
+        self.assertEqual(sorted(m_datastore.release_ips.call_args_list), [
+            call(set([IPAddress("192.168.0.1"), IPAddress("192.168.0.2")])),
+            call(set([IPAddress("192.168.1.1")]))])
+        self.assertEqual(sorted(m_endpoint_index.remove.call_args_list),
+                         [call("a"), call("b")])
+
+    def test_cleanup_all_requires_hostname(self):
+        with self.assertRaises(IsolatorException) as e:
+            calico_mesos.cleanup_all({})
+        self.assertEqual(e.exception.message, ERROR_MISSING_HOSTNAME)
+
+
+class TestLazyDatastore(unittest.TestCase):
+    @patch('etcd_pool.install', autospec=True)
+    @patch('pycalico.ipam.IPAMClient')
+    def test_client_built_on_first_access(self, m_ipam_client, m_install):
+        lazy_datastore = calico_mesos._LazyDatastore()
+        self.assertFalse(m_ipam_client.called)
+
+        lazy_datastore.profile_exists("public")
+        lazy_datastore.profile_exists("public")
+        m_ipam_client.assert_called_once_with()
+        m_ipam_client.return_value.profile_exists.assert_called_with("public")
+
+    @patch('etcd_pool.install', autospec=True)
+    @patch('pycalico.ipam.IPAMClient')
+    def test_etcd_pool_installed(self, m_ipam_client, m_install):
+        lazy_datastore = calico_mesos._LazyDatastore()
+        lazy_datastore.get_client()
+        m_install.assert_called_once_with(
+            m_ipam_client.return_value.etcd_client,
+            calico_mesos.ETCD_POOL_SIZE, calico_mesos.ETCD_IDLE_TIMEOUT)
+        self.assertEqual(lazy_datastore.pool, m_install.return_value)
+
+    @patch('etcd_pool.install', autospec=True)
+    @patch('pycalico.ipam.IPAMClient')
+    def test_etcd_client_calls_timed(self, m_ipam_client, m_install):
+        lazy_datastore = calico_mesos._LazyDatastore()
+        metrics = RequestMetrics("isolate")
+        calico_mesos._request_context.metrics = metrics
+        try:
+            lazy_datastore.etcd_client.write("/key", "value", prevExist=False)
+            lazy_datastore.profile_exists("public")
+        finally:
+            calico_mesos._request_context.metrics = None
+
+        m_ipam_client.return_value.etcd_client.write.assert_called_once_with(
+            "/key", "value", prevExist=False)
+        self.assertEqual([operation for operation, _ in metrics.calls()],
+                         ["etcd_client.write", "profile_exists"])
+
+    def test_etcd_pool_not_imported_at_start(self):
+        self.assertNotIn("etcd_pool", vars(calico_mesos))
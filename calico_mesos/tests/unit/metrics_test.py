@@ -0,0 +1,114 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+from mock import Mock, patch
+from metrics import RequestMetrics, Histograms, TimedProxy
+
+
+class TestRequestMetrics(unittest.TestCase):
+    @patch('time.time')
+    def test_record(self, m_time):
+        m_time.side_effect = [100.0,         # start
+                              100.5, 101.0,  # validate
+                              101.0, 101.25,  # get_endpoints
+                              101.5, 101.5,  # validate again
+                              102.0]         # finish
+        metrics = RequestMetrics("isolate", container_id="abc")
+        with metrics.span("validate"):
+            pass
+        metrics.timed("get_endpoints", lambda: None)()
+        with metrics.span("validate"):
+            pass
+
+        self.assertEqual(metrics.finish("failed"), {
+            "command": "isolate",
+            "container_id": "abc",
+            "start": 100.0,
+            "duration": 2.0,
+            "error": "failed",
+            "phases": {"validate": 0.5},
+            "datastore": {"get_endpoints": {"count": 1, "duration": 0.25}}})
+        self.assertEqual(metrics.calls(), [("get_endpoints", 0.25)])
+
+    def test_failed_call_is_counted(self):
+        metrics = RequestMetrics("cleanup")
+
+        def fail():
+            raise KeyError()
+        self.assertRaises(KeyError, metrics.timed("get_endpoint", fail))
+        self.assertEqual(metrics.finish()["datastore"]["get_endpoint"]["count"],
+                         1)
+
+
+class TestTimedProxy(unittest.TestCase):
+    def test_method_calls_timed(self):
+        metrics = RequestMetrics("isolate")
+        target = Mock(base_uri="http://etcd")
+        proxy = TimedProxy(target, metrics, "etcd_client.")
+
+        self.assertEqual(proxy.read("/key"), target.read.return_value)
+        self.assertEqual(proxy.base_uri, "http://etcd")
+        self.assertEqual([operation for operation, _ in metrics.calls()],
+                         ["etcd_client.read"])
+
+
+class TestHistograms(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state = os.path.join(self.tmpdir, "metrics.json")
+        self.textfile = os.path.join(self.tmpdir, "calico_mesos.prom")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _record(self, duration):
+        return {"command": "allocate", "duration": duration, "error": None,
+                "phases": {"assign": duration}, "datastore": {}}
+
+    def test_processes_merge_histograms(self):
+        for duration in (0.003, 20.0):
+            histograms = Histograms()
+            histograms.observe_request(self._record(duration),
+                                       [("auto_assign_ips", duration)])
+            histograms.save(self.state, self.textfile)
+
+        with open(self.textfile) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn("# TYPE calico_mesos_request_duration_seconds histogram",
+                      lines)
+        prefix = ('calico_mesos_request_duration_seconds_bucket'
+                  '{command="allocate",outcome="success",')
+        self.assertIn(prefix + 'le="0.0025"} 0', lines)
+        self.assertIn(prefix + 'le="0.005"} 1', lines)
+        self.assertIn(prefix + 'le="10.0"} 1', lines)
+        self.assertIn(prefix + 'le="+Inf"} 2', lines)
+        self.assertIn('calico_mesos_request_duration_seconds_count'
+                      '{command="allocate",outcome="success"} 2', lines)
+        self.assertIn('calico_mesos_phase_duration_seconds_count'
+                      '{command="allocate",phase="assign"} 2', lines)
+        self.assertIn('calico_mesos_datastore_call_duration_seconds_sum'
+                      '{operation="auto_assign_ips"} 20.003', lines)
+
+    def test_save_resets_observations(self):
+        histograms = Histograms()
+        histograms.observe_request(self._record(0.1), [])
+        histograms.save(self.state, self.textfile)
+        histograms.save(self.state, self.textfile)
+        with open(self.textfile) as textfile:
+            self.assertIn('calico_mesos_request_duration_seconds_count'
+                          '{command="allocate",outcome="success"} 1',
+                          textfile.read())
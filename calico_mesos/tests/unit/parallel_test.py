@@ -0,0 +1,100 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+from mock import Mock
+from parallel import run_parallel, check_results, OnceCache, TaskGraph
+
+
+class TestRunParallel(unittest.TestCase):
+    def test_results_in_order_with_errors_isolated(self):
+        def func(item):
+            if item == 2:
+                raise ValueError(item)
+            return item * 10
+
+        results = run_parallel(func, [1, 2, 3], 3)
+
+        self.assertEqual([result for result, _ in results], [10, None, 30])
+        self.assertIsNone(results[0][1])
+        self.assertEqual(results[1][1][0], ValueError)
+        self.assertRaises(ValueError, check_results, results)
+        self.assertEqual(check_results(run_parallel(abs, [-1, 2], 2)), [1, 2])
+
+    def test_items_run_concurrently(self):
+        barrier = threading.Event()
+        started = []
+
+        def func(item):
+            started.append(item)
+            if len(started) == 2:
+                barrier.set()
+            return barrier.wait(5)
+
+        self.assertEqual(check_results(run_parallel(func, [1, 2], 2)),
+                         [True, True])
+
+
+class TestTaskGraph(unittest.TestCase):
+    def test_independent_steps_overlap(self):
+        both_started = threading.Event()
+        started = []
+
+        def step(name):
+            started.append(name)
+            if len(started) == 2:
+                both_started.set()
+            return both_started.wait(5) and name
+
+        graph = TaskGraph()
+        graph.add("a", lambda: step("a"))
+        graph.add("b", lambda: step("b"))
+        graph.add("c", lambda a, b: a + b, after=["a", "b"])
+        self.assertEqual(graph.run(), {"a": "a", "b": "b", "c": "ab"})
+
+    def test_failure_undoes_completed_steps(self):
+        undone = []
+        graph = TaskGraph()
+        graph.add("a", lambda: 1, undo=undone.append)
+        graph.add("b", lambda a: a + 1, after=["a"], undo=undone.append)
+        graph.add("c", Mock(side_effect=ValueError("c failed")),
+                  after=["b"])
+        after_failure = Mock()
+        graph.add("d", after_failure, after=["c"])
+
+        with self.assertRaises(ValueError) as e:
+            graph.run()
+        self.assertEqual(str(e.exception), "c failed")
+        self.assertEqual(undone, [2, 1])
+        self.assertFalse(after_failure.called)
+
+    def test_unknown_dependency(self):
+        graph = TaskGraph()
+        self.assertRaises(ValueError, graph.add, "a", Mock(), after=["b"])
+
+
+class TestOnceCache(unittest.TestCase):
+    def test_computed_once(self):
+        func = Mock(return_value=1)
+        cache = OnceCache()
+        results = run_parallel(lambda _: cache.get("key", func, "arg"),
+                               range(5), 5)
+        self.assertEqual(check_results(results), [1] * 5)
+        func.assert_called_once_with("arg")
+
+    def test_failures_not_cached(self):
+        func = Mock(side_effect=[ValueError(), 2])
+        cache = OnceCache()
+        self.assertRaises(ValueError, cache.get, "key", func)
+        self.assertEqual(cache.get("key", func), 2)
@@ -0,0 +1,52 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+from collections import namedtuple
+from netaddr import IPAddress, IPNetwork
+from pool_index import PoolIndex
+
+Pool = namedtuple("Pool", "cidr")
+
+
+class TestPoolIndex(unittest.TestCase):
+    def setUp(self):
+        self.pool_a = Pool(IPNetwork("10.0.0.0/16"))
+        self.pool_b = Pool(IPNetwork("192.168.0.0/24"))
+        self.pool_c = Pool(IPNetwork("192.168.2.0/24"))
+        self.index = PoolIndex([self.pool_c, self.pool_a, self.pool_b])
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup(IPAddress("10.0.255.255")),
+                         self.pool_a)
+        self.assertEqual(self.index.lookup(IPAddress("192.168.0.0")),
+                         self.pool_b)
+        self.assertEqual(self.index.lookup(IPAddress("192.168.2.7")),
+                         self.pool_c)
+        self.assertIsNone(self.index.lookup(IPAddress("192.168.1.1")))
+        self.assertIsNone(self.index.lookup(IPAddress("9.255.255.255")))
+        self.assertIsNone(PoolIndex([]).lookup(IPAddress("10.0.0.1")))
+
+    def test_overlapping_pools(self):
+        outer = Pool(IPNetwork("10.0.0.0/8"))
+        inner = Pool(IPNetwork("10.1.0.0/16"))
+        index = PoolIndex([outer, inner])
+        self.assertEqual(index.lookup(IPAddress("10.1.0.1")), inner)
+        self.assertEqual(index.lookup(IPAddress("10.2.0.1")), outer)
+
+    def test_group_by_pool(self):
+        ips = [IPAddress(ip) for ip in
+               ["192.168.0.1", "10.0.0.1", "172.16.0.1", "192.168.0.2"]]
+        self.assertEqual(self.index.group_by_pool(ips),
+                         [(self.pool_b, [ips[0], ips[3]]),
+                          (self.pool_a, [ips[1]])])
@@ -0,0 +1,82 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from profile_cache import ProfileCache
+
+
+class TestProfileCache(unittest.TestCase):
+    @patch('time.time', return_value=1000)
+    def test_entries_expire(self, m_time):
+        cache = ProfileCache(60, 10)
+        cache.add("public")
+        self.assertTrue(cache.contains("public"))
+        m_time.return_value = 1060
+        self.assertFalse(cache.contains("public"))
+        self.assertEqual(cache.stats(),
+                         {"hits": 1, "misses": 1, "evictions": 0, "size": 0})
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ProfileCache(60, 2)
+        cache.add("a")
+        cache.add("b")
+        cache.contains("a")
+        cache.add("c")
+        self.assertTrue(cache.contains("a"))
+        self.assertFalse(cache.contains("b"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_invalidate(self):
+        cache = ProfileCache(60, 10)
+        cache.add("public")
+        cache.invalidate("public")
+        self.assertFalse(cache.contains("public"))
+
+
+class TestProfileCacheFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "profiles.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_processes_share_entries(self):
+        first = ProfileCache(60, 10, self.path)
+        first.contains("public")
+        first.add("public")
+        first.add("ng_prod")
+        first.save()
+
+        second = ProfileCache(60, 10, self.path)
+        self.assertTrue(second.contains("public"))
+        second.invalidate("ng_prod")
+        second.save()
+
+        third = ProfileCache(60, 10, self.path)
+        self.assertFalse(third.contains("ng_prod"))
+        self.assertTrue(third.contains("public"))
+        self.assertEqual(third.stats(),
+                         {"hits": 1, "misses": 1, "evictions": 0, "size": 1})
+
+    @patch('statefile.atomic_write')
+    def test_lookups_alone_not_saved(self, m_atomic_write):
+        cache = ProfileCache(60, 10, self.path)
+        cache.contains("public")
+        cache.save()
+        self.assertFalse(m_atomic_write.called)
+        self.assertFalse(os.path.exists(self.path + ".lock"))
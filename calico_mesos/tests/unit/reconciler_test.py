@@ -0,0 +1,188 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+from mock import Mock, patch
+from netaddr import IPAddress, IPNetwork
+from pycalico.ipam import IPAMClient
+from pycalico.datastore_datatypes import Endpoint
+from reconciler import Reconciler
+from handle_records import HandleRecords
+
+BLOCK = IPNetwork("192.168.1.0/30")
+
+
+def _endpoint(container_id, address, orchestrator_id="mesos"):
+    endpoint = Endpoint("host", orchestrator_id, container_id,
+                        "ep-" + container_id, "active", "ee:ee:ee:ee:ee:ee")
+    endpoint.ipv4_nets.add(IPNetwork(address))
+    return endpoint
+
+
+class TestReconciler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datastore = Mock(spec=IPAMClient)
+        # .1 is used by a live container, .2 by a dead one and .3 by a
+        # Docker container; .0 is only assigned.
+        self.datastore.get_endpoints.return_value = [
+            _endpoint("live", "192.168.1.1"),
+            _endpoint("dead", "192.168.1.2"),
+            _endpoint("docker", "192.168.1.3", orchestrator_id="docker")]
+        self.datastore._get_affine_blocks.side_effect = \
+            lambda host, version, pool: [BLOCK] if version == 4 else []
+        block = Mock(cidr=BLOCK, allocations=[2, 0, 1, 0],
+                     attributes=[{"handle_id": "live"},
+                                 {"handle_id": "dead"},
+                                 {"handle_id": "leaked"}])
+        self.datastore._read_block.return_value = block
+        self.handles = HandleRecords(os.path.join(self.tmpdir, "handles"))
+        with patch('time.time', return_value=0.0):
+            for handle_id in ("live", "dead", "leaked"):
+                self.handles.add(handle_id)
+
+        def release_ips(addresses):
+            for address in addresses:
+                block.allocations[list(BLOCK).index(address)] = None
+        self.datastore.release_ips.side_effect = release_ips
+        self.cleanup = Mock()
+        self.reconciler = Reconciler(
+            self.datastore, "host", "mesos", self.cleanup,
+            os.path.join(self.tmpdir, "reconcile.json"), grace=60,
+            handles=self.handles, handle_age=600)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_find_orphans(self):
+        self.assertEqual(self.reconciler.find_orphans(set(["live"])), {
+            "endpoint dead ep-dead": ("endpoint", "dead"),
+            "address 192.168.1.0 leaked": ("address",
+                                           IPAddress("192.168.1.0"))})
+        self.datastore.get_endpoints.assert_called_once_with(hostname="host")
+
+    def test_unrecorded_handles_not_released(self):
+        # Another host's assignment, and one without a handle, in this
+        # host's block.
+        block = self.datastore._read_block.return_value
+        block.allocations = [3, 4, None, None]
+        block.attributes = [{"handle_id": "live"}, {"handle_id": "dead"},
+                            {"handle_id": "leaked"},
+                            {"handle_id": "other-host"}, {"handle_id": None}]
+        self.datastore.get_endpoints.return_value = []
+        self.assertEqual(self.reconciler.find_orphans(set()), {
+            "handle live": ("handle", "live"),
+            "handle dead": ("handle", "dead"),
+            "handle leaked": ("handle", "leaked")})
+
+        self.reconciler.handles = None
+        self.assertEqual(self.reconciler.find_orphans(set()), {})
+
+    @patch('time.time')
+    def test_unused_handles_forgotten(self, m_time):
+        m_time.return_value = 1000.0
+        self.handles.add("failed-allocate")
+        m_time.return_value = 1600.0
+        self.reconciler.run(set(["live"]))
+        m_time.return_value = 1660.0
+        self.reconciler.run(set(["live"]))
+        self.assertEqual(sorted(self.handles.recorded()),
+                         ["dead", "leaked", "live"])
+
+    @patch('time.time')
+    def test_recent_handles_not_released(self, m_time):
+        # Allocated, but its task's container not isolated yet.
+        m_time.return_value = 1000.0
+        for handle_id in ("live", "dead", "leaked", "failed-allocate"):
+            self.handles.add(handle_id, allocated=True)
+        m_time.return_value = 1599.0
+        self.assertEqual(self.reconciler.find_orphans(set(["live"])), {
+            "endpoint dead ep-dead": ("endpoint", "dead")})
+        # The blocks aren't read when no handle is old enough.
+        self.assertFalse(self.datastore._read_block.called)
+
+        m_time.return_value = 1600.0
+        self.assertEqual(sorted(self.reconciler.find_orphans(set(["live"]))),
+                         ["address 192.168.1.0 leaked",
+                          "endpoint dead ep-dead", "handle failed-allocate"])
+
+
+    def test_local_endpoints_used(self):
+        list_endpoints = Mock(return_value=[_endpoint("dead",
+                                                      "192.168.1.2")])
+        self.reconciler.list_endpoints = list_endpoints
+        self.assertEqual(self.reconciler.find_orphans(set(["live"])), {
+            "endpoint dead ep-dead": ("endpoint", "dead"),
+            "address 192.168.1.0 leaked": ("address",
+                                           IPAddress("192.168.1.0"))})
+        self.assertFalse(self.datastore.get_endpoints.called)
+
+        # Local state which doesn't cover every endpoint isn't used.
+        list_endpoints.return_value = None
+        self.reconciler.find_orphans(set(["live"]))
+        self.datastore.get_endpoints.assert_called_once_with(hostname="host")
+
+    @patch('time.time')
+    def test_orphans_released_after_grace(self, m_time):
+        m_time.return_value = 1000.0
+        result = self.reconciler.run(set(["live"]))
+        self.assertEqual(result, {"endpoints": [], "addresses": [],
+                                  "pending": 2, "failures": {}})
+
+        m_time.return_value = 1059.0
+        self.assertEqual(self.reconciler.run(set(["live"]))["pending"], 2)
+        self.assertFalse(self.cleanup.called)
+
+        m_time.return_value = 1060.0
+        result = self.reconciler.run(set(["live"]))
+        self.assertEqual(result, {"endpoints": ["dead"],
+                                  "addresses": ["192.168.1.0"],
+                                  "pending": 0, "failures": {}})
+        self.cleanup.assert_called_once_with("dead")
+        self.datastore.release_ips.assert_called_once_with(
+            set([IPAddress("192.168.1.0")]))
+
+    @patch('time.time')
+    def test_orphan_which_recovers_is_forgotten(self, m_time):
+        m_time.return_value = 1000.0
+        self.reconciler.run(set(["live"]))
+        m_time.return_value = 1100.0
+        self.reconciler.run(set(["live", "dead", "leaked"]))
+        m_time.return_value = 1120.0
+        result = self.reconciler.run(set(["live"]))
+        self.assertEqual(result["pending"], 2)
+        self.assertFalse(self.cleanup.called)
+
+    @patch('time.time')
+    def test_batches_continue_from_cursor(self, m_time):
+        self.reconciler.batch_size = 1
+        self.cleanup.side_effect = IOError("etcd unavailable")
+        m_time.return_value = 1000.0
+        self.reconciler.run(set(["live"]))
+
+        # The address sorts first.
+        m_time.return_value = 1100.0
+        result = self.reconciler.run(set(["live"]))
+        self.assertEqual(result["addresses"], ["192.168.1.0"])
+        self.assertFalse(self.cleanup.called)
+
+        # The failed endpoint stays pending, and is retried by later passes.
+        # So is the leaked handle, which now has no addresses.
+        for _ in range(2):
+            result = self.reconciler.run(set(["live"]))
+            self.assertEqual(result["failures"],
+                             {"dead": "etcd unavailable"})
+            self.assertEqual(result["pending"], 2)
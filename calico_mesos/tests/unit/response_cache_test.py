@@ -0,0 +1,106 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from response_cache import ResponseCache, request_hash
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.tmpdir, 60, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_request_hash_ignores_key_order(self):
+        self.assertEqual(request_hash("allocate", {"uid": "a", "num_ipv4": 1}),
+                         request_hash("allocate", {"num_ipv4": 1, "uid": "a"}))
+        self.assertNotEqual(request_hash("allocate", {"uid": "a"}),
+                            request_hash("release", {"uid": "a"}))
+
+    def test_only_same_request_matches(self):
+        self.cache.put("uid=a", "allocate", "hash1", '{"ipv4": []}')
+        self.assertEqual(self.cache.get("uid=a", "allocate", "hash1"),
+                         (True, '{"ipv4": []}'))
+        self.assertEqual(self.cache.get("uid=a", "allocate", "hash2"),
+                         (False, None))
+        self.assertEqual(self.cache.get("uid=b", "allocate", "hash1"),
+                         (False, None))
+
+        # A later request for the key replaces the response.
+        self.cache.put("uid=a", "release", "hash3", None)
+        self.assertEqual(self.cache.get("uid=a", "allocate", "hash1"),
+                         (False, None))
+        self.assertEqual(self.cache.get("uid=a", "release", "hash3"),
+                         (True, None))
+        self.assertEqual(self.cache.stats(),
+                         {"hits": 2, "misses": 3, "stores": 2,
+                          "evictions": 0})
+
+    def test_responses_shared_between_instances(self):
+        self.cache.put("container=a/b", "isolate", "hash", None)
+        other = ResponseCache(self.tmpdir, 60, 10)
+        self.assertEqual(other.get("container=a/b", "isolate", "hash"),
+                         (True, None))
+
+    @patch('time.time', return_value=1000)
+    def test_responses_expire(self, m_time):
+        self.cache.put("uid=a", "allocate", "hash", "response")
+        m_time.return_value = 1060
+        self.assertEqual(self.cache.get("uid=a", "allocate", "hash"),
+                         (False, None))
+
+    def test_oldest_evicted(self):
+        cache = ResponseCache(self.tmpdir, 60, 2, evict_every=1)
+        now = time.time()
+        for age, key in ((2, "a"), (1, "b")):
+            cache.put(key, "cleanup", "hash", None)
+            os.utime(os.path.join(self.tmpdir, key), (now - age, now - age))
+        cache.put("c", "cleanup", "hash", None)
+
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["b", "c"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    @patch('random.randrange', return_value=0)
+    def test_eviction_is_occasional(self, m_randrange):
+        cache = ResponseCache(self.tmpdir, 60, 1, evict_every=3)
+        for key in ("a", "b"):
+            cache.put(key, "cleanup", "hash", None)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
+        cache.put("c", "cleanup", "hash", None)
+        self.assertEqual(os.listdir(self.tmpdir), ["c"])
+        m_randrange.assert_called_once_with(3)
+
+    def test_new_generation_invalidates_generational_responses(self):
+        self.cache.put("uid=a", "allocate", "hash", "response",
+                       self.cache.generation())
+        self.cache.put("container=b", "isolate", "hash", None)
+        self.cache.new_generation()
+        self.assertEqual(self.cache.get("uid=a", "allocate", "hash"),
+                         (False, None))
+        self.assertEqual(self.cache.get("container=b", "isolate", "hash"),
+                         (True, None))
+
+    def test_forget(self):
+        self.cache.put("container=a", "isolate", "hash", None)
+        self.cache.forget("container=a")
+        self.cache.forget("container=a")
+        self.assertEqual(self.cache.get("container=a", "isolate", "hash"),
+                         (False, None))
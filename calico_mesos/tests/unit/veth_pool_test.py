@@ -0,0 +1,93 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import unittest
+from subprocess import CalledProcessError
+from mock import Mock, patch
+from netaddr import IPNetwork
+from veth_pool import VethPool, provision_pooled_veth
+
+IP_LINKS = """1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN
+5: vpoolh0a0b0c@vpooln0a0b0c: <BROADCAST,MULTICAST,UP> mtu 1500
+6: vpooln0a0b0c@vpoolh0a0b0c: <BROADCAST,MULTICAST,UP> mtu 1500
+7: cali1234@if6: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500
+"""
+
+
+@patch('veth_pool.check_call', autospec=True)
+@patch('veth_pool.netns', autospec=True)
+class TestVethPool(unittest.TestCase):
+    def test_refill_creates_pairs(self, m_netns, m_check_call):
+        pool = VethPool(2)
+        pool.refill()
+        self.assertEqual(m_check_call.call_count, 2)
+        # Created down.
+        command = m_check_call.call_args[0][0]
+        host_name, peer_name = command[3], command[-1]
+        self.assertEqual(command, ["ip", "link", "add", host_name, "type",
+                                   "veth", "peer", "name", peer_name])
+        self.assertTrue(host_name.startswith("vpoolh"))
+        self.assertEqual(peer_name, "vpooln" + host_name[6:])
+        first = m_check_call.call_args_list[0][0][0]
+        self.assertEqual(pool.take(), (first[3], first[-1]))
+        self.assertEqual(pool.stats(), {"size": 1, "hits": 1, "misses": 0})
+
+    def test_take_when_empty(self, m_netns, m_check_call):
+        pool = VethPool(2)
+        self.assertIsNone(pool.take())
+        self.assertEqual(pool.stats()["misses"], 1)
+
+    @patch('veth_pool.check_output', autospec=True, return_value=IP_LINKS)
+    def test_pairs_deleted_on_start_and_stop(self, m_check_output, m_netns,
+                                             m_check_call):
+        pool = VethPool(1, interval=60)
+        pool.start()
+        for _ in range(100):
+            if pool.stats()["size"]:
+                break
+            time.sleep(0.01)
+        pool.stop()
+        commands = [args[0] for args, _ in m_check_call.call_args_list]
+        self.assertEqual(commands[0], ["ip", "link", "del", "vpoolh0a0b0c"])
+        self.assertEqual(commands[1][:3], ["ip", "link", "add"])
+        self.assertEqual(commands[2:], [["ip", "link", "del", commands[1][3]]])
+        self.assertEqual(pool.stats()["size"], 0)
+
+    def test_provision_pooled_veth(self, m_netns, m_check_call):
+        endpoint = Mock(ipv4_nets=set([IPNetwork("192.168.0.1/32")]),
+                        ipv6_nets=set())
+        endpoint.name = "cali1234"
+        namespace = Mock()
+
+        mac = provision_pooled_veth(endpoint, namespace, "eth0",
+                                    ("vpoolh1", "vpooln1"))
+
+        m_check_call.assert_called_once_with(
+            ["ip", "link", "set", "vpoolh1", "name", "cali1234", "up"])
+        m_netns.move_veth_into_ns.assert_called_once_with(namespace,
+                                                          "vpooln1", "eth0")
+        m_netns.add_ip_to_ns_veth.assert_called_once_with(
+            namespace, IPNetwork("192.168.0.1/32").ip, "eth0")
+        m_netns.add_ns_default_route.assert_called_once_with(
+            namespace, "cali1234", "eth0")
+        self.assertEqual(mac, m_netns.get_ns_veth_mac.return_value)
+
+    def test_failed_provision_deletes_pair(self, m_netns, m_check_call):
+        endpoint = Mock(ipv4_nets=set(), ipv6_nets=set())
+        endpoint.name = "cali1234"
+        m_netns.move_veth_into_ns.side_effect = CalledProcessError(1, "ip")
+
+        self.assertRaises(CalledProcessError, provision_pooled_veth,
+                          endpoint, Mock(), "eth0", ("vpoolh1", "vpooln1"))
+        m_check_call.assert_called_with(["ip", "link", "del", "cali1234"])
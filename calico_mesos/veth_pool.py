@@ -0,0 +1,174 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pool of veth pairs created ahead of time, so that isolating a container only
+has to move, rename and address an existing pair.
+"""
+import os
+import logging
+import threading
+from collections import deque
+from subprocess import check_call, check_output, CalledProcessError
+
+from pycalico import netns
+
+_log = logging.getLogger("CALICOMESOS")
+
+# Pooled pairs are named with these prefixes and a shared token, keeping
+# within the 15 character limit on interface names.  The host side must not
+# use Felix's "cali" prefix until it belongs to an endpoint.
+HOST_PREFIX = "vpoolh"
+PEER_PREFIX = "vpooln"
+
+
+class VethPool(object):
+    """
+    Keeps up to size veth pairs, refilled by a background thread.  Each pair
+    is a (host name, peer name) tuple.  Both sides are left down, so that
+    the host side can be renamed and brought up by a single command.
+
+    :param size: The number of pairs to keep.
+    :param interval: Seconds between checks, in addition to the checks made
+    whenever a pair is taken.
+    """
+    def __init__(self, size, interval=10):
+        self.size = size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pairs = deque()
+        self._counters = {"hits": 0, "misses": 0}
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """
+        Delete any pooled pairs left by a previous run, then start filling
+        the pool in the background.
+        """
+        for name in _pooled_links():
+            _delete_link(name)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop refilling and delete the pooled pairs.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            pairs = list(self._pairs)
+            self._pairs.clear()
+        for host_name, _ in pairs:
+            _delete_link(host_name)
+
+    def take(self):
+        """
+        :return: A (host name, peer name) tuple, or None if the pool is
+        empty.
+        """
+        with self._lock:
+            if self._pairs:
+                self._counters["hits"] += 1
+                pair = self._pairs.popleft()
+            else:
+                self._counters["misses"] += 1
+                pair = None
+        self._wakeup.set()
+        return pair
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._pairs)
+            return stats
+
+    def refill(self):
+        """
+        Create pairs until the pool is full.
+        """
+        while not self._stopping:
+            with self._lock:
+                if len(self._pairs) >= self.size:
+                    return
+            token = os.urandom(3).encode("hex")
+            pair = (HOST_PREFIX + token, PEER_PREFIX + token)
+            check_call(["ip", "link", "add", pair[0], "type", "veth",
+                        "peer", "name", pair[1]])
+            with self._lock:
+                self._pairs.append(pair)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                self.refill()
+            except Exception:
+                _log.exception("Couldn't refill the veth pool")
+            self._wakeup.wait(self.interval)
+
+
+def provision_pooled_veth(endpoint, namespace, veth_name_ns, pair):
+    """
+    Set up a pooled veth pair for an endpoint, as Endpoint.provision_veth
+    does for a pair it creates: the host side is renamed to the endpoint's
+    interface name, and the peer is moved into the namespace, addressed and
+    given default routes.  The pair is deleted if this fails.
+
+    :param endpoint: The pycalico Endpoint.
+    :param namespace: The netns.Namespace of the container.
+    :param veth_name_ns: The name of the interface in the namespace.
+    :param pair: The (host name, peer name) tuple taken from a VethPool.
+    :return: The MAC address of the veth in the namespace.
+    """
+    host_name, peer_name = pair
+    try:
+        # The rename is applied before the link is brought up, so both take
+        # one command.
+        check_call(["ip", "link", "set", host_name, "name", endpoint.name,
+                    "up"])
+        host_name = endpoint.name
+
+        netns.move_veth_into_ns(namespace, peer_name, veth_name_ns)
+        for ip_net in endpoint.ipv4_nets | endpoint.ipv6_nets:
+            netns.add_ip_to_ns_veth(namespace, ip_net.ip, veth_name_ns)
+        netns.add_ns_default_route(namespace, endpoint.name, veth_name_ns)
+        return netns.get_ns_veth_mac(namespace, veth_name_ns)
+    except Exception:
+        _delete_link(host_name)
+        raise
+
+
+def _pooled_links():
+    """
+    :return: Names of the host side of any pooled pairs which exist.
+    """
+    names = []
+    for line in check_output(["ip", "-o", "link", "show"]).splitlines():
+        # Lines are of the form "12: vpoolhabcdef@vpoolnabcdef: <...".
+        name = line.split(":")[1].strip().split("@")[0]
+        if name.startswith(HOST_PREFIX):
+            names.append(name)
+    return names
+
+
+def _delete_link(name):
+    try:
+        check_call(["ip", "link", "del", name])
+    except CalledProcessError as e:
+        _log.warning("Couldn't delete veth %s: %s", name, e)